@@ -2,6 +2,13 @@ import argparse
 
 # Import helpers scripts
 from scripts.delete_env_files import delete_files
+from scripts.environment import ExpensiveService, load_environment
+from scripts.git_metadata import head_info
+from scripts.image_builds import build_images
+from scripts.log_store import record_failure, run_logs
+from scripts.pipeline import pipelined_update
+from scripts.process_runner import run_process
+from scripts.startup_scheduler import StartupGraphError, build_startup_graph, concurrency_limit, start_expensive_services
 from scripts.utilities import *
 from scripts.update_apps import update_apps
 from scripts.self_update import self_update
@@ -9,16 +16,6 @@ from scripts.docker_compose import *
 from scripts.commodities import *
 from scripts.provision_custom import provision_custom
 
-def run_command(cmd: str, output_list: Optional[List[str]] = None) -> int:
-    """
-    Runs a shell command and optionally appends output lines to output_list.
-    Returns the command's exit code.
-    """
-    result = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-    if output_list is not None:
-        output_list.extend(result.stdout.splitlines())
-    return result.returncode
-
 def colorize_lightblue(msg: str) -> str:
     return msg
 
@@ -52,6 +49,9 @@ parser.add_argument('-p', '--provision-commodities', action='store_true')
 parser.add_argument('-C', '--prepare-compose', action='store_true')
 parser.add_argument('-r', '--reset', action='store_true')
 parser.add_argument('-n', '--nopull', action='store_true')
+parser.add_argument('-f', '--force-fetch', action='store_true')
+parser.add_argument('-P', '--pipeline', action='store_true')
+parser.add_argument('-F', '--force-provision', action='store_true')
 args = parser.parse_args()
 
 os.environ['PYTHONUNBUFFERED'] = '1'
@@ -63,17 +63,11 @@ def fail_and_exit(new_project: bool) -> None:
     print(colorize_red("Failed to clone or update the configuration repository."))
     sys.exit(1)
 
-def check_healthy_output(output_lines: List[str]) -> bool:
-    """
-    Checks if any line in output_lines contains 'healthy'.
-    """
-    return any('healthy' in line for line in output_lines)
-
 # Check for update logic
 if args.check_for_update:
     this_version: str = '3.1.0'
     print(colorize_lightblue(f"This is a universal dev env (version {this_version})"))
-    current_branch: str = subprocess.getoutput(f"git -C {root_loc} rev-parse --abbrev-ref HEAD").strip()
+    current_branch: str = head_info(root_loc).branch or 'HEAD'
     if current_branch == 'master':
         self_update(root_loc, this_version)
     else:
@@ -135,7 +129,10 @@ if args.prepare_config:
 # Update apps logic
 if args.update_apps:
     print(colorize_lightblue('Updating apps:'))
-    update_apps(root_loc)
+    if args.pipeline:
+        pipelined_update(root_loc, args.force_fetch, not args.nopull)
+    else:
+        update_apps(root_loc, args.force_fetch)
 
 # Reset environment logic
 if args.reset:
@@ -154,161 +151,100 @@ if args.reset:
 
 # Prepare docker-compose files
 if args.prepare_compose:
-    create_commodities_list(root_loc)
-    prepare_compose(root_loc, DOCKER_COMPOSE_FILE_LIST)
+    if compose_up_to_date(root_loc, DOCKER_COMPOSE_FILE_LIST):
+        print(colorize_lightblue('Compose configuration is up to date'))
+    else:
+        create_commodities_list(root_loc)
+        prepare_compose(root_loc, DOCKER_COMPOSE_FILE_LIST)
 
 # Build docker images
 if args.build_images:
     if os.path.getsize(DOCKER_COMPOSE_FILE_LIST) == 0:
         print(colorize_red('Nothing to start!'))
         sys.exit(1)
-    print(colorize_lightblue('Building images (might take a while)... (logging to logfiles/imagebuild.log)'))
-    if run_command(f"{os.environ.get('DC_CMD')} build {'--pull' if not args.nopull else ''} > logfiles/imagebuild.log 2>&1") != 0:
-        print(colorize_red('Something went wrong when building the images, check the log file. Here are the last 10 lines:'))
-        with open(os.path.join(root_loc, 'logfiles/imagebuild.log')) as f:
-            lines = f.readlines()
-            for line in lines[-10:]:
-                print(line, end='')
+    build_log: str = run_logs(root_loc).path('imagebuild')
+    print(colorize_lightblue(f"Building images (might take a while)... (logging to {run_logs(root_loc).display(build_log)})"))
+    if build_images(root_loc, not args.nopull, build_log) != 0:
+        print(colorize_red('Something went wrong when building the images, see the output above'))
         sys.exit(1)
 
 # Provision commodities (containers)
 if args.provision_commodities:
     existing_containers: List[str] = []
     run_command(f"{os.environ.get('DC_CMD')} ps --services", existing_containers)
-    print(colorize_lightblue('Recreating containers... (logging to logfiles/containercreate.log)'))
-    if run_command(f"{os.environ.get('DC_CMD')} up --remove-orphans --force-recreate --no-start > logfiles/containercreate.log 2>&1") != 0:
+    create_log: str = run_logs(root_loc).path('containercreate')
+    print(colorize_lightblue(f"Recreating containers... (logging to {run_logs(root_loc).display(create_log)})"))
+    create = run_process(f"{os.environ.get('DC_CMD')} up --remove-orphans --force-recreate --no-start",
+                         log_path=create_log)
+    if create.exit_code != 0:
+        record_failure(root_loc, create_log, create.exit_code)
         print(colorize_red('Something went wrong when creating the containers, check the log file. Here are the last 10 lines:'))
-        with open(os.path.join(root_loc, 'logfiles/containercreate.log')) as f:
-            lines = f.readlines()
-            for line in lines[-10:]:
-                print(line, end='')
+        create.print_tail()
         sys.exit(1)
     existing_containers2: List[str] = []
     run_command(f"{os.environ.get('DC_CMD')} ps --services", existing_containers2)
     new_containers: List[str] = list(set(existing_containers2) - set(existing_containers))
-    provision_commodities(root_loc, new_containers)
+    provision_commodities(root_loc, new_containers, args.force_provision)
 
 # Start applications logic
 if args.start_apps:
     if os.path.getsize(DOCKER_COMPOSE_FILE_LIST) == 0:
         print(colorize_red('Nothing to start!'))
         sys.exit(1)
-    with open(os.path.join(root_loc, 'dev-env-config', 'configuration.yml')) as f:
-        config: Dict[str, Any] = yaml.safe_load(f)
-    services_to_start: List[str] = []
-    run_command(f"{os.environ.get('DC_CMD')} config --services", services_to_start)
-    expensive_todo: List[Dict[str, Any]] = []
-    expensive_inprogress: List[Dict[str, Any]] = []
+    environment = load_environment(root_loc)
+    if environment is None:
+        print(colorize_red('No dev-env-config found!'))
+        sys.exit(1)
+    services_to_start: List[str] = compose_services(DOCKER_COMPOSE_FILE_LIST)
+    all_services: List[str] = list(services_to_start)
+    expensive_todo: List[ExpensiveService] = []
     print(colorize_lightblue('Checking application configurations...'))
-    for appname, appconfig in config.get('applications', {}).items():
-        config_options = appconfig.get('options', [])
-        for option in config_options:
-            service_name: str = option['compose-service-name']
-            auto_start: bool = option.get('auto-start', True)
-            if not auto_start:
+    for appname, app in environment.apps.items():
+        for option in app.options:
+            service_name: str = option.compose_service_name
+            if not option.auto_start:
                 print(colorize_pink(f"Dev-env-config option found - service {service_name} autostart is FALSE"))
                 if service_name in services_to_start:
                     services_to_start.remove(service_name)
-        app_config_path: str = os.path.join(root_loc, 'apps', appname, 'configuration.yml')
-        if not os.path.exists(app_config_path):
-            continue
-        with open(app_config_path) as depf:
-            dependencies: Dict[str, Any] = yaml.safe_load(depf)
-        if not dependencies or 'expensive_startup' not in dependencies:
-            continue
-        for service in dependencies['expensive_startup']:
-            service_name = service['compose_service']
+        for service in app.expensive_startup:
+            service_name = service.compose_service
             if service_name not in services_to_start:
                 continue
             print(colorize_pink(f"Found expensive to start service {service_name}"))
             expensive_todo.append(service)
             services_to_start.remove(service_name)
+    try:
+        startup_graph = build_startup_graph(expensive_todo, all_services)
+    except StartupGraphError as e:
+        print(colorize_red(f"Cannot start the expensive services: {e}"))
+        sys.exit(1)
     up: int = run_command(f"{os.environ.get('DC_CMD')} up --no-deps --remove-orphans -d logstash", [])
     time.sleep(3)
     if up != 0:
         print(colorize_red('Something went wrong when initialising live container logging. Check the output above.'))
         sys.exit(1)
     if services_to_start:
-        print(colorize_lightblue('Starting inexpensive services... (logging to logfiles/containerstart.log)'))
-        up = run_command(f"{os.environ.get('DC_CMD')} up --no-deps --remove-orphans -d {' '.join(services_to_start)}")
-        if up != 0:
+        start_log: str = run_logs(root_loc).path('containerstart')
+        print(colorize_lightblue(f"Starting inexpensive services... (logging to {run_logs(root_loc).display(start_log)})"))
+        start = run_process(f"{os.environ.get('DC_CMD')} up --no-deps --remove-orphans -d {' '.join(services_to_start)}",
+                            log_path=start_log)
+        if start.exit_code != 0:
+            record_failure(root_loc, start_log, start.exit_code)
             print(colorize_red('Something went wrong when starting the containers, check the log file. Here are the last 10 lines:'))
-            with open(os.path.join(root_loc, 'logfiles/containerstart.log')) as f:
-                lines = f.readlines()
-                for line in lines[-10:]:
-                    print(line, end='')
+            start.print_tail()
             sys.exit(1)
     if len(expensive_todo) > 0:
-        print(colorize_lightblue('Starting expensive services... (logging to logfiles/containerstart.log)'))
-    expensive_failed: List[Dict[str, Any]] = []
-    while len(expensive_todo) > 0 or len(expensive_inprogress) > 0:
-        if len(expensive_inprogress) > 0:
-            print()
-            time.sleep(5)
-        def healthy(service: Dict[str, Any]) -> bool:
-            """
-            Checks if a service is healthy using either Docker health check or a custom command.
-            """
-            service['check_count'] = service.get('check_count', 0) + 1
-            if service.get('healthcheck_cmd') == 'docker':
-                print(colorize_lightblue(f"Checking if {service['compose_service']} is healthy (using Docker healthcheck) - Attempt {service['check_count']}"))
-                output_lines: List[str] = []
-                outcode: int = run_command(f"docker inspect --format=\"{{{{json .State.Health.Status}}}}\" {service['compose_service']}", output_lines)
-                return outcode == 0 and check_healthy_output(output_lines)
-            else:
-                print(colorize_lightblue(f"Checking if {service['compose_service']} is healthy (using configuration.yml CMD) - Attempt {service['check_count']}"))
-                return run_command(f"docker exec {service['compose_service']} {service['healthcheck_cmd']}") == 0
-        # Remove healthy services from in-progress list
-        expensive_inprogress[:] = [s for s in expensive_inprogress if not healthy(s)]
-        for service in expensive_inprogress:
-            output_lines: List[str] = []
-            run_command(f"docker logs --tail 1 {service['compose_service']}", output_lines)
-            print(colorize_yellow(f"Not yet (Last log line: {output_lines[0] if output_lines else ''})"))
-            restart_count: int = 0
-            output_lines = []
-            run_command(f"docker inspect --format=\"{{{{json .RestartCount}}}}\" {service['compose_service']}", output_lines)
-            for ln in output_lines:
-                if ln.isdigit() and int(ln) > 0:
-                    restart_count = int(ln)
-            if restart_count > 0:
-                print(colorize_pink(f"The container has exited (crashed?) and been restarted {restart_count} times (max 10 allowed)"))
-            if restart_count > 9:
-                print(colorize_red('The failure threshold has been reached. Skipping this container'))
-                expensive_failed.append(service)
-                run_command(f"{os.environ.get('DC_CMD')} stop {service['compose_service']}")
-        while len(expensive_inprogress) < 3 and expensive_todo:
-            service = expensive_todo.pop(0)
-            dependency_healthy: bool = True
-            wait_until_healthy_list = service.get('wait_until_healthy', [])
-            if wait_until_healthy_list:
-                print(colorize_lightblue(f"{service['compose_service']} has dependencies it would like to be healthy before starting:"))
-            for dep in wait_until_healthy_list:
-                if dep.get('healthcheck_cmd') == 'docker':
-                    print(colorize_lightblue(f"Checking if {dep['compose_service']} is healthy (using Docker healthcheck)"))
-                    output_lines: List[str] = []
-                    outcode: int = run_command(f"docker inspect --format=\"{{{{json .State.Health.Status}}}}\" {dep['compose_service']}", output_lines)
-                    dependency_healthy = outcode == 0 and check_healthy_output(output_lines)
-                else:
-                    print(colorize_lightblue(f"Checking if {dep['compose_service']} is healthy (using cmd in configuration.yml)"))
-                    dependency_healthy = run_command(f"docker exec {dep['compose_service']} {dep['healthcheck_cmd']}") == 0
-                if dependency_healthy:
-                    print(colorize_green('It is!'))
-                else:
-                    print(colorize_yellow(f"{dep['compose_service']} is not healthy, so {service['compose_service']} will not be started yet"))
-                    time.sleep(3)
-                    break
-            if dependency_healthy:
-                run_command(f"{os.environ.get('DC_CMD')} up --no-deps --remove-orphans -d {service['compose_service']}")
-                service['check_count'] = 0
-                expensive_inprogress.append(service)
-    provision_custom(root_loc)
+        print(colorize_lightblue('Starting expensive services...'))
+    expensive_failed: List[ExpensiveService] = start_expensive_services(
+        startup_graph, concurrency_limit(environment.config))
+    provision_custom(root_loc, args.force_provision)
     if expensive_failed:
         print(colorize_yellow('All done, but the following containers failed to start - check logs/log.txt for any useful error messages:'))
         for service in expensive_failed:
-            print(colorize_yellow(f"  {service['compose_service']}"))
+            print(colorize_yellow(f"  {service.compose_service}"))
     else:
         print(colorize_green('Environment is ready for use'))
-    post_up_message = config.get('post-up-message')
+    post_up_message = environment.post_up_message
     if post_up_message:
         print()
         print(colorize_yellow('Special message from your dev-env-config:'))
@@ -28,6 +28,8 @@ fi
 
 command="$1"         # Get the first argument as the main command
 subcommands="$2"     # Get the second argument as subcommands or flags
+# Every step of this command logs to the same run in logfiles/runs
+export DEV_ENV_RUN_ID="$(date +%Y%m%d-%H%M%S)-$$"
 
 if [ "$command" = "up" ]
 then
@@ -114,13 +116,30 @@ else
       reload        stop all containers, rebuild them, and restart them
                     (including commodity fragments)
       quickreload   as per reload, but without rebuilding images 
-      destroy       stop and remove all containers, then remove all built
-                    images and (optionally) reset common-dev-env configuration
+      destroy       stop and remove all containers, volumes and volume
+                    snapshots, then remove all built images and (optionally)
+                    reset common-dev-env configuration
       repair        set the docker-compose configuration to use *this* dev-env,
                     for users with several common-dev-env instances
 
    flags:
       -n, --nopull  for 'up' and 'reload' only; avoid docker hub ratelimiting 
                     by not checking for updates to FROM images used in 
-                    Dockerfiles"
+                    Dockerfiles
+      -f, --force-fetch
+                    for 'up' and 'reload' only; fetch every app's repo even
+                    if its remote was seen unchanged within the fetch TTL
+                    (fetch-ttl in the dev-env-config, or DEV_ENV_FETCH_TTL)
+      -P, --pipeline
+                    for 'up' and 'reload' only; build and provision each app
+                    as soon as its repo has been updated instead of waiting
+                    for every repo
+      -F, --force-provision
+                    for 'up' and 'reload' only; run every always-run custom
+                    provision script, even those whose declared inputs are
+                    unchanged, and retry Postgres init fragments that
+                    reported errors (or set DEV_ENV_FORCE_PROVISION=1)"
 fi
+
+# This script is sourced, so the run ID would otherwise outlive the command
+unset DEV_ENV_RUN_ID
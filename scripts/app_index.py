@@ -0,0 +1,192 @@
+import os
+import re
+import sys
+import glob
+import time
+import shutil
+import tempfile
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+# Fragment kinds with a fixed filename
+FRAGMENT_KINDS = {
+    'compose-fragment.yml': 'compose',
+    'postgres-init-fragment.sql': 'postgres-init',
+    'custom-provision.sh': 'custom-provision',
+    'custom-provision-always.sh': 'custom-provision-always',
+}
+VARIANT_PATTERN = re.compile(r'compose-fragment\.(.*?)\.yml')
+
+# root_loc -> (directory mtimes, index)
+_index_cache: Dict[str, Tuple[Tuple[Optional[int], ...], 'AppIndex']] = {}
+
+
+@dataclass
+class AppFiles:
+    name: str
+    path: str
+    # Path of apps/<app>/configuration.yml, or None if there is none
+    config: Optional[str] = None
+    # Fragment kind (see FRAGMENT_KINDS) -> path
+    fragments: Dict[str, str] = field(default_factory=dict)
+    # Variant name -> path of compose-fragment.<variant>.yml
+    variants: Dict[str, str] = field(default_factory=dict)
+    # Other files whose names look like compose fragments but are not recognised
+    unsupported: List[str] = field(default_factory=list)
+
+    def fragment(self, kind: str) -> Optional[str]:
+        return self.fragments.get(kind)
+
+    @property
+    def compose_fragments(self) -> List[str]:
+        """
+        Every *compose-fragment*.yml file, recognised or not, sorted by name.
+        """
+        paths = list(self.variants.values()) + self.unsupported
+        if 'compose' in self.fragments:
+            paths.append(self.fragments['compose'])
+        return sorted(paths, key=os.path.basename)
+
+
+@dataclass
+class AppIndex:
+    root_loc: str
+    apps: Dict[str, AppFiles]
+
+    def app(self, appname: str) -> AppFiles:
+        """
+        Returns the files for an app; an app that has not been cloned has none.
+        """
+        files = self.apps.get(appname)
+        if files is None:
+            return AppFiles(name=appname, path=os.path.join(self.root_loc, 'apps', appname))
+        return files
+
+
+def scan_app(name: str, path: str) -> Tuple[AppFiles, Optional[int]]:
+    """
+    Indexes one app directory, returning the files and the mtime of its fragments directory.
+    """
+    files = AppFiles(name=name, path=path)
+    fragments_mtime: Optional[int] = None
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name == 'configuration.yml' and entry.is_file():
+                files.config = entry.path
+            elif entry.name == 'fragments' and entry.is_dir():
+                fragments_mtime = entry.stat().st_mtime_ns
+    if fragments_mtime is None:
+        return files, None
+    with os.scandir(os.path.join(path, 'fragments')) as entries:
+        for entry in entries:
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            kind = FRAGMENT_KINDS.get(entry.name)
+            if kind is not None:
+                files.fragments[kind] = entry.path
+            elif 'compose-fragment' in entry.name and entry.name.endswith('.yml'):
+                match = VARIANT_PATTERN.fullmatch(entry.name)
+                if match:
+                    files.variants[match.group(1)] = entry.path
+                else:
+                    files.unsupported.append(entry.path)
+    return files, fragments_mtime
+
+
+def build_app_index(root_loc: str) -> Tuple[AppIndex, Tuple[Optional[int], ...]]:
+    apps_dir = os.path.join(root_loc, 'apps')
+    apps: Dict[str, AppFiles] = {}
+    mtimes: List[Optional[int]] = []
+    try:
+        mtimes.append(os.stat(apps_dir).st_mtime_ns)
+        with os.scandir(apps_dir) as entries:
+            app_entries = sorted((entry for entry in entries if entry.is_dir()), key=lambda entry: entry.name)
+    except FileNotFoundError:
+        return AppIndex(root_loc, apps), (None,)
+    for entry in app_entries:
+        files, fragments_mtime = scan_app(entry.name, entry.path)
+        apps[entry.name] = files
+        mtimes += [entry.stat().st_mtime_ns, fragments_mtime]
+    return AppIndex(root_loc, apps), tuple(mtimes)
+
+
+def directory_mtimes(index: AppIndex) -> Tuple[Optional[int], ...]:
+    mtimes: List[Optional[int]] = []
+    try:
+        mtimes.append(os.stat(os.path.join(index.root_loc, 'apps')).st_mtime_ns)
+        for files in index.apps.values():
+            mtimes.append(os.stat(files.path).st_mtime_ns)
+            try:
+                mtimes.append(os.stat(os.path.join(files.path, 'fragments')).st_mtime_ns)
+            except FileNotFoundError:
+                mtimes.append(None)
+    except FileNotFoundError:
+        return (None,)
+    return tuple(mtimes)
+
+
+def app_index(root_loc: str) -> AppIndex:
+    """
+    Returns an index of every app directory and its fragments, built in one scandir pass.
+    The index is rebuilt only when an app or fragments directory has gained or lost entries.
+    """
+    cached = _index_cache.get(root_loc)
+    if cached is not None and directory_mtimes(cached[1]) == cached[0]:
+        return cached[1]
+    index, mtimes = build_app_index(root_loc)
+    _index_cache[root_loc] = (mtimes, index)
+    return index
+
+
+def benchmark(app_count: int = 500, iterations: int = 5) -> None:
+    """
+    Compares the old per-file glob/exists discovery with the index over a synthetic tree of app_count apps.
+    """
+    root_loc = tempfile.mkdtemp(prefix='app-index-bench-')
+    try:
+        for number in range(app_count):
+            fragments = os.path.join(root_loc, 'apps', f'app{number}', 'fragments')
+            os.makedirs(fragments)
+            names = ['compose-fragment.yml', 'postgres-init-fragment.sql']
+            if number % 3 == 0:
+                names += ['compose-fragment.alt.yml', 'custom-provision.sh']
+            for name in names + ['unrelated.txt']:
+                open(os.path.join(fragments, name), 'w').close()
+            open(os.path.join(root_loc, 'apps', f'app{number}', 'configuration.yml'), 'w').close()
+        appnames = [f'app{number}' for number in range(app_count)]
+
+        def scattered() -> None:
+            for appname in appnames:
+                fragments = os.path.join(root_loc, 'apps', appname, 'fragments')
+                glob.glob(os.path.join(fragments, '*compose-fragment*.yml'))
+                for name in ['postgres-init-fragment.sql', 'custom-provision.sh', 'custom-provision-always.sh']:
+                    os.path.exists(os.path.join(fragments, name))
+                os.path.exists(os.path.join(root_loc, 'apps', appname, 'configuration.yml'))
+
+        def indexed() -> None:
+            _index_cache.clear()
+            index = app_index(root_loc)
+            for appname in appnames:
+                files = index.app(appname)
+                files.compose_fragments
+                for kind in ['postgres-init', 'custom-provision', 'custom-provision-always']:
+                    files.fragment(kind)
+
+        def revalidated() -> None:
+            index = app_index(root_loc)
+            for appname in appnames:
+                index.app(appname).fragment('postgres-init')
+
+        for label, run in (('glob/exists', scattered), ('index (cold)', indexed), ('index (cached)', revalidated)):
+            started = time.perf_counter()
+            for _ in range(iterations):
+                run()
+            elapsed = (time.perf_counter() - started) / iterations
+            print(f"{label:<15} {elapsed * 1000:>8.2f} ms for {app_count} apps")
+    finally:
+        shutil.rmtree(root_loc)
+        _index_cache.clear()
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
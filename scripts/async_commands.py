@@ -0,0 +1,69 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+from scripts.process_runner import Command, LineDecoder, READ_SIZE
+
+T = TypeVar('T')
+
+
+async def _spawn(cmd: Command, input_text: Optional[str], env: Optional[Dict[str, str]]) -> asyncio.subprocess.Process:
+    stdin = asyncio.subprocess.PIPE if input_text is not None else asyncio.subprocess.DEVNULL
+    if isinstance(cmd, str):
+        return await asyncio.create_subprocess_shell(
+            cmd, stdin=stdin, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, env=env)
+    return await asyncio.create_subprocess_exec(
+        *cmd, stdin=stdin, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, env=env)
+
+
+async def stream_async(cmd: Command, on_line: Callable[[str], None], input_text: Optional[str] = None,
+                       env: Optional[Dict[str, str]] = None) -> int:
+    """
+    Runs a command (a string runs through the shell, a list does not) and calls on_line with each
+    line of combined stdout/stderr as it arrives. env replaces the process environment if given.
+    Returns the exit code.
+    """
+    try:
+        process = await _spawn(cmd, input_text, env)
+    except OSError as e:
+        on_line(str(e))
+        return 127
+    if input_text is not None:
+        process.stdin.write(input_text.encode())
+        await process.stdin.drain()
+        process.stdin.close()
+    decoder = LineDecoder()
+    while True:
+        data = await process.stdout.read(READ_SIZE)
+        if not data:
+            break
+        for line in decoder.feed(data):
+            on_line(line)
+    for line in decoder.close():
+        on_line(line)
+    return await process.wait()
+
+
+async def run_async(cmd: Command, output_lines: Optional[List[str]] = None, input_text: Optional[str] = None,
+                    env: Optional[Dict[str, str]] = None) -> int:
+    """
+    The awaitable equivalent of utilities.run_command: output is printed, or collected into
+    output_lines if a list is given. Returns the exit code.
+    """
+    if output_lines is None:
+        return await stream_async(cmd, print, input_text, env)
+    return await stream_async(cmd, output_lines.append, input_text, env)
+
+
+async def capture_async(cmd: Command, input_text: Optional[str] = None,
+                        env: Optional[Dict[str, str]] = None) -> Tuple[int, List[str]]:
+    """
+    Runs a command and returns (exit code, output lines).
+    """
+    output_lines: List[str] = []
+    return await run_async(cmd, output_lines, input_text, env), output_lines
+
+
+def run_sync(awaitable: Awaitable[T]) -> T:
+    """
+    Runs a coroutine to completion from synchronous code.
+    """
+    return asyncio.run(awaitable)
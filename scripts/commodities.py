@@ -1,7 +1,10 @@
-import os
-import yaml
-from scripts.utilities import colorize_yellow, colorize_pink, colorize_lightblue
-from provision_scripts.provision_postgres import provision_postgres
+import asyncio
+import hashlib
+from typing import Any, Dict, Tuple, Union
+from scripts.async_commands import run_sync
+from scripts.environment import Environment, load_environment
+from scripts.state_store import commodities_store
+from scripts.utilities import colorize_yellow, colorize_pink, colorize_lightblue, force_requested
 # from scripts.provision_hosts import provision_hosts
 # from scripts.provision_nginx import provision_nginx
 # from scripts.provision_elasticsearch5 import provision_elasticsearch5
@@ -11,29 +14,26 @@ from provision_scripts.provision_postgres import provision_postgres
 
 def create_commodities_list(root_loc: str) -> None:
     """
-    Builds a list of all commodities required by all apps and writes it to .commodities.yml.
+    Builds a list of all commodities required by all apps and writes it to the .commodities state file.
     """
-    config_path = os.path.join(root_loc, 'dev-env-config', 'configuration.yml')
-    if not os.path.exists(config_path):
+    environment = load_environment(root_loc)
+    if environment is None:
         print(colorize_yellow('No dev-env-config found. Maybe this is a fresh box... '
                               'if so, you need to do "source run.sh up"'))
         exit(1)
 
-    with open(config_path) as f:
-        config = yaml.safe_load(f)
-
-    commodity_list, app_to_commodity_map = which_app_needs_what(root_loc, config)
+    commodity_list, app_to_commodity_map = which_app_needs_what(environment)
     if 'logging' not in commodity_list:
         commodity_list.append('logging')
     commodity_file = get_commodity_file(root_loc)
+    if commodity_file.get('commodities') == commodity_list and not missing_pairings(app_to_commodity_map, commodity_file) \
+            and commodities_store(root_loc).exists():
+        return
 
-    # Update the master list and add missing pairings
-    commodity_file['commodities'] = commodity_list
-    add_missing_pairings(app_to_commodity_map, commodity_file)
-
-    # Write the commodity information to a file
-    with open(os.path.join(root_loc, '.commodities.yml'), 'w') as f:
-        yaml.dump(commodity_file, f)
+    # Update the master list and add missing pairings; written once when the batch ends
+    with commodities_store(root_loc).batch() as commodity_file:
+        commodity_file['commodities'] = commodity_list
+        add_missing_pairings(app_to_commodity_map, commodity_file)
 
 def add_missing_pairings(app_to_commodity_map: dict, commodity_file: dict) -> None:
     """
@@ -48,93 +48,119 @@ def add_missing_pairings(app_to_commodity_map: dict, commodity_file: dict) -> No
                 cf_app_list[app_name][current_commodity] = False
                 print(colorize_pink(f"Found a new commodity dependency from {app_name} to {current_commodity}"))
 
-def which_app_needs_what(root_loc: str, config: dict) -> tuple[list, dict]:
+def missing_pairings(app_to_commodity_map: dict, commodity_file: dict) -> bool:
+    """
+    Returns True if any app/commodity pairing is absent from the commodity file.
+    """
+    cf_app_list = commodity_file.get('applications') or {}
+    return any(
+        current_commodity not in (cf_app_list.get(app_name) or {})
+        for app_name, app_commodity_list in app_to_commodity_map.items()
+        for current_commodity in app_commodity_list
+    )
+
+def which_app_needs_what(environment: Environment) -> tuple[list, dict]:
     """
     Returns a tuple: (list of all commodities, mapping of app to its commodities).
     """
-    app_to_commodity_map = {}
-    commodity_list = []
-    if config.get('applications'):
-        for appname in config['applications']:
-            app_config_path = os.path.join(root_loc, 'apps', appname, 'configuration.yml')
-            if not os.path.exists(app_config_path):
-                continue
-            with open(app_config_path) as f:
-                dependencies = yaml.safe_load(f)
-            if not dependencies or 'commodities' not in dependencies:
-                continue
-            for appcommodity in dependencies['commodities']:
-                commodity_list.append(appcommodity)
-                app_to_commodity_map.setdefault(appname, []).append(appcommodity)
-    return list(set(commodity_list)), app_to_commodity_map
+    return environment.commodities, environment.app_to_commodities()
 
 def get_commodity_file(root_loc: str) -> dict:
     """
-    Loads or creates the .commodities.yml file structure.
+    Loads (or starts a new) .commodities state document.
     """
-    path = os.path.join(root_loc, '.commodities.yml')
-    if os.path.exists(path):
-        with open(path) as f:
-            commodity_file = yaml.safe_load(f)
-    else:
+    store = commodities_store(root_loc)
+    if not store.exists():
         print(colorize_lightblue('Did not find any .commodities file. Creating a new one.'))
-        commodity_file = {
-            'version': '2',
-            'commodities': [],
-            'applications': {}
-        }
-    return commodity_file
+    return store.data
 
 def commodity_provisioned(root_loc: str, app_name: str, commodity: str) -> bool:
     """
     Returns True if the commodity is provisioned for the app.
     """
-    with open(os.path.join(root_loc, '.commodities.yml')) as f:
-        commodity_file = yaml.safe_load(f)
-    return commodity_file['applications'][app_name][commodity]
+    return bool(commodities_store(root_loc).data['applications'][app_name][commodity])
+
+def provision_status(root_loc: str, app_name: str, commodity: str) -> Union[str, bool, Dict[str, Any], None]:
+    """
+    Returns what is recorded for the app's init fragment: the digest of the fragment applied cleanly,
+    {'digest': ..., 'errors': True} if it reported errors, True if the app was provisioned before digests
+    were recorded, or None/False if it has not been provisioned.
+    """
+    return (commodities_store(root_loc).data['applications'].get(app_name) or {}).get(commodity)
+
+def fragment_digest(content: bytes) -> str:
+    return 'sha256:' + hashlib.sha256(content).hexdigest()
 
-def set_commodity_provision_status(root_loc: str, app_name: str, commodity: str, status: bool) -> None:
+def provision_decision(root_loc: str, app_name: str, commodity: str, content: bytes,
+                       new_container: bool, force: bool = False) -> Tuple[bool, str]:
+    """
+    Decides whether an app's init fragment needs running. Returns (run it, reason). A fragment that
+    reported errors is not run again until it changes or provisioning is forced, as fragments that
+    create databases or users would otherwise fail on every run.
+    """
+    status = provision_status(root_loc, app_name, commodity)
+    if new_container:
+        return True, 'the container is new'
+    if status is True:
+        # Nothing records what was applied; assume the current fragment so later edits are picked up
+        set_commodity_provision_status(root_loc, app_name, commodity, fragment_digest(content))
+        return False, 'provisioned before fragment changes were tracked'
+    if isinstance(status, dict):
+        if status.get('digest') != fragment_digest(content):
+            return True, 'the fragment has changed since it reported errors'
+        if force:
+            return True, 'it reported errors last time and provisioning is forced'
+        return False, 'it reported errors last time and is unchanged (use --force-provision to retry)'
+    if not isinstance(status, str):
+        return True, 'not provisioned yet'
+    if status != fragment_digest(content):
+        return True, 'the fragment has changed since it was applied'
+    return False, 'the fragment is unchanged since it was applied'
+
+def set_commodity_provision_status(root_loc: str, app_name: str, commodity: str,
+                                   status: Union[bool, str, Dict[str, Any]]) -> None:
     """
-    Sets the provision status for a commodity for a given app.
+    Sets the provision status for a commodity for a given app (see provision_status). Inside a
+    commodities_store(root_loc).deferred() the write is held back until that ends.
     """
-    path = os.path.join(root_loc, '.commodities.yml')
-    with open(path) as f:
-        commodity_file = yaml.safe_load(f)
-    commodity_file['applications'][app_name][commodity] = status
-    with open(path, 'w') as f:
-        yaml.dump(commodity_file, f)
+    with commodities_store(root_loc).batch() as commodity_file:
+        commodity_file['applications'].setdefault(app_name, {})[commodity] = status
 
 def commodity_required(root_loc: str, appname: str, commodity: str) -> bool:
     """
     Returns True if the app requires the commodity.
     """
-    app_config_path = os.path.join(root_loc, 'apps', appname, 'configuration.yml')
-    if not os.path.exists(app_config_path):
-        return False
-    with open(app_config_path) as f:
-        dependencies = yaml.safe_load(f)
-    if not dependencies:
-        return False
-    return 'commodities' in dependencies and commodity in dependencies['commodities']
+    environment = load_environment(root_loc)
+    return environment is not None and environment.commodity_required(appname, commodity)
 
 def commodity(root_loc: str, commodity_name: str) -> bool:
     """
     Returns True if the given name is a commodity in the environment.
     """
-    path = os.path.join(root_loc, '.commodities.yml')
-    if not os.path.exists(path):
+    store = commodities_store(root_loc)
+    if not store.exists():
         return False
-    with open(path) as f:
-        commodities = yaml.safe_load(f)
-    return commodity_name in commodities.get('commodities', [])
+    return commodity_name in store.data.get('commodities', [])
 
-def provision_commodities(root_loc: str, new_containers: list) -> None:
+def provision_commodities(root_loc: str, new_containers: list, force: bool = False) -> None:
     """
-    Provisions all required commodities for the environment.
+    Provisions all required commodities for the environment. force (or DEV_ENV_FORCE_PROVISION) retries
+    init fragments that reported errors even if they are unchanged.
     """
+    force = force_requested(force)
+    # Imported here as provision_postgres itself depends on this module
+    from scripts.provision_scripts.provision_postgres import provision_postgres_async
     print(colorize_lightblue('Provisioning commodities...'))
-    for postgres_version in ['13', '17']:
-        provision_postgres(root_loc, new_containers, postgres_version)
+
+    async def provision_all() -> None:
+        # The Postgres versions are separate containers, so they are provisioned side by side
+        await asyncio.gather(*(
+            provision_postgres_async(root_loc, new_containers, postgres_version, force)
+            for postgres_version in ['13', '17']
+        ))
+
+    with commodities_store(root_loc).deferred():
+        run_sync(provision_all())
     # provision_nginx(root_loc, new_containers)
     # provision_elasticsearch5(root_loc)
     # provision_elasticsearch7(root_loc)
@@ -0,0 +1,95 @@
+import json
+import subprocess
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional
+from scripts.docker_api import DockerAPIError, docker_client
+
+
+@dataclass(frozen=True)
+class ContainerState:
+    name: str
+    exists: bool
+    status: str = 'missing'
+    # None when the container has no Docker healthcheck
+    health: Optional[str] = None
+    restart_count: int = 0
+    exit_code: int = 0
+    # ID of the image the container was created from
+    image: Optional[str] = None
+
+    @property
+    def healthy(self) -> bool:
+        return self.health == 'healthy'
+
+    @property
+    def running(self) -> bool:
+        return self.status == 'running'
+
+
+class ContainerSnapshot:
+    """
+    The state of a set of containers as reported by a single `docker inspect` call.
+    Lookups are by container name or compose service name.
+    """
+
+    def __init__(self, states: Dict[str, ContainerState]):
+        self.states = states
+
+    def __getitem__(self, name: str) -> ContainerState:
+        return self.states.get(name) or ContainerState(name=name, exists=False)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.states
+
+    def healthy(self, name: str) -> bool:
+        return self[name].healthy
+
+
+def parse_inspect_output(output: str) -> Dict[str, ContainerState]:
+    try:
+        documents = json.loads(output or '[]')
+    except ValueError:
+        return {}
+    return parse_inspect_documents(documents)
+
+
+def parse_inspect_documents(documents: List[Dict[str, Any]]) -> Dict[str, ContainerState]:
+    states: Dict[str, ContainerState] = {}
+    for document in documents:
+        state = document.get('State') or {}
+        name = (document.get('Name') or '').lstrip('/')
+        container_state = ContainerState(
+            name=name,
+            exists=True,
+            status=state.get('Status', 'unknown'),
+            health=(state.get('Health') or {}).get('Status'),
+            restart_count=document.get('RestartCount') or 0,
+            exit_code=state.get('ExitCode') or 0,
+            image=document.get('Image'),
+        )
+        states[name] = container_state
+        service = ((document.get('Config') or {}).get('Labels') or {}).get('com.docker.compose.service')
+        if service and service not in states:
+            states[service] = container_state
+    return states
+
+
+def container_snapshot(names: Iterable[str], docker: str = 'docker') -> ContainerSnapshot:
+    """
+    Inspects all the named containers with one `docker inspect` call (or over one pooled
+    Engine API connection when the socket is available). Containers that do not
+    exist are reported as missing rather than failing the whole snapshot.
+    """
+    names = sorted(set(names))
+    if not names:
+        return ContainerSnapshot({})
+    client = docker_client()
+    if client is not None:
+        try:
+            return ContainerSnapshot(parse_inspect_documents(client.inspect_many(names)))
+        except DockerAPIError:
+            pass
+    # docker inspect exits non-zero if any container is missing, but still prints the ones it found
+    result = subprocess.run([docker, 'inspect', '--type', 'container', *names],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    return ContainerSnapshot(parse_inspect_output(result.stdout))
@@ -1,19 +1,25 @@
 import os
+import shutil
+from scripts.state_store import state_file_paths
 
 def delete_files(root_loc: str) -> None:
     """
-    Deletes specific files in the given root directory if they exist.
+    Deletes specific files in the given root directory if they exist, along with the merged compose files
+    and the volume snapshots (whose volumes the reset removes too).
     """
     files_to_delete = [
-        '.commodities.yml',
-        '.custom_provision.yml',
         '.docker-compose-file-list',
         '.db2_init.sql',
         '.postgres_init.sql'
     ]
-    for filename in files_to_delete:
-        file_path = os.path.join(root_loc, filename)
+    state_names = ('.commodities', '.custom_provision', '.update-timings', '.remote-freshness', '.compose-manifest',
+                   '.image-builds')
+    state_files = [path for name in state_names
+                   for path in state_file_paths(root_loc, name)]
+    for file_path in [os.path.join(root_loc, filename) for filename in files_to_delete] + state_files:
         try:
             os.remove(file_path)
         except FileNotFoundError:
             pass
+    for directory in ('.compose-cache', '.volume-snapshots'):
+        shutil.rmtree(os.path.join(root_loc, directory), ignore_errors=True)
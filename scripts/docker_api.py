@@ -0,0 +1,247 @@
+import io
+import os
+import json
+import shlex
+import socket
+import struct
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+DEFAULT_SOCKET = '/var/run/docker.sock'
+BASE_URL = 'http+docker://localhost'
+
+_client: Optional['DockerClient'] = None
+_client_checked = False
+_client_lock = threading.Lock()
+
+
+class DockerAPIError(Exception):
+    """
+    Raised for error responses and for transport failures (the daemon restarting, a broken socket), so
+    callers only have to handle this one exception before falling back to the CLI.
+    """
+    pass
+
+
+class UnixSocketConnection(urllib3.connection.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: Any = None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def _new_conn(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        return sock
+
+
+class UnixSocketConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    def __init__(self, socket_path: str, timeout: float, maxsize: int):
+        super().__init__('localhost', timeout=timeout, maxsize=maxsize, block=False)
+        self.socket_path = socket_path
+
+    def _new_conn(self) -> UnixSocketConnection:
+        return UnixSocketConnection(self.socket_path, self.timeout.connect_timeout)
+
+
+class UnixSocketAdapter(HTTPAdapter):
+    """
+    Sends every request over one keep-alive connection pool bound to a unix socket.
+    """
+
+    def __init__(self, socket_path: str, timeout: float = 60, pool_maxsize: int = 8):
+        super().__init__()
+        self.pool = UnixSocketConnectionPool(socket_path, timeout, pool_maxsize)
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self.pool
+
+    def get_connection(self, url, proxies=None):
+        return self.pool
+
+    def request_url(self, request, proxies):
+        return request.path_url
+
+    def close(self) -> None:
+        self.pool.close()
+        super().close()
+
+
+def demultiplex(data: bytes) -> bytes:
+    """
+    Strips the 8-byte stream headers Docker adds to the output of containers without a TTY.
+    Output that does not start with such a header (TTY containers) is returned unchanged.
+    """
+    if len(data) < 8 or data[0] not in (0, 1, 2) or data[1:4] != b'\0\0\0':
+        return data
+    chunks = []
+    offset = 0
+    while offset + 8 <= len(data):
+        size = struct.unpack('>I', data[offset + 4:offset + 8])[0]
+        chunks.append(data[offset + 8:offset + 8 + size])
+        offset += 8 + size
+    return b''.join(chunks)
+
+
+class DockerClient:
+    """
+    A minimal Docker Engine API client covering what the dev-env needs: inspect, logs, exec,
+    archive upload and events.
+    """
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET, timeout: float = 60, pool_maxsize: int = 8):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.pool_maxsize = pool_maxsize
+        self.session = requests.Session()
+        self.session.mount('http+docker://', UnixSocketAdapter(socket_path, timeout, pool_maxsize))
+
+    def close(self) -> None:
+        self.session.close()
+
+    def _request(self, method: str, path: str, expected: Tuple[int, ...] = (200,), **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            response = self.session.request(method, BASE_URL + path, **kwargs)
+        except (requests.RequestException, urllib3.exceptions.HTTPError, OSError) as e:
+            raise DockerAPIError(f"{method} {path} failed: {e}") from e
+        if response.status_code not in expected:
+            try:
+                message = response.json().get('message', response.text)
+            except ValueError:
+                message = response.text
+            raise DockerAPIError(f"{method} {path} returned {response.status_code}: {message}")
+        return response
+
+    def ping(self) -> bool:
+        try:
+            return self._request('GET', '/_ping', timeout=5).text == 'OK'
+        except (requests.RequestException, DockerAPIError, OSError):
+            return False
+
+    def inspect(self, name: str) -> Optional[Dict[str, Any]]:
+        """
+        Returns the same document as `docker inspect <name>`, or None if there is no such container.
+        """
+        response = self._request('GET', f"/containers/{quote(name)}/json", expected=(200, 404))
+        return response.json() if response.status_code == 200 else None
+
+    def inspect_many(self, names: Iterable[str]) -> List[Dict[str, Any]]:
+        """
+        Inspects several containers at once over the pooled connections (the Engine API has no batch
+        inspect; the container list endpoint lacks the health and restart details needed).
+        Missing containers are left out.
+        """
+        names = list(names)
+        if len(names) <= 1:
+            documents = [self.inspect(name) for name in names]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.pool_maxsize, len(names))) as executor:
+                documents = list(executor.map(self.inspect, names))
+        return [document for document in documents if document is not None]
+
+    def image_id(self, name: str) -> Optional[str]:
+        """
+        Returns the ID of the named image (as `docker image inspect --format {{.Id}}`), or None if it does not exist.
+        """
+        response = self._request('GET', f"/images/{quote(name)}/json", expected=(200, 404))
+        return response.json().get('Id') if response.status_code == 200 else None
+
+    def logs(self, name: str, tail: int = 1) -> str:
+        response = self._request('GET', f"/containers/{quote(name)}/logs",
+                                 params={'stdout': 1, 'stderr': 1, 'tail': tail})
+        return demultiplex(response.content).decode('utf-8', errors='replace')
+
+    def exec(self, name: str, cmd: List[str]) -> Tuple[int, str]:
+        """
+        Runs cmd in the container and returns (exit code, combined stdout and stderr).
+        """
+        created = self._request('POST', f"/containers/{quote(name)}/exec", expected=(201,),
+                                json={'AttachStdout': True, 'AttachStderr': True, 'Cmd': cmd}).json()
+        exec_id = created['Id']
+        # The request blocks until the command finishes, so it is not subject to the usual timeout
+        output = self._request('POST', f"/exec/{exec_id}/start", json={'Detach': False, 'Tty': False},
+                               timeout=None).content
+        exit_code = self._request('GET', f"/exec/{exec_id}/json").json().get('ExitCode')
+        return (exit_code if exit_code is not None else 1), demultiplex(output).decode('utf-8', errors='replace')
+
+    def put_archive(self, name: str, path: str, archive: bytes) -> None:
+        self._request('PUT', f"/containers/{quote(name)}/archive", params={'path': path}, data=archive,
+                      headers={'Content-Type': 'application/x-tar'})
+
+    def upload_files(self, name: str, path: str, files: Dict[str, bytes]) -> None:
+        """
+        Copies files (archive name -> content) into a directory in the container, replacing `tar | docker cp`.
+        """
+        self.put_archive(name, path, build_archive(files))
+
+    def events(self, filters: Dict[str, List[str]]) -> Iterator[Dict[str, Any]]:
+        response = self._request('GET', '/events', params={'filters': json.dumps(filters)},
+                                 stream=True, timeout=(self.timeout, None))
+        try:
+            for line in response.iter_lines():
+                if line:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+        finally:
+            response.close()
+
+
+def build_archive(files: Dict[str, bytes]) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as archive:
+        for archive_name, content in files.items():
+            info = tarfile.TarInfo(archive_name)
+            info.size = len(content)
+            info.mode = 0o644
+            archive.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+def socket_path() -> Optional[str]:
+    """
+    Returns the Docker socket to use, honouring a unix:// DOCKER_HOST. Returns None if Docker is
+    reached some other way (e.g. over TCP), in which case only the CLI can be used.
+    """
+    docker_host = os.environ.get('DOCKER_HOST', '')
+    if docker_host.startswith('unix://'):
+        return docker_host[len('unix://'):]
+    if docker_host:
+        return None
+    return DEFAULT_SOCKET
+
+
+def docker_client() -> Optional[DockerClient]:
+    """
+    Returns the shared Engine API client, or None if the CLI should be used instead (the API is
+    disabled with DEV_ENV_DOCKER_BACKEND=cli, or the socket is missing or not answering).
+    """
+    global _client, _client_checked
+    with _client_lock:
+        if not _client_checked:
+            _client_checked = True
+            path = socket_path()
+            if os.environ.get('DEV_ENV_DOCKER_BACKEND', 'api').lower() != 'cli' and path and os.path.exists(path):
+                client = DockerClient(path)
+                if client.ping():
+                    _client = client
+                else:
+                    client.close()
+        return _client
+
+
+def split_command(cmd: str) -> List[str]:
+    """
+    Splits a configuration.yml healthcheck command the way `docker exec <container> <cmd>` in a shell would.
+    """
+    return shlex.split(cmd)
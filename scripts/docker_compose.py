@@ -1,119 +1,330 @@
 import os
 import sys
-import time
 import yaml
 import glob
-from typing import Dict, List, Optional, Any
-from scripts.utilities import colorize_yellow, colorize_red, colorize_lightblue
+import hashlib
+import tempfile
+from typing import Dict, List, Optional, Any, Tuple
+from scripts.app_index import app_index
+from scripts.environment import YamlLoader, config_path, file_key, load_environment
+from scripts.state_store import StateStore, commodities_store, get_store
+from scripts.utilities import colorize_yellow, colorize_red, colorize_lightblue, run_command_noshell
+
+COMPOSE_CACHE_DIR = '.compose-cache'
+# Merged compose files kept for switching back and forth between configurations
+COMPOSE_CACHE_KEEP = 5
+
+def compose_manifest_store(root_loc: str) -> StateStore:
+    return get_store(root_loc, '.compose-manifest',
+                     lambda: {'version': '1', 'inputs': None, 'apps': {}, 'commodities': None, 'file_list': None,
+                              'referenced': {}})
+
+def fingerprint(path: str) -> Optional[List[int]]:
+    key = file_key(path)
+    return list(key) if key is not None else None
+
+def compose_inputs(root_loc: str) -> Dict[str, Any]:
+    """
+    Fingerprints (mtime and size) every file prepare-compose reads: the dev-env-config, the root fragment,
+    each app's configuration.yml and compose fragments, and the commodity fragments.
+    Nothing is parsed, so this is cheap enough to run on every invocation.
+    """
+    apps = {
+        appname: {
+            'config': fingerprint(files.config) if files.config else None,
+            'fragments': {os.path.basename(path): fingerprint(path) for path in files.compose_fragments},
+        }
+        for appname, files in app_index(root_loc).apps.items()
+    }
+    commodity_fragments = glob.glob(os.path.join(root_loc, 'scripts', 'docker', '*', 'compose-fragment.yml'))
+    return {
+        'config': fingerprint(config_path(root_loc)),
+        'root_fragment': fingerprint(os.path.join(root_loc, 'apps', 'root-compose-fragment.yml')),
+        'apps': apps,
+        'commodities': {os.path.basename(os.path.dirname(path)): fingerprint(path) for path in sorted(commodity_fragments)},
+    }
+
+def compose_up_to_date(root_loc: str, file_list_loc: str) -> bool:
+    """
+    Returns True if none of prepare-compose's inputs (including the files the fragments reference) have
+    changed since the file list was last written (and the files it names still exist), in which case the
+    phase has nothing to do.
+    """
+    manifest = compose_manifest_store(root_loc)
+    if not manifest.exists():
+        return False
+    recorded = manifest.data
+    try:
+        with open(file_list_loc) as f:
+            file_list = f.read()
+    except FileNotFoundError:
+        return False
+    if file_list != recorded.get('file_list') or recorded.get('inputs') != compose_inputs(root_loc):
+        return False
+    # Files named by env_file/extends are only known from the last run, so they are checked separately
+    referenced = recorded.get('referenced') or {}
+    if any(fingerprint(path) != key for path, key in referenced.items()):
+        return False
+    store = commodities_store(root_loc)
+    if not store.exists() or store.data.get('commodities') != recorded.get('commodities'):
+        return False
+    sep = ';' if sys.platform.startswith('win') else ':'
+    return all(os.path.exists(path) for path in file_list.split(sep) if path)
 
 def prepare_compose(root_loc: str, file_list_loc: str) -> None:
     """
     Prepares the list of Docker Compose fragments for the environment and writes them to a file.
     Handles app fragments and commodity fragments and writes the list using the correct separator for the OS.
+    Fragment selection is reused for apps whose inputs are unchanged since the previous run, and
+    diagnostics are printed together at the end.
     """
+    inputs = compose_inputs(root_loc)
+    manifest = compose_manifest_store(root_loc)
     commodity_list: List[str] = []
-    compose_variants = find_active_variants(root_loc)
+    diagnostics: List[Tuple[str, str]] = []
 
     # Ensure the first fragment is always the root fragment for consistent path resolution
     commodity_list.append(os.path.join(root_loc, 'apps', 'root-compose-fragment.yml'))
 
-    # Add app compose fragments
-    get_apps(root_loc, commodity_list, compose_variants)
+    with manifest.batch() as recorded:
+        # Add app compose fragments
+        selections = select_fragments(root_loc, inputs, recorded)
+        for appname, selection in selections.items():
+            if selection['fragment'] is not None:
+                commodity_list.append(selection['fragment'])
+            diagnostics.extend((level, message) for level, message in selection['diagnostics'])
 
-    # Add commodity fragments if present
-    commodities_path = os.path.join(root_loc, '.commodities.yml')
-    if os.path.exists(commodities_path):
-        with open(commodities_path) as f:
-            commodities = yaml.safe_load(f)
-        if commodities and 'commodities' in commodities:
-            for commodity_info in commodities['commodities']:
+        # Add commodity fragments if present
+        commodities: Optional[List[str]] = None
+        store = commodities_store(root_loc)
+        if store.exists():
+            commodities = store.data.get('commodities')
+            for commodity_info in commodities or []:
                 commodity_list.append(
                     os.path.join(root_loc, 'scripts', 'docker', commodity_info, 'compose-fragment.yml')
                 )
 
-    # Write the compose file list to disk, using the correct separator for the platform
-    sep = ';' if sys.platform.startswith('win') else ':'
-    with open(file_list_loc, 'w') as f:
-        f.write(sep.join(commodity_list))
+        # Compose only has to parse one file if the fragments can be merged up front
+        referenced = referenced_files(commodity_list)
+        merged = merged_compose_file(root_loc, commodity_list, referenced)
+        if merged is not None:
+            commodity_list = [merged]
 
-def get_apps(root_loc: str, commodity_list: List[str], compose_variants: Dict[str, str]) -> None:
+        # Write the compose file list to disk, using the correct separator for the platform
+        sep = ';' if sys.platform.startswith('win') else ':'
+        with open(file_list_loc, 'w') as f:
+            f.write(sep.join(commodity_list))
+
+        recorded['inputs'] = inputs
+        recorded['apps'] = selections
+        recorded['commodities'] = list(commodities) if commodities is not None else None
+        recorded['file_list'] = sep.join(commodity_list)
+        recorded['referenced'] = {path: fingerprint(path) for path in referenced}
+
+    print_diagnostics(diagnostics)
+
+def select_fragments(root_loc: str, inputs: Dict[str, Any], recorded: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
     """
-    Adds app-specific compose fragments to the commodity_list based on the configuration and active variants.
+    Returns {app: {'variant', 'inputs', 'fragment', 'diagnostics'}} for every configured app, re-using the
+    recorded selection for apps whose configuration, fragments and chosen variant have not changed.
     """
-    config_path = os.path.join(root_loc, 'dev-env-config', 'configuration.yml')
-    if not os.path.exists(config_path):
+    environment = load_environment(root_loc)
+    if environment is None:
         print(colorize_yellow('No dev-env-config found. Maybe this is a fresh box... '
                               'if so, you need to do "source run.sh up"'))
-        return
+        return {}
+
+    previous = recorded.get('apps') or {}
+    selections: Dict[str, Dict[str, Any]] = {}
+    recomputed = 0
+    for appname, app in environment.apps.items():
+        app_inputs = inputs['apps'].get(appname)
+        cached = previous.get(appname)
+        if cached is not None and cached.get('inputs') == app_inputs and cached.get('variant') == app.variant:
+            selections[appname] = cached
+            continue
+        fragment, diagnostics = select_app_fragment(root_loc, appname, app.variant)
+        selections[appname] = {'variant': app.variant, 'inputs': app_inputs,
+                               'fragment': fragment, 'diagnostics': diagnostics}
+        recomputed += 1
+    if previous and recomputed:
+        print(colorize_lightblue(f"Compose inputs changed for {recomputed} of {len(selections)} app(s)"))
+    return selections
 
-    with open(config_path) as f:
-        config = yaml.safe_load(f)
-    if not config or 'applications' not in config:
+def select_app_fragment(root_loc: str, appname: str, variant: Optional[str]) -> Tuple[Optional[str], List[List[str]]]:
+    """
+    Chooses the compose fragment for one app: the fragment for its configured variant if there is one,
+    otherwise the default fragment. Returns (path or None, [[level, message], ...]).
+    """
+    diagnostics: List[List[str]] = []
+    files = app_index(root_loc).app(appname)
+    for path in files.unsupported:
+        diagnostics.append(['warning', f"Unsupported fragment in {appname}: {os.path.basename(path)}"])
+    if variant is not None and variant in files.variants:
+        diagnostics.append(['info', f'{appname}: Selected compose variant "{variant}"'])
+        return files.variants[variant], diagnostics
+    if files.fragment('compose') is None:
+        diagnostics.append(['error', f"Cannot find a valid compose fragment file in {appname}; no container will be created"])
+    return files.fragment('compose'), diagnostics
+
+def print_diagnostics(diagnostics: List[Tuple[str, str]]) -> None:
+    colours = {'info': colorize_lightblue, 'warning': colorize_yellow, 'error': colorize_red}
+    for level, message in diagnostics:
+        print(colours.get(level, colorize_yellow)(message))
+
+def project_directory(fragments: List[str]) -> str:
+    """
+    Returns the directory compose resolves relative paths and .env against: that of the first fragment.
+    """
+    return os.path.dirname(os.path.abspath(fragments[0]))
+
+def referenced_files(fragments: List[str]) -> List[str]:
+    """
+    Returns the files the fragments pull in that `docker compose config` reads too: the project's .env,
+    every service's env_file and any file named by extends (followed recursively). env_file paths are
+    relative to the project directory, extends paths to the file that names them.
+    """
+    project_dir = project_directory(fragments)
+    referenced = [os.path.join(project_dir, '.env')]
+    pending = list(fragments)
+    seen = set()
+    while pending:
+        path = os.path.abspath(pending.pop(0))
+        if path in seen:
+            continue
+        seen.add(path)
+        try:
+            with open(path) as f:
+                document = yaml.load(f, Loader=YamlLoader) or {}
+        except (OSError, yaml.YAMLError):
+            continue
+        services = document.get('services') if isinstance(document, dict) else None
+        for service in (services or {}).values():
+            if not isinstance(service, dict):
+                continue
+            env_files = service.get('env_file') or []
+            for env_file in [env_files] if isinstance(env_files, (str, dict)) else env_files:
+                env_path = env_file.get('path') if isinstance(env_file, dict) else env_file
+                if isinstance(env_path, str):
+                    referenced.append(os.path.join(project_dir, env_path))
+            extends = service.get('extends')
+            if isinstance(extends, dict) and isinstance(extends.get('file'), str):
+                extended = os.path.join(os.path.dirname(path), extends['file'])
+                referenced.append(extended)
+                pending.append(extended)
+    return list(dict.fromkeys(os.path.normpath(path) for path in referenced))
+
+def compose_cache_key(fragments: List[str], referenced: List[str]) -> str:
+    """
+    Returns a key derived from the path and content of every fragment (in order), of every file they
+    reference and the compose command.
+    """
+    digest = hashlib.sha256(os.environ.get('DC_CMD', 'docker compose').encode())
+    for path in fragments + ['--referenced--'] + referenced:
+        digest.update(b'\0' + path.encode() + b'\0')
+        try:
+            with open(path, 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+        except FileNotFoundError:
+            digest.update(b'missing')
+    return digest.hexdigest()[:24]
+
+def merged_compose_file(root_loc: str, fragments: List[str], referenced: List[str]) -> Optional[str]:
+    """
+    Returns the path of a single normalised compose file equivalent to the fragments, produced with
+    `docker compose config` and cached under a key of the fragments' content hashes and those of the files
+    they reference (so it is only re-merged when one of them changes). The service list is cached alongside it.
+    Returns None if the fragments could not be merged, in which case the fragment list should be used.
+    """
+    cache_dir = os.path.join(root_loc, COMPOSE_CACHE_DIR)
+    key = compose_cache_key(fragments, referenced)
+    merged_path = os.path.join(cache_dir, f'{key}.yml')
+    project_dir = project_directory(fragments)
+    if os.path.exists(merged_path) and os.path.exists(services_path(merged_path)):
+        os.utime(merged_path)
+        link_env_file(project_dir, cache_dir)
+        return merged_path
+
+    cmd = os.environ.get('DC_CMD', 'docker compose').split()
+    # The same project directory the fragment list would get, rather than wherever this is run from
+    cmd += ['--project-directory', project_dir]
+    for fragment in fragments:
+        cmd += ['-f', fragment]
+    # Interpolation is left to each later compose call, so the merged file does not capture this shell's variables
+    cmd += ['config', '--no-interpolate']
+    output_lines: List[str] = []
+    if run_command_noshell(cmd, output_lines) != 0:
+        print(colorize_yellow('Could not merge the compose fragments; compose will read them individually'))
+        for line in output_lines[-10:]:
+            print(line)
+        return None
+    merged = '\n'.join(output_lines) + '\n'
+    try:
+        services = list((yaml.load(merged, Loader=YamlLoader) or {}).get('services') or {})
+    except yaml.YAMLError:
+        print(colorize_yellow('Could not read the merged compose file; compose will read the fragments individually'))
+        return None
+
+    os.makedirs(cache_dir, exist_ok=True)
+    write_atomically(services_path(merged_path), ''.join(f'{service}\n' for service in services))
+    write_atomically(merged_path, merged)
+    link_env_file(project_dir, cache_dir)
+    prune_compose_cache(cache_dir)
+    return merged_path
+
+def link_env_file(project_dir: str, cache_dir: str) -> None:
+    """
+    Later compose calls take the merged file's directory as the project directory and read .env from there,
+    so the cache gets a link to the project's .env (or a copy where links are not allowed).
+    """
+    source = os.path.join(project_dir, '.env')
+    target = os.path.join(cache_dir, '.env')
+    if os.path.lexists(target):
+        os.remove(target)
+    if not os.path.exists(source):
         return
+    try:
+        os.symlink(os.path.relpath(source, cache_dir), target)
+    except OSError:
+        with open(source) as f:
+            write_atomically(target, f.read())
 
-    for appname in config['applications']:
-        app_fragments_dir = os.path.join(root_loc, 'apps', appname, 'fragments')
-        if appname in compose_variants:
-            variant_fragment_filename = fragment_filename(compose_variants[appname])
-            variant_path = os.path.join(app_fragments_dir, variant_fragment_filename)
-            if os.path.exists(variant_path):
-                commodity_list.append(variant_path)
-        else:
-            default_fragment = os.path.join(app_fragments_dir, 'compose-fragment.yml')
-            if os.path.exists(default_fragment):
-                commodity_list.append(default_fragment)
-
-def find_active_variants(root_loc: str) -> Dict[str, str]:
-    """
-    Determines which compose variant fragment to use for each app, based on configuration and available files.
-    Returns a dictionary mapping app names to their selected variant fragment name.
-    """
-    config_path = os.path.join(root_loc, 'dev-env-config', 'configuration.yml')
-    with open(config_path) as f:
-        config = yaml.safe_load(f)
-    if not config or 'applications' not in config:
-        return {}
+def services_path(merged_path: str) -> str:
+    return merged_path[:-len('.yml')] + '.services'
 
-    compose_variants: Dict[str, str] = {}
-
-    for appname in config['applications']:
-        found_valid_fragment = False
-        fragments_glob = os.path.join(root_loc, 'apps', appname, 'fragments', '*compose-fragment*.yml')
-        compose_fragments = glob.glob(fragments_glob)
-
-        for fragment in compose_fragments:
-            basename = os.path.basename(fragment)
-            if basename == 'compose-fragment.yml':
-                found_valid_fragment = True
-            elif basename.startswith('compose-fragment.') and basename.endswith('.yml'):
-                variant_fragment_filename = validate_variant_fragment_filename(config, appname, basename)
-                if variant_fragment_filename is not None:
-                    compose_variants[appname] = variant_fragment_filename
-                    print(colorize_lightblue(f'{appname}: Selected compose variant "{compose_variants[appname]}"'))
-                    found_valid_fragment = True
-            else:
-                print(colorize_yellow(f"Unsupported fragment in {appname}: {basename}"))
-
-        if not found_valid_fragment:
-            print(colorize_red(f"Cannot find a valid compose fragment file in {appname}; no container will be created"))
-            print(colorize_yellow('Continuing in 10 seconds...'))
-            time.sleep(10)
-
-    return compose_variants
-
-def validate_variant_fragment_filename(config: Dict[str, Any], appname: str, basename: str) -> Optional[str]:
-    """
-    Validates if the given variant fragment filename matches the app's configured variant.
-    Returns the variant name if valid, otherwise None.
-    """
-    import re
-    match = re.match(r'compose-fragment\.(.*?)\.yml', basename)
-    if match:
-        variant_fragment_filename = match.group(1)
-        app_config = config['applications'].get(appname, {})
-        if app_config.get('variant') == variant_fragment_filename:
-            return variant_fragment_filename
-    return None
+def write_atomically(path: str, content: str) -> None:
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+    os.replace(temp_path, path)
+
+def prune_compose_cache(cache_dir: str) -> None:
+    merged_files = sorted(
+        (entry for entry in os.scandir(cache_dir) if entry.name.endswith('.yml')),
+        key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in merged_files[COMPOSE_CACHE_KEEP:]:
+        for path in (entry.path, services_path(entry.path)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def compose_services(file_list_loc: str) -> List[str]:
+    """
+    Returns the services defined by the prepared compose configuration, from the cache written alongside
+    the merged file where possible, otherwise from `docker compose config --services`.
+    """
+    with open(file_list_loc) as f:
+        compose_file = f.read().strip()
+    if compose_file.endswith('.yml') and os.path.basename(os.path.dirname(compose_file)) == COMPOSE_CACHE_DIR:
+        try:
+            with open(services_path(compose_file)) as f:
+                return [line for line in f.read().splitlines() if line]
+        except FileNotFoundError:
+            pass
+    output_lines: List[str] = []
+    run_command_noshell(os.environ.get('DC_CMD', 'docker compose').split() + ['config', '--services'], output_lines)
+    return output_lines
 
 def highest_version(version_a: str, version_b: str) -> Optional[str]:
     """
@@ -0,0 +1,233 @@
+import os
+import yaml
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+# Prefer the libyaml-backed loader; it is several times faster than the pure Python one
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# path -> ((mtime_ns, size), parsed document)
+_yaml_cache: Dict[str, Tuple[Tuple[int, int], Any]] = {}
+# root_loc -> (fingerprint, environment)
+_environment_cache: Dict[str, Tuple[Tuple[Any, ...], 'Environment']] = {}
+
+
+class ConfigError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class HealthDependency:
+    compose_service: str
+    healthcheck_cmd: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class ExpensiveService:
+    app_name: str
+    compose_service: str
+    healthcheck_cmd: Optional[str] = None
+    wait_until_healthy: Tuple[HealthDependency, ...] = ()
+    # Seconds to wait for the service (and its dependencies) to become healthy; None waits indefinitely.
+    # Kept as written in configuration.yml, startup_timeout_seconds checks it when the services are started
+    startup_timeout: Any = None
+
+
+@dataclass(frozen=True)
+class ProvisionInputs:
+    """
+    What an app's custom-provision-always.sh depends on besides the script itself (custom_provision.always_inputs).
+    """
+    # Globs relative to the app's directory
+    files: Tuple[str, ...] = ()
+    # Containers (or compose services) whose image IDs are inputs
+    images: Tuple[str, ...] = ()
+    env: Tuple[str, ...] = ()
+
+
+@dataclass(frozen=True)
+class ServiceOption:
+    compose_service_name: str
+    auto_start: bool = True
+
+
+@dataclass
+class App:
+    name: str
+    # The app's entry in dev-env-config/configuration.yml
+    settings: Dict[str, Any]
+    # The contents of apps/<app>/configuration.yml (None if the file does not exist)
+    app_config: Optional[Dict[str, Any]]
+    options: List[ServiceOption] = field(default_factory=list)
+    commodities: List[str] = field(default_factory=list)
+    expensive_startup: List[ExpensiveService] = field(default_factory=list)
+    # Apps whose custom provision scripts must finish before this app's start (custom_provision.after)
+    provision_after: List[str] = field(default_factory=list)
+    # None if the app has not declared them, in which case the always-run script runs every time
+    provision_inputs: Optional[ProvisionInputs] = None
+
+    @property
+    def repo(self) -> Optional[str]:
+        return self.settings.get('repo')
+
+    @property
+    def ref(self) -> Optional[str]:
+        return self.settings.get('ref', self.settings.get('branch'))
+
+    @property
+    def variant(self) -> Optional[str]:
+        return self.settings.get('variant')
+
+    @property
+    def has_app_config(self) -> bool:
+        return self.app_config is not None
+
+
+@dataclass
+class Environment:
+    root_loc: str
+    config: Dict[str, Any]
+    apps: Dict[str, App]
+
+    @property
+    def post_up_message(self) -> Optional[str]:
+        return self.config.get('post-up-message')
+
+    @property
+    def commodities(self) -> List[str]:
+        """
+        Returns every commodity required by at least one app (in first-seen order).
+        """
+        return list(dict.fromkeys(c for app in self.apps.values() for c in app.commodities))
+
+    @property
+    def expensive_services(self) -> List[ExpensiveService]:
+        return [service for app in self.apps.values() for service in app.expensive_startup]
+
+    def app_to_commodities(self) -> Dict[str, List[str]]:
+        return {name: list(app.commodities) for name, app in self.apps.items() if app.commodities}
+
+    def commodity_required(self, appname: str, commodity: str) -> bool:
+        app = self.apps.get(appname)
+        return app is not None and commodity in app.commodities
+
+
+def load_yaml(path: str) -> Any:
+    """
+    Parses a YAML file, re-using the previous result while the file's mtime and size are unchanged.
+    Returns None if the file does not exist. The result is shared, so callers must not modify it.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        _yaml_cache.pop(path, None)
+        return None
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _yaml_cache.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    with open(path) as f:
+        document = yaml.load(f, Loader=YamlLoader)
+    _yaml_cache[path] = (key, document)
+    return document
+
+
+def file_key(path: str) -> Optional[Tuple[int, int]]:
+    """
+    Returns the (mtime, size) pair used to decide whether a file has changed, or None if it is missing.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def config_path(root_loc: str) -> str:
+    return os.path.join(root_loc, 'dev-env-config', 'configuration.yml')
+
+
+def app_config_path(root_loc: str, appname: str) -> str:
+    return os.path.join(root_loc, 'apps', appname, 'configuration.yml')
+
+
+def load_environment(root_loc: str) -> Optional[Environment]:
+    """
+    Returns the environment model for root_loc, or None if there is no dev-env-config yet.
+    The model is built once and rebuilt only when one of the configuration files changes.
+    """
+    main_path = config_path(root_loc)
+    main_key = file_key(main_path)
+    if main_key is None:
+        _environment_cache.pop(root_loc, None)
+        return None
+    config = load_yaml(main_path) or {}
+    applications = config.get('applications') or {}
+    fingerprint = (main_key,) + tuple(
+        file_key(app_config_path(root_loc, appname)) for appname in applications
+    )
+    cached = _environment_cache.get(root_loc)
+    if cached is not None and cached[0] == fingerprint:
+        return cached[1]
+
+    apps: Dict[str, App] = {}
+    for appname, settings in applications.items():
+        apps[appname] = build_app(appname, settings or {}, load_yaml(app_config_path(root_loc, appname)))
+    environment = Environment(root_loc=root_loc, config=config, apps=apps)
+    _environment_cache[root_loc] = (fingerprint, environment)
+    return environment
+
+
+def build_app(appname: str, settings: Dict[str, Any], app_config: Optional[Dict[str, Any]]) -> App:
+    options = [
+        ServiceOption(option['compose-service-name'], option.get('auto-start', True))
+        for option in settings.get('options') or []
+    ]
+    app = App(name=appname, settings=settings, app_config=app_config, options=options)
+    if not app_config:
+        return app
+    app.commodities = list(app_config.get('commodities') or [])
+    custom_provision = app_config.get('custom_provision') or {}
+    app.provision_after = list(custom_provision.get('after') or [])
+    inputs = custom_provision.get('always_inputs')
+    if inputs is not None:
+        app.provision_inputs = ProvisionInputs(
+            files=tuple(inputs.get('files') or ()),
+            images=tuple(inputs.get('images') or ()),
+            env=tuple(inputs.get('env') or ()),
+        )
+    for service in app_config.get('expensive_startup') or []:
+        dependencies = tuple(
+            HealthDependency(dep['compose_service'], dep.get('healthcheck_cmd'))
+            for dep in service.get('wait_until_healthy') or []
+        )
+        app.expensive_startup.append(ExpensiveService(
+            app_name=appname,
+            compose_service=service['compose_service'],
+            healthcheck_cmd=service.get('healthcheck_cmd'),
+            wait_until_healthy=dependencies,
+            startup_timeout=service.get('startup_timeout'),
+        ))
+    return app
+
+
+def startup_timeout_seconds(service: ExpensiveService) -> Optional[float]:
+    """
+    Returns an expensive service's startup_timeout in seconds (None if it has none).
+    Raises ConfigError if it is not a positive number.
+    """
+    value = service.startup_timeout
+    if value is None:
+        return None
+    error = ConfigError(f"apps/{service.app_name}/configuration.yml: startup_timeout of {service.compose_service} "
+                        f"must be a positive number of seconds, not {value!r}")
+    # bool is an int subclass, but "true" is not a timeout
+    if isinstance(value, bool):
+        raise error
+    try:
+        timeout = float(value)
+    except (TypeError, ValueError):
+        raise error from None
+    if not timeout > 0 or timeout == float('inf'):
+        raise error
+    return timeout
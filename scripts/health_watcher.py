@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import atexit
+import threading
+import subprocess
+from typing import Dict, List, Optional
+import requests
+from scripts.docker_api import DockerAPIError, DockerClient, docker_client
+
+# docker events actions that can change whether a service is (or will become) healthy
+WATCHED_ACTIONS = ('health_status', 'die', 'restart', 'start', 'oom')
+
+_watcher: Optional['HealthWatcher'] = None
+_watcher_lock = threading.Lock()
+
+
+class HealthWatcher:
+    """
+    Follows a single `docker events` stream (CLI or Engine API) for the project's containers and wakes up anyone waiting
+    for a container's state to change. If the stream cannot be started (or stops), waiting simply
+    times out, so callers fall back to polling.
+    """
+
+    def __init__(self, docker: str = 'docker', project: Optional[str] = None,
+                 client: Optional[DockerClient] = None):
+        self.docker = docker
+        self.project = project
+        # When set, events are read from the Engine API instead of a `docker events` process
+        self.client = client
+        # container name (and compose service name) -> last health/lifecycle state seen
+        self.states: Dict[str, str] = {}
+        self.generation = 0
+        self._condition = threading.Condition()
+        self._process: Optional[subprocess.Popen] = None
+        self._thread: Optional[threading.Thread] = None
+        self._streaming = False
+
+    @property
+    def running(self) -> bool:
+        return self._streaming
+
+    def command(self) -> List[str]:
+        cmd = [self.docker, 'events', '--format', '{{json .}}', '--filter', 'type=container']
+        if self.project:
+            cmd += ['--filter', f'label=com.docker.compose.project={self.project}']
+        return cmd
+
+    def filters(self) -> Dict[str, List[str]]:
+        filters = {'type': ['container']}
+        if self.project:
+            filters['label'] = [f'com.docker.compose.project={self.project}']
+        return filters
+
+    def start(self) -> bool:
+        if self.client is not None:
+            target = self._read_api_events
+        else:
+            try:
+                self._process = subprocess.Popen(self.command(), stdout=subprocess.PIPE,
+                                                 stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL)
+            except OSError:
+                self._process = None
+                return False
+            target = self._read_events
+        self._streaming = True
+        self._thread = threading.Thread(target=target, daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self) -> None:
+        self._streaming = False
+        if self._process is not None and self._process.poll() is None:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+        self._notify()
+
+    def _read_events(self) -> None:
+        for raw_line in self._process.stdout:
+            try:
+                event = json.loads(raw_line)
+            except ValueError:
+                continue
+            self.handle_event(event)
+        # The stream has ended; wake everyone so they go back to polling
+        self._streaming = False
+        self._notify()
+
+    def _read_api_events(self) -> None:
+        try:
+            for event in self.client.events(self.filters()):
+                if not self._streaming:
+                    break
+                self.handle_event(event)
+        except (DockerAPIError, requests.RequestException, OSError):
+            pass
+        self._streaming = False
+        self._notify()
+
+    def handle_event(self, event: Dict) -> None:
+        action = event.get('Action') or event.get('status') or ''
+        if not action.startswith(WATCHED_ACTIONS):
+            return
+        state = action.split(':', 1)[1].strip() if action.startswith('health_status') else action
+        attributes = (event.get('Actor') or {}).get('Attributes') or {}
+        names = {attributes.get('name'), attributes.get('com.docker.compose.service')} - {None}
+        with self._condition:
+            for name in names:
+                self.states[name] = state
+            self.generation += 1
+            self._condition.notify_all()
+
+    def _notify(self) -> None:
+        with self._condition:
+            self.generation += 1
+            self._condition.notify_all()
+
+    def state(self, name: str) -> Optional[str]:
+        with self._condition:
+            return self.states.get(name)
+
+    def wait(self, since: int, timeout: float) -> bool:
+        """
+        Waits until an event newer than generation `since` arrives or the timeout passes.
+        Returns True if woken by an event. Take `since` from .generation before checking state,
+        so an event that arrives during the check is not missed.
+        """
+        if not self.running:
+            time.sleep(timeout)
+            return False
+        with self._condition:
+            return self._condition.wait_for(lambda: self.generation != since, timeout)
+
+
+def health_watcher() -> HealthWatcher:
+    """
+    Returns the process-wide watcher for this compose project, starting it on first use.
+    """
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None:
+            _watcher = HealthWatcher(project=os.environ.get('COMPOSE_PROJECT_NAME') or None,
+                                     client=docker_client())
+            _watcher.start()
+            atexit.register(_watcher.stop)
+        return _watcher
@@ -0,0 +1,484 @@
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Pattern, Tuple, Union
+from scripts.async_commands import run_sync, stream_async
+from scripts.docker_api import DockerAPIError, docker_client
+from scripts.environment import load_environment
+from scripts.log_store import record_failure
+from scripts.process_runner import run_process
+from scripts.state_store import StateStore, get_store
+from scripts.utilities import colorize_green, colorize_lightblue, colorize_red, colorize_yellow, print_log_tail
+
+# Base images are checked for updates (build --pull) at most this often unless configured otherwise
+DEFAULT_PULL_TTL = 24 * 60 * 60
+HASH_THREADS = 8
+DEFAULT_BUILD_CONCURRENCY = 4
+# $NAME or ${NAME} in a FROM line
+ARG_PATTERN = re.compile(r'\$(?:\{(\w+)\}|(\w+))')
+# Build contexts Docker fetches itself (git repositories and tarballs); there are no local files to hash
+REMOTE_CONTEXT_PATTERN = re.compile(r'^(?:[a-z][a-z0-9+.-]*://|git@|github\.com/)', re.IGNORECASE)
+
+
+@dataclass(frozen=True)
+class BuildService:
+    name: str
+    image: str
+    context: str
+    dockerfile: str
+    # Everything else in the service's build section (args, target, dockerfile_inline...), as sorted JSON
+    settings: str
+
+
+def builds_store(root_loc: str) -> StateStore:
+    return get_store(root_loc, '.image-builds', lambda: {'version': '1', 'services': {}})
+
+
+def pull_ttl(root_loc: str) -> float:
+    """
+    Returns how many seconds may pass between base image update checks, from DEV_ENV_PULL_TTL or the
+    pull-ttl key of the dev-env-config. 0 checks on every build.
+    """
+    environment = load_environment(root_loc)
+    configured = os.environ.get('DEV_ENV_PULL_TTL', environment.config.get('pull-ttl') if environment else None)
+    try:
+        return max(0.0, float(configured))
+    except (TypeError, ValueError):
+        return DEFAULT_PULL_TTL
+
+
+def compose_command(files: Optional[List[str]] = None) -> List[str]:
+    """
+    Returns the compose command, reading the given files instead of COMPOSE_FILE if any are given.
+    """
+    cmd = os.environ.get('DC_CMD', 'docker compose').split()
+    for path in files or []:
+        cmd += ['-f', path]
+    return cmd
+
+
+def compose_config(files: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+    """
+    Returns the fully resolved compose configuration (paths absolute, variables interpolated), or None.
+    """
+    cmd = compose_command(files) + ['config', '--format', 'json']
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    if result.returncode != 0:
+        return None
+    try:
+        return json.loads(result.stdout)
+    except ValueError:
+        return None
+
+
+def build_services(config: Dict[str, Any]) -> List[BuildService]:
+    project = config.get('name') or os.environ.get('COMPOSE_PROJECT_NAME') or ''
+    services: List[BuildService] = []
+    for name, service in (config.get('services') or {}).items():
+        build = service.get('build')
+        if not build:
+            continue
+        if isinstance(build, str):
+            build = {'context': build}
+        context = build.get('context') or '.'
+        dockerfile = build.get('dockerfile') or 'Dockerfile'
+        services.append(BuildService(
+            name=name,
+            image=service.get('image') or f'{project}-{name}',
+            context=context,
+            dockerfile=dockerfile if os.path.isabs(dockerfile) else os.path.join(context, dockerfile),
+            settings=json.dumps({key: value for key, value in build.items() if key != 'context'}, sort_keys=True),
+        ))
+    return services
+
+
+def compile_pattern(pattern: str) -> Pattern:
+    """
+    Translates a .dockerignore pattern (Go filepath.Match syntax plus **) into a regular expression.
+    """
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**', i):
+            i += 2
+            if pattern.startswith('/', i):
+                # "**/" matches zero or more directories
+                regex += '(?:.*/)?'
+                i += 1
+            else:
+                regex += '.*'
+            continue
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[' and pattern.find(']', i + 1) != -1:
+            end = pattern.find(']', i + 1)
+            regex += '[' + pattern[i + 1:end].replace('\\', '\\\\') + ']'
+            i = end + 1
+            continue
+        elif c == '\\' and i + 1 < len(pattern):
+            regex += re.escape(pattern[i + 1])
+            i += 2
+            continue
+        else:
+            regex += re.escape(c)
+        i += 1
+    return re.compile(regex)
+
+
+def dockerignore_patterns(service: BuildService) -> List[Tuple[bool, Pattern]]:
+    """
+    Returns [(negated, regex), ...] from the Dockerfile-specific ignore file if there is one,
+    otherwise from the context's .dockerignore.
+    """
+    for path in (service.dockerfile + '.dockerignore', os.path.join(service.context, '.dockerignore')):
+        try:
+            with open(path) as f:
+                lines = f.read().splitlines()
+            break
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+    else:
+        return []
+    patterns: List[Tuple[bool, Pattern]] = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        negated = line.startswith('!')
+        line = os.path.normpath(line[1:].strip() if negated else line).lstrip('/')
+        if line and line != '.':
+            patterns.append((negated, compile_pattern(line)))
+    return patterns
+
+
+def is_ignored(relpath: str, patterns: List[Tuple[bool, Pattern]]) -> bool:
+    """
+    Applies the patterns in order (the last match wins). A pattern matching a parent directory
+    matches everything under it, as in Docker.
+    """
+    parts = relpath.split('/')
+    candidates = ['/'.join(parts[:n]) for n in range(1, len(parts) + 1)]
+    ignored = False
+    for negated, regex in patterns:
+        if any(regex.fullmatch(candidate) for candidate in candidates):
+            ignored = not negated
+    return ignored
+
+
+def is_remote_context(context: str) -> bool:
+    return REMOTE_CONTEXT_PATTERN.match(context) is not None
+
+
+def file_digest(path: str) -> bytes:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def context_hash(service: BuildService) -> str:
+    """
+    Hashes everything the build of this service depends on: the build settings, the Dockerfile and
+    every file of the context that .dockerignore does not exclude (name, executable bit and content).
+    A remote context has no local files, so plan_builds rebuilds it every time instead of trusting this hash.
+    """
+    digest = hashlib.sha256(service.settings.encode())
+    try:
+        digest.update(file_digest(service.dockerfile))
+    except (FileNotFoundError, IsADirectoryError):
+        digest.update(b'no dockerfile')
+    patterns = dockerignore_patterns(service)
+    # Ignored directories can only be skipped outright when no later pattern can re-include part of them
+    prune = not any(negated for negated, _ in patterns)
+    for dirpath, dirnames, filenames in os.walk(service.context):
+        reldir = os.path.relpath(dirpath, service.context)
+        reldir = '' if reldir == '.' else reldir + '/'
+        dirnames.sort()
+        for name in list(dirnames):
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                dirnames.remove(name)
+                filenames.append(name)
+            elif prune and is_ignored(reldir + name, patterns):
+                dirnames.remove(name)
+        for name in sorted(filenames):
+            relpath = reldir + name
+            if is_ignored(relpath, patterns):
+                continue
+            path = os.path.join(dirpath, name)
+            stat = os.lstat(path)
+            digest.update(relpath.encode() + (b'\0x\0' if stat.st_mode & 0o111 else b'\0-\0'))
+            if os.path.islink(path):
+                digest.update(os.readlink(path).encode())
+            else:
+                digest.update(file_digest(path))
+    return digest.hexdigest()
+
+
+def image_id(image: str) -> Optional[str]:
+    client = docker_client()
+    if client is not None:
+        try:
+            return client.image_id(image)
+        except DockerAPIError:
+            pass
+    result = subprocess.run(['docker', 'image', 'inspect', '--format', '{{.Id}}', image],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    if result.returncode != 0:
+        return None
+    return result.stdout.strip() or None
+
+
+def base_images(service: BuildService) -> List[str]:
+    """
+    Returns the external images the Dockerfile builds FROM (stages that only build FROM an earlier
+    stage are left out), with ARG defaults and build args substituted.
+    """
+    settings = json.loads(service.settings)
+    dockerfile = settings.get('dockerfile_inline')
+    if dockerfile is None:
+        try:
+            with open(service.dockerfile) as f:
+                dockerfile = f.read()
+        except (OSError, UnicodeDecodeError):
+            return []
+    build_args = settings.get('args') or {}
+    if isinstance(build_args, list):
+        build_args = dict(arg.split('=', 1) if '=' in arg else (arg, '') for arg in build_args)
+    values: Dict[str, str] = {}
+    stages: set = set()
+    bases: List[str] = []
+    for line in dockerfile.splitlines():
+        words = line.split()
+        if len(words) < 2:
+            continue
+        instruction = words[0].upper()
+        if instruction == 'ARG' and not bases and not stages:
+            name, _, default = words[1].partition('=')
+            values[name] = str(build_args.get(name, default))
+        elif instruction == 'FROM':
+            image = next((word for word in words[1:] if not word.startswith('--')), '')
+            image = ARG_PATTERN.sub(lambda match: values.get(match.group(1) or match.group(2), ''), image)
+            if image.lower() not in stages and image != 'scratch':
+                bases.append(image)
+            if len(words) >= 4 and words[-2].upper() == 'AS':
+                stages.add(words[-1].lower())
+    return bases
+
+
+@dataclass
+class BuildJob:
+    service: BuildService
+    digest: str
+    pull: bool
+    # The image the service has now (None if it has never been built)
+    image_id: Optional[str]
+    # How long the previous build took, used to start slow builds early
+    previous_seconds: float = 0.0
+    # A service this one waits for, because it builds from the same base image
+    after: Optional[str] = None
+
+
+def build_concurrency(root_loc: str) -> int:
+    """
+    Returns the number of images to build at once, from DEV_ENV_BUILD_CONCURRENCY or the
+    build-concurrency key of the dev-env-config, defaulting to the CPU count (at most 4).
+    """
+    environment = load_environment(root_loc)
+    configured = os.environ.get('DEV_ENV_BUILD_CONCURRENCY',
+                                environment.config.get('build-concurrency') if environment else None)
+    try:
+        return max(1, int(configured))
+    except (TypeError, ValueError):
+        return max(1, min(DEFAULT_BUILD_CONCURRENCY, os.cpu_count() or 1))
+
+
+def plan_builds(root_loc: str, services: List[BuildService], pull: bool) -> List[BuildJob]:
+    """
+    Returns a job for each service that needs building: those whose image is missing or was replaced,
+    whose inputs changed since it was built (always assumed for a remote context), or whose base image
+    check is due.
+    """
+    recorded = builds_store(root_loc).data['services']
+    ttl = pull_ttl(root_loc)
+    now = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, min(HASH_THREADS, len(services)))) as pool:
+        hashes = list(pool.map(context_hash, services))
+        image_ids = list(pool.map(lambda service: image_id(service.image), services))
+
+    plan: List[BuildJob] = []
+    for service, digest, current_id in zip(services, hashes, image_ids):
+        record = recorded.get(service.name) or {}
+        pull_due = pull and now - (record.get('pulled_at') or 0) >= ttl
+        if current_id is None:
+            reason = 'no image'
+        elif is_remote_context(service.context):
+            reason = 'remote build context, which cannot be checked for changes'
+        elif record.get('hash') != digest:
+            reason = 'build inputs changed' if record else 'no previous build recorded'
+        elif record.get('image_id') != current_id:
+            reason = 'image was replaced outside the dev-env'
+        elif pull_due:
+            reason = 'base image check due'
+        else:
+            continue
+        print(colorize_lightblue(f"{service.name}: building ({reason})"))
+        plan.append(BuildJob(service, digest, pull_due, current_id, record.get('seconds') or 0.0))
+    skipped = len(services) - len(plan)
+    if skipped:
+        print(colorize_lightblue(f"{skipped} image(s) are up to date and will not be rebuilt"))
+    return plan
+
+
+def schedule_builds(plan: List[BuildJob]) -> List[BuildJob]:
+    """
+    Orders the jobs so that one service for each base image shared by several services builds first
+    (most widely shared first), with the others waiting for it so the base is only fetched once.
+    Services with a base of their own follow, slowest previous build first.
+    """
+    bases = {job.service.name: base_images(job.service) for job in plan}
+    sharers: Dict[str, List[BuildJob]] = {}
+    for job in plan:
+        for base in dict.fromkeys(bases[job.service.name]):
+            sharers.setdefault(base, []).append(job)
+    leaders: List[BuildJob] = []
+    for base, jobs in sorted(sharers.items(), key=lambda item: -len(item[1])):
+        if len(jobs) < 2:
+            continue
+        leader = next((job for job in jobs if job in leaders), jobs[0])
+        if leader not in leaders:
+            leaders.append(leader)
+        for job in jobs:
+            if job is not leader and job not in leaders and job.after is None:
+                job.after = leader.service.name
+    others = sorted((job for job in plan if job not in leaders), key=lambda job: -job.previous_seconds)
+    return leaders + others
+
+
+async def build_service(job: BuildJob, log_path: str, files: Optional[List[str]] = None) -> Tuple[int, float]:
+    """
+    Builds one service, writing its output to its own log file. Returns (exit code, seconds).
+    """
+    cmd = compose_command(files) + ['build'] + (['--pull'] if job.pull else []) + [job.service.name]
+    started = time.monotonic()
+    with open(log_path, 'w') as log:
+        code = await stream_async(cmd, lambda line: log.write(line + '\n'))
+    return code, time.monotonic() - started
+
+
+async def run_builds(plan: List[BuildJob], limit: Union[int, asyncio.Semaphore], log_dir: str,
+                     files: Optional[List[str]] = None) -> Dict[str, Tuple[int, float]]:
+    """
+    Builds every job with at most `limit` running at once (a semaphore can be passed to share the limit
+    with other callers). A failed build does not stop the others. Returns {service: (exit code, seconds)}.
+    """
+    semaphore = limit if isinstance(limit, asyncio.Semaphore) else asyncio.Semaphore(limit)
+    finished = {job.service.name: asyncio.Event() for job in plan}
+    results: Dict[str, Tuple[int, float]] = {}
+
+    async def run(job: BuildJob) -> None:
+        try:
+            if job.after is not None:
+                await finished[job.after].wait()
+            async with semaphore:
+                results[job.service.name] = await build_service(job, os.path.join(log_dir, f'{job.service.name}.log'), files)
+            code, seconds = results[job.service.name]
+            if code == 0:
+                print(colorize_green(f"{job.service.name}: built in {seconds:.1f}s"))
+            else:
+                print(colorize_red(f"{job.service.name}: build failed after {seconds:.1f}s"))
+        finally:
+            finished[job.service.name].set()
+
+    await asyncio.gather(*(run(job) for job in plan))
+    return results
+
+
+def record_builds(root_loc: str, plan: List[BuildJob], results: Dict[str, Tuple[int, float]], log_dir: str,
+                  log_path: str) -> List[str]:
+    """
+    Records the outcome of each build, appends it to the summary log and reports failures with the tail of
+    the service's own log. Returns the failed services that have no earlier image to fall back on.
+    """
+    unusable: List[str] = []
+    with builds_store(root_loc).batch() as document, open(log_path, 'a') as summary:
+        now = time.time()
+        for job in plan:
+            name = job.service.name
+            code, seconds = results.get(name, (1, 0.0))
+            previous = document['services'].get(name) or {}
+            summary.write(f"{name}: {'built' if code == 0 else 'FAILED'} in {seconds:.1f}s "
+                          f"(log: {os.path.join(log_dir, name + '.log')})\n")
+            if code == 0:
+                document['services'][name] = {
+                    'hash': job.digest,
+                    'image': job.service.image,
+                    'image_id': image_id(job.service.image),
+                    'built_at': now,
+                    'pulled_at': now if job.pull else previous.get('pulled_at'),
+                    'seconds': seconds,
+                }
+                continue
+            previous['failed_at'] = now
+            previous['seconds'] = seconds
+            document['services'][name] = previous
+            print(colorize_red(f"{name} failed to build. Here are the last 10 lines of {name}.log:"))
+            print_log_tail(os.path.join(log_dir, f'{name}.log'))
+            record_failure(root_loc, os.path.join(log_dir, f'{name}.log'), code)
+            if job.image_id is None:
+                unusable.append(name)
+            else:
+                print(colorize_yellow(f"{name} will run its previously built image"))
+    return unusable
+
+
+def build_images(root_loc: str, pull: bool, log_path: str) -> int:
+    """
+    Builds the images whose inputs have changed (see plan_builds), several at once, each logging to
+    build/<service>.log next to log_path, which gets a summary. A failed build is reported with the tail of
+    its own log while the others carry on.
+    Returns 0 if every service has an image to run (a failed rebuild leaves the previous image in place),
+    otherwise 1. Falls back to one build of everything if the compose configuration cannot be read.
+    """
+    open(log_path, 'w').close()
+    config = compose_config()
+    if config is None:
+        print(colorize_yellow('Could not read the compose configuration; building every image'))
+        result = run_process(compose_command() + ['build'] + (['--pull'] if pull else []), log_path=log_path, append=True)
+        if result.exit_code != 0:
+            print(colorize_red('Something went wrong when building the images. Here are the last 10 lines of the log:'))
+            result.print_tail()
+            record_failure(root_loc, log_path, result.exit_code)
+        return result.exit_code
+
+    plan = plan_builds(root_loc, build_services(config), pull)
+    if not plan:
+        with open(log_path, 'a') as f:
+            f.write('All images are up to date\n')
+        return 0
+
+    log_dir = os.path.join(os.path.dirname(log_path), 'build')
+    os.makedirs(log_dir, exist_ok=True)
+    limit = build_concurrency(root_loc)
+    print(colorize_lightblue(f"Building {len(plan)} image(s), {limit} at a time (logging to {os.path.relpath(log_dir, root_loc)})"))
+    started = time.monotonic()
+    results = run_sync(run_builds(schedule_builds(plan), limit, log_dir))
+    wall_time = time.monotonic() - started
+
+    unusable = record_builds(root_loc, plan, results, log_dir, log_path)
+    failed = sum(1 for code, _ in results.values() if code != 0)
+    print(colorize_lightblue(f"Built {len(plan) - failed} of {len(plan)} image(s) in {wall_time:.1f}s"))
+    if unusable:
+        print(colorize_red(f"No image is available for: {', '.join(unusable)}"))
+        return 1
+    return 0
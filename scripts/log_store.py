@@ -0,0 +1,474 @@
+import os
+import re
+import sys
+import json
+import time
+import gzip
+import atexit
+import shutil
+import argparse
+from typing import Any, Dict, Iterator, List, Optional, Pattern, Tuple
+from scripts.environment import load_environment
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+RUNS_DIR = os.path.join('logfiles', 'runs')
+# Holds the ID of the most recent run
+LATEST_FILE = 'latest'
+MANIFEST = 'run.json'
+# Finished logs are compressed in independent blocks of about this much text, so the end of a log (or
+# any line) can be read without decompressing everything before it
+BLOCK_SIZE = 1024 * 1024
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+# Disk use is bounded by deleting whole old runs rather than by rotating individual logs, so one step's
+# output is never split across files (the block index keeps reading a large log cheap)
+DEFAULT_RETENTION_MB = 512
+# A run that has not finished after this long was interrupted, and is compressed by the next run to finish
+ABANDONED_AFTER = 24 * 60 * 60
+TAIL_READ_SIZE = 64 * 1024
+
+# Set by run.sh, so the processes of one command (`up` runs logic twice) log to the same run
+RUN_ID_VARIABLE = 'DEV_ENV_RUN_ID'
+RUN_ID_PATTERN = re.compile(r'[A-Za-z0-9][A-Za-z0-9._-]*')
+
+# root_loc -> the run this process is logging to
+_runs: Dict[str, 'RunLogs'] = {}
+
+
+class RunLogs:
+    """
+    The logs of one dev-env run: logfiles/runs/<run id>/<phase>.log, or <phase>/<service>.log for phases
+    that log each service separately, plus a run.json manifest recording which logs belong to failures.
+    The logs are plain text while the run is going and are compressed when it finishes.
+    """
+
+    def __init__(self, root_loc: str, run_id: str):
+        self.root_loc = root_loc
+        self.run_id = run_id
+        self.directory = os.path.join(root_loc, RUNS_DIR, run_id)
+
+    def path(self, phase: str, service: Optional[str] = None) -> str:
+        path = os.path.join(self.directory, phase, f'{service}.log') if service else \
+            os.path.join(self.directory, f'{phase}.log')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def phase_dir(self, phase: str) -> str:
+        """
+        Returns the directory for a phase's per-service logs.
+        """
+        path = os.path.join(self.directory, phase)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def display(self, path: str) -> str:
+        return os.path.relpath(path, self.root_loc)
+
+    def record_failure(self, path: str, exit_code: int) -> None:
+        manifest = read_manifest(self.directory)
+        manifest.setdefault('failures', []).append(
+            {'log': os.path.relpath(path, self.directory), 'exit_code': exit_code})
+        write_manifest(self.directory, manifest)
+
+    def finish(self) -> None:
+        """
+        Compresses the run's logs, marks it finished and deletes the oldest runs beyond the retention limit.
+        """
+        try:
+            compress_run(self.directory)
+            manifest = read_manifest(self.directory)
+            manifest['finished'] = time.time()
+            write_manifest(self.directory, manifest)
+            for abandoned in abandoned_runs(self.root_loc):
+                compress_run(abandoned)
+            prune_runs(self.root_loc, retention_bytes(self.root_loc), keep=self.run_id)
+        except OSError as e:
+            print(f"Could not tidy up the logs of this run: {e}", file=sys.stderr)
+
+
+def current_run_id() -> str:
+    """
+    Returns the ID of the run this process belongs to: DEV_ENV_RUN_ID if run.sh set it, otherwise one of
+    this process's own (its start time and PID).
+    """
+    run_id = os.environ.get(RUN_ID_VARIABLE, '')
+    if RUN_ID_PATTERN.fullmatch(run_id):
+        return run_id
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+
+
+def run_logs(root_loc: str) -> RunLogs:
+    """
+    Returns the run this process logs to, starting it (and registering it to be compressed at exit) on first use.
+    A run already started by an earlier process of the same command is carried on: its failures are kept
+    and the commands are listed one after the other.
+    """
+    run = _runs.get(root_loc)
+    if run is not None:
+        return run
+    run_id = current_run_id()
+    run = RunLogs(root_loc, run_id)
+    os.makedirs(run.directory, exist_ok=True)
+    if os.path.exists(os.path.join(run.directory, MANIFEST)):
+        manifest = read_manifest(run.directory)
+        manifest.pop('finished', None)
+        manifest['command'] = manifest.get('command', []) + [';'] + sys.argv[1:]
+    else:
+        manifest = {'run_id': run_id, 'started': time.time(), 'command': sys.argv[1:], 'failures': []}
+    write_manifest(run.directory, manifest)
+    with open(os.path.join(root_loc, RUNS_DIR, LATEST_FILE), 'w') as f:
+        f.write(run_id)
+    atexit.register(run.finish)
+    _runs[root_loc] = run
+    return run
+
+
+def record_failure(root_loc: str, path: str, exit_code: int) -> None:
+    """
+    Records a failed step's log in this process's run, if the log belongs to it.
+    """
+    run = _runs.get(root_loc)
+    if run is not None and os.path.abspath(path).startswith(os.path.abspath(run.directory) + os.sep):
+        run.record_failure(path, exit_code)
+
+
+def retention_bytes(root_loc: str) -> int:
+    """
+    Returns how much space old runs may take, from DEV_ENV_LOG_RETENTION_MB or the log-retention-mb key
+    of the dev-env-config, defaulting to 512 MB.
+    """
+    environment = load_environment(root_loc)
+    configured = os.environ.get('DEV_ENV_LOG_RETENTION_MB',
+                                environment.config.get('log-retention-mb') if environment else None)
+    try:
+        return max(0, int(configured)) * 1024 * 1024
+    except (TypeError, ValueError):
+        return DEFAULT_RETENTION_MB * 1024 * 1024
+
+
+def read_manifest(run_dir: str) -> Dict[str, Any]:
+    try:
+        with open(os.path.join(run_dir, MANIFEST)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {'run_id': os.path.basename(run_dir), 'failures': []}
+
+
+def write_manifest(run_dir: str, manifest: Dict[str, Any]) -> None:
+    temp_path = os.path.join(run_dir, MANIFEST + '.tmp')
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temp_path, os.path.join(run_dir, MANIFEST))
+
+
+def list_runs(root_loc: str) -> List[str]:
+    """
+    Returns the run directories, oldest first (run IDs start with their start time).
+    """
+    runs_dir = os.path.join(root_loc, RUNS_DIR)
+    if not os.path.isdir(runs_dir):
+        return []
+    return sorted(entry.path for entry in os.scandir(runs_dir) if entry.is_dir())
+
+
+def latest_run(root_loc: str) -> Optional[str]:
+    try:
+        with open(os.path.join(root_loc, RUNS_DIR, LATEST_FILE)) as f:
+            run_dir = os.path.join(root_loc, RUNS_DIR, f.read().strip())
+    except FileNotFoundError:
+        runs = list_runs(root_loc)
+        return runs[-1] if runs else None
+    return run_dir if os.path.isdir(run_dir) else None
+
+
+def abandoned_runs(root_loc: str) -> List[str]:
+    now = time.time()
+    abandoned = []
+    for run_dir in list_runs(root_loc):
+        manifest = read_manifest(run_dir)
+        if 'finished' not in manifest and now - manifest.get('started', now) > ABANDONED_AFTER:
+            abandoned.append(run_dir)
+    return abandoned
+
+
+def directory_size(path: str) -> int:
+    total = 0
+    for directory, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.path.getsize(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def prune_runs(root_loc: str, limit: int, keep: str) -> None:
+    """
+    Deletes the oldest runs until all of them together fit in limit bytes. The run `keep` is never deleted.
+    """
+    runs = [(run_dir, directory_size(run_dir)) for run_dir in list_runs(root_loc)]
+    total = sum(size for _, size in runs)
+    for run_dir, size in runs:
+        if total <= limit:
+            break
+        if os.path.basename(run_dir) == keep:
+            continue
+        shutil.rmtree(run_dir, ignore_errors=True)
+        total -= size
+
+
+def compression() -> Tuple[str, Any]:
+    """
+    Returns the extension and compress function for finished logs: zstd if the zstandard package is
+    installed, otherwise gzip.
+    """
+    if zstandard is not None:
+        return '.zst', zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress
+    return '.gz', lambda data: gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def decompress(extension: str, data: bytes) -> bytes:
+    if extension == '.zst':
+        if zstandard is None:
+            raise RuntimeError('this log is compressed with zstd; install the zstandard package to read it')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def index_path(path: str) -> str:
+    return path + '.idx'
+
+
+def read_index(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(index_path(path)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def compress_log(path: str) -> None:
+    """
+    Compresses a finished log into blocks that each hold whole lines, and indexes them: each block's
+    offset and size in the compressed file, its first line number and its line count. If an earlier
+    process of the run already compressed a log of the same name, this one is appended to it.
+    """
+    extension, compress = compression()
+    target = path + extension
+    index = read_index(target) if os.path.exists(target) else None
+    if index is not None:
+        shutil.copyfile(target, target + '.tmp')
+        blocks: List[List[int]] = index['blocks']
+        lines = index['lines']
+        offset = os.path.getsize(target)
+    else:
+        blocks = []
+        lines = 0
+        offset = 0
+    with open(path, 'rb') as source, open(target + '.tmp', 'ab' if index is not None else 'wb') as destination:
+        while True:
+            data = source.read(BLOCK_SIZE)
+            if not data:
+                break
+            if not data.endswith(b'\n'):
+                data += source.readline()
+            compressed = compress(data)
+            destination.write(compressed)
+            count = data.count(b'\n') + (0 if data.endswith(b'\n') else 1)
+            blocks.append([offset, len(compressed), lines, count])
+            offset += len(compressed)
+            lines += count
+    with open(index_path(target) + '.tmp', 'w') as f:
+        json.dump({'lines': lines, 'blocks': blocks}, f)
+    os.replace(target + '.tmp', target)
+    os.replace(index_path(target) + '.tmp', index_path(target))
+    os.remove(path)
+
+
+def compress_run(run_dir: str) -> None:
+    for directory, _, names in os.walk(run_dir):
+        for name in names:
+            if name.endswith('.log'):
+                compress_log(os.path.join(directory, name))
+
+
+def resolve_log(path: str) -> Optional[str]:
+    """
+    Returns where a log is now: as written, or compressed once its run finished.
+    """
+    for candidate in (path, path + '.zst', path + '.gz'):
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def read_blocks(path: str, reverse: bool = False) -> Iterator[Tuple[int, str]]:
+    """
+    Yields (first line number, text) for each block of a compressed log, using its index.
+    """
+    extension = os.path.splitext(path)[1]
+    index = read_index(path)
+    if index is None:
+        # Without an index the whole log is one block (gzip and zstd both read concatenated blocks)
+        with open(path, 'rb') as f:
+            yield 0, decompress(extension, f.read()).decode('utf-8', errors='replace')
+        return
+    blocks = index['blocks']
+    with open(path, 'rb') as f:
+        for offset, size, first_line, _ in (reversed(blocks) if reverse else blocks):
+            f.seek(offset)
+            yield first_line, decompress(extension, f.read(size)).decode('utf-8', errors='replace')
+
+
+def tail_plain(path: str, count: int) -> List[str]:
+    """
+    Returns the last count lines of a plain log, reading backwards from its end.
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b''
+        while position > 0 and data.count(b'\n') <= count:
+            step = min(TAIL_READ_SIZE, position)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+    return data.decode('utf-8', errors='replace').splitlines()[-count:] if count else []
+
+
+def tail_log(path: str, count: int = 10) -> List[str]:
+    """
+    Returns the last count lines of a log, decompressing only the blocks they are in if it is compressed.
+    """
+    if not path.endswith(('.zst', '.gz')):
+        return tail_plain(path, count)
+    lines: List[str] = []
+    for _, text in read_blocks(path, reverse=True):
+        lines = text.splitlines() + lines
+        if len(lines) >= count:
+            break
+    return lines[-count:] if count else []
+
+
+def grep_log(path: str, pattern: Pattern) -> Iterator[Tuple[int, str]]:
+    """
+    Yields (line number, line) for each line of a log that matches pattern.
+    """
+    # A compressed block is skipped unless the pattern matches somewhere in it. That check sees many lines at
+    # once, so ^ and $ must match at each line; \A and \Z cannot be made to, so such patterns check every line.
+    block_pattern = None if re.search(r'\\[AZ]', pattern.pattern) else \
+        re.compile(pattern.pattern, pattern.flags | re.MULTILINE)
+    if not path.endswith(('.zst', '.gz')):
+        with open(path, errors='replace') as f:
+            for number, line in enumerate(f, 1):
+                # Matched without its newline, as the lines of a compressed log are
+                line = line.rstrip('\n')
+                if pattern.search(line):
+                    yield number, line
+        return
+    for first_line, text in read_blocks(path):
+        if block_pattern is not None and not block_pattern.search(text):
+            continue
+        for number, line in enumerate(text.splitlines(), first_line + 1):
+            if pattern.search(line):
+                yield number, line
+
+
+def run_log_files(run_dir: str) -> List[str]:
+    """
+    Returns the logs of a run relative to its directory, as they were named while it was going.
+    """
+    logs = []
+    for directory, _, names in os.walk(run_dir):
+        for name in names:
+            for suffix in ('.log', '.log.zst', '.log.gz'):
+                if name.endswith(suffix):
+                    logs.append(os.path.relpath(os.path.join(directory, name[:len(name) - len(suffix) + 4]), run_dir))
+    return sorted(logs)
+
+
+def find_run(root_loc: str, run_id: Optional[str]) -> Optional[str]:
+    if run_id is None:
+        return latest_run(root_loc)
+    matches = [run_dir for run_dir in list_runs(root_loc) if os.path.basename(run_dir).startswith(run_id)]
+    return matches[-1] if matches else None
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python3 -m scripts.log_store',
+                                     description='Reads the logs of past dev-env runs (logfiles/runs)')
+    parser.add_argument('--root', default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('runs', help='list the runs, oldest first')
+    failure = commands.add_parser('last-failure', help='show the end of each failed log of the last run')
+    failure.add_argument('-n', '--lines', type=int, default=20)
+    tail = commands.add_parser('tail', help='show the end of a log, e.g. imagebuild or build/<service>')
+    tail.add_argument('log')
+    tail.add_argument('-n', '--lines', type=int, default=20)
+    tail.add_argument('--run', help='run ID (or its prefix); the last run by default')
+    grep = commands.add_parser('grep', help='search the logs of a run')
+    grep.add_argument('pattern')
+    grep.add_argument('--run', help='run ID (or its prefix); the last run by default')
+    grep.add_argument('--service', help='only search the logs of this service or app')
+    grep.add_argument('--phase', help='only search the logs of this phase, e.g. build or custom-provision')
+    grep.add_argument('-i', '--ignore-case', action='store_true')
+    args = parser.parse_args(argv)
+
+    if args.command == 'runs':
+        for run_dir in list_runs(args.root):
+            manifest = read_manifest(run_dir)
+            started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(manifest.get('started', 0)))
+            status = f"{len(manifest.get('failures', []))} failure(s)" if 'finished' in manifest else 'unfinished'
+            print(f"{os.path.basename(run_dir):<24} {started}  {directory_size(run_dir) / 1024 / 1024:>8.1f} MB  "
+                  f"{status:<14} {' '.join(manifest.get('command', []))}")
+        return 0
+
+    run_dir = find_run(args.root, getattr(args, 'run', None))
+    if run_dir is None:
+        print('No matching run found', file=sys.stderr)
+        return 1
+
+    if args.command == 'last-failure':
+        failures = read_manifest(run_dir).get('failures', [])
+        if not failures:
+            print(f"Run {os.path.basename(run_dir)} recorded no failures")
+            return 0
+        for failure in failures:
+            path = resolve_log(os.path.join(run_dir, failure['log']))
+            print(f"==> {failure['log']} (exit code {failure['exit_code']}) <==")
+            for line in tail_log(path, args.lines) if path else ['(log not found)']:
+                print(line)
+        return 1
+
+    if args.command == 'tail':
+        name = args.log if args.log.endswith('.log') else args.log + '.log'
+        path = resolve_log(os.path.join(run_dir, name))
+        if path is None:
+            print(f"No log {name} in run {os.path.basename(run_dir)}; it has: {', '.join(run_log_files(run_dir))}",
+                  file=sys.stderr)
+            return 1
+        for line in tail_log(path, args.lines):
+            print(line)
+        return 0
+
+    pattern = re.compile(args.pattern, re.IGNORECASE if args.ignore_case else 0)
+    found = False
+    for log in run_log_files(run_dir):
+        phase, _, rest = log.partition(os.sep)
+        service = os.path.splitext(rest or phase)[0]
+        if args.service and service != args.service and not service.startswith(args.service + '.'):
+            continue
+        if args.phase and os.path.splitext(phase)[0] != args.phase:
+            continue
+        for number, line in grep_log(resolve_log(os.path.join(run_dir, log)), pattern):
+            found = True
+            print(f"{log}:{number}: {line}")
+    return 0 if found else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
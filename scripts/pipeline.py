@@ -0,0 +1,183 @@
+import os
+import sys
+import time
+import asyncio
+from typing import Dict, List, Optional, Tuple
+from scripts.app_index import app_index
+from scripts.async_commands import capture_async, run_sync
+from scripts.commodities import add_missing_pairings
+from scripts.docker_compose import select_app_fragment
+from scripts.environment import load_environment, load_yaml
+from scripts.log_store import run_logs
+from scripts.image_builds import build_concurrency, build_services, compose_config, plan_builds, record_builds, \
+    run_builds, schedule_builds
+from scripts.state_store import commodities_store
+from scripts.update_apps import update_apps
+from scripts.utilities import colorize_green, colorize_lightblue, colorize_yellow
+
+DEFAULT_PROVISION_CONCURRENCY = 2
+POSTGRES_VERSIONS = ('13', '17')
+
+
+def provision_concurrency(root_loc: str) -> int:
+    """
+    Returns the number of apps to provision at once while pipelining, from DEV_ENV_PROVISION_CONCURRENCY
+    or the provision-concurrency key of the dev-env-config, defaulting to 2.
+    """
+    environment = load_environment(root_loc)
+    configured = os.environ.get('DEV_ENV_PROVISION_CONCURRENCY',
+                                environment.config.get('provision-concurrency') if environment else None)
+    try:
+        return max(1, int(configured))
+    except (TypeError, ValueError):
+        return DEFAULT_PROVISION_CONCURRENCY
+
+
+def commodity_fragment(root_loc: str, commodity: str) -> str:
+    return os.path.join(root_loc, 'scripts', 'docker', commodity, 'compose-fragment.yml')
+
+
+def app_compose_files(root_loc: str, appname: str) -> Optional[List[str]]:
+    """
+    Returns the fragments needed to build one app on its own: the root fragment, the app's fragment and the
+    fragments of the commodities it uses. None if the app has no compose fragment.
+    """
+    environment = load_environment(root_loc)
+    app = environment.apps.get(appname) if environment else None
+    if app is None:
+        return None
+    fragment, _ = select_app_fragment(root_loc, appname, app.variant)
+    if fragment is None:
+        return None
+    commodities = [commodity_fragment(root_loc, commodity) for commodity in dict.fromkeys(app.commodities + ['logging'])]
+    return [os.path.join(root_loc, 'apps', 'root-compose-fragment.yml'), fragment] + \
+        [path for path in commodities if os.path.exists(path)]
+
+
+class Pipeline:
+    """
+    Runs each app through build and provisioning as soon as its update or clone has finished, with a
+    separate concurrency limit for each stage.
+    """
+
+    def __init__(self, root_loc: str, pull: bool, log_dir: str, compose_env: Dict[str, str]):
+        self.root_loc = root_loc
+        self.pull = pull
+        self.log_dir = log_dir
+        # The environment compose commands run in, as the process-wide COMPOSE_FILE is not the one to use yet
+        self.compose_env = compose_env
+        self.summary_log = os.path.join(os.path.dirname(log_dir), 'pipeline.log')
+        self.build_limit = asyncio.Semaphore(build_concurrency(root_loc))
+        self.provision_limit = asyncio.Semaphore(provision_concurrency(root_loc))
+        # One app at a time initialises each Postgres container, which is started at most once
+        self.postgres_locks = {version: asyncio.Lock() for version in POSTGRES_VERSIONS}
+        self.postgres_started = {version: False for version in POSTGRES_VERSIONS}
+        # Whether each Postgres container is created by this pipeline (None until that has been checked)
+        self.postgres_new: Dict[str, Optional[bool]] = {version: None for version in POSTGRES_VERSIONS}
+
+    async def run(self, force_fetch: bool) -> Dict[str, Tuple[str, float]]:
+        loop = asyncio.get_running_loop()
+        updated: asyncio.Queue = asyncio.Queue()
+        update_started = time.monotonic()
+
+        def on_app_updated(appname: str) -> None:
+            loop.call_soon_threadsafe(updated.put_nowait, (appname, time.monotonic() - update_started))
+
+        update = asyncio.ensure_future(asyncio.to_thread(update_apps, self.root_loc, force_fetch, on_app_updated))
+        update.add_done_callback(lambda _: updated.put_nowait(None))
+        chains: List[asyncio.Task] = []
+        while True:
+            item = await updated.get()
+            if item is None:
+                break
+            chains.append(asyncio.ensure_future(self.app_chain(*item)))
+        await update
+        return dict(await asyncio.gather(*chains))
+
+    async def app_chain(self, appname: str, updated_after: float) -> Tuple[str, Tuple[str, float]]:
+        started = time.monotonic()
+        status = await self.build_app(appname)
+        # Provisioning only needs the commodity containers, so it goes ahead even if the app's build did not
+        async with self.provision_limit:
+            await self.provision_app(appname)
+        return appname, (status, updated_after + time.monotonic() - started)
+
+    async def build_app(self, appname: str) -> str:
+        files = app_compose_files(self.root_loc, appname)
+        if files is None:
+            return 'nothing to build'
+        config = await asyncio.to_thread(compose_config, files)
+        if config is None:
+            print(colorize_yellow(f"{appname} cannot be built on its own; it will be built with the other images"))
+            return 'deferred'
+        app_services = set((load_yaml(files[1]) or {}).get('services') or {})
+        services = [service for service in build_services(config) if service.name in app_services]
+        plan = await asyncio.to_thread(plan_builds, self.root_loc, services, self.pull)
+        if not plan:
+            return 'built'
+        results = await run_builds(schedule_builds(plan), self.build_limit, self.log_dir, files)
+        unusable = record_builds(self.root_loc, plan, results, self.log_dir, self.summary_log)
+        return 'build failed' if unusable else 'built'
+
+    async def provision_app(self, appname: str) -> None:
+        # Imported here as provision_postgres depends on the commodities module, which this module imports
+        from scripts.provision_scripts.provision_postgres import start_postgres_maybe
+        environment = load_environment(self.root_loc)
+        app = environment.apps.get(appname) if environment else None
+        if app is None or app_index(self.root_loc).app(appname).fragment('postgres-init') is None:
+            return
+        versions = [version for version in POSTGRES_VERSIONS if f'postgres-{version}' in app.commodities]
+        if not versions:
+            return
+        with commodities_store(self.root_loc).batch() as commodity_file:
+            add_missing_pairings({appname: app.commodities}, commodity_file)
+        for version in versions:
+            async with self.postgres_locks[version]:
+                if self.postgres_new[version] is None:
+                    self.postgres_new[version] = await self.postgres_missing(version)
+                self.postgres_started[version] = await start_postgres_maybe(
+                    self.root_loc, appname, self.postgres_started[version], self.postgres_new[version], version,
+                    self.compose_env)
+
+    async def postgres_missing(self, version: str) -> bool:
+        """
+        Returns True if the Postgres container does not exist yet, so starting it creates it from scratch and
+        the provision status in .commodities is stale. If compose cannot say, the container is assumed to exist.
+        """
+        from scripts.provision_scripts.provision_postgres import postgres_container
+        container = postgres_container(version)
+        # --all, so a stopped container still counts as existing
+        exit_code, services = await capture_async(os.environ['DC_CMD'].split() + ['ps', '--all', '--services'],
+                                                  env=self.compose_env)
+        if exit_code != 0 or container in services:
+            return False
+        print(colorize_yellow(f"The Postgres {version} container is being newly created - "
+                              "provision status in .commodities will be ignored"))
+        return True
+
+
+def pipelined_update(root_loc: str, force_fetch: bool, pull: bool) -> None:
+    """
+    Updates all apps, building each app's images and provisioning its Postgres databases as soon as that
+    app is up to date rather than after every app has been updated. The later build and provision phases
+    then find that work already done (unchanged images are not rebuilt, provisioned apps are skipped).
+    """
+    # Commodity containers are started from the root and commodity fragments until the full compose
+    # configuration has been prepared
+    sep = ';' if sys.platform.startswith('win') else ':'
+    commodity_dir = os.path.join(root_loc, 'scripts', 'docker')
+    commodities = sorted(os.listdir(commodity_dir)) if os.path.isdir(commodity_dir) else []
+    compose_env = dict(os.environ, COMPOSE_FILE=sep.join(
+        [os.path.join(root_loc, 'apps', 'root-compose-fragment.yml')] +
+        [commodity_fragment(root_loc, c) for c in commodities if os.path.exists(commodity_fragment(root_loc, c))]))
+
+    log_dir = run_logs(root_loc).phase_dir('build')
+    pipeline = Pipeline(root_loc, pull, log_dir, compose_env)
+    open(pipeline.summary_log, 'w').close()
+    started = time.monotonic()
+    results = run_sync(pipeline.run(force_fetch))
+
+    print(colorize_lightblue(f"Pipeline finished in {time.monotonic() - started:.1f}s:"))
+    for appname, (status, seconds) in sorted(results.items(), key=lambda item: -item[1][1]):
+        colour = colorize_green if status in ('built', 'nothing to build') else colorize_yellow
+        print(colour(f"  {appname:<40} {status:<18} ready after {seconds:>7.1f}s"))
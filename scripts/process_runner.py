@@ -0,0 +1,106 @@
+import re
+import codecs
+import subprocess
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Union
+
+Command = Union[str, List[str]]
+
+DEFAULT_TAIL_LINES = 10
+READ_SIZE = 64 * 1024
+# A line longer than this (e.g. a progress bar that never ends its line) is passed on in pieces
+MAX_LINE_LENGTH = 1024 * 1024
+# The line endings text mode recognises: \r on its own is how git and docker redraw progress lines
+LINE_END = re.compile(r'\r\n|\r|\n')
+
+
+class LineDecoder:
+    """
+    Turns chunks of bytes into lines of text. Decoding is incremental, so a character split across two
+    reads is not mangled, and invalid UTF-8 is replaced rather than failing the command.
+    """
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.pending = ''
+
+    def feed(self, data: bytes) -> List[str]:
+        text = self.pending + self.decoder.decode(data)
+        # A trailing \r may be the first half of \r\n, so it waits for the next chunk
+        held = '\r' if text.endswith('\r') else ''
+        lines = LINE_END.split(text[:len(text) - len(held)])
+        self.pending = lines.pop() + held
+        while len(self.pending) > MAX_LINE_LENGTH:
+            lines.append(self.pending[:MAX_LINE_LENGTH])
+            self.pending = self.pending[MAX_LINE_LENGTH:]
+        return lines
+
+    def close(self) -> List[str]:
+        text = self.pending + self.decoder.decode(b'', final=True)
+        self.pending = ''
+        lines = LINE_END.split(text)
+        if lines[-1] == '':
+            lines.pop()
+        return lines
+
+
+@dataclass
+class ProcessResult:
+    exit_code: int
+    # The last lines of output (at most tail_lines of them)
+    tail: List[str]
+
+    def print_tail(self) -> None:
+        for line in self.tail:
+            print(line)
+
+
+def run_process(cmd: Command, on_line: Optional[Callable[[str], None]] = None, log_path: Optional[str] = None,
+                append: bool = False, tail_lines: int = DEFAULT_TAIL_LINES,
+                input_text: Optional[str] = None) -> ProcessResult:
+    """
+    Runs a command (a string runs through the shell, a list does not) and streams its combined
+    stdout/stderr line by line to on_line and/or the file at log_path, as it arrives. Only the last
+    tail_lines lines are kept, so the output is never held in memory in full.
+    """
+    tail: deque = deque(maxlen=tail_lines)
+    log = open(log_path, 'a' if append else 'w') if log_path is not None else None
+
+    def emit(lines: List[str]) -> None:
+        # Handled a chunk at a time, as a single build can produce millions of lines
+        if not lines:
+            return
+        tail.extend(lines)
+        if on_line is not None:
+            for line in lines:
+                on_line(line)
+        if log is not None:
+            log.write('\n'.join(lines) + '\n')
+
+    try:
+        try:
+            process = subprocess.Popen(
+                cmd, shell=isinstance(cmd, str), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                stdin=subprocess.PIPE if input_text is not None else subprocess.DEVNULL)
+        except OSError as e:
+            emit([str(e)])
+            return ProcessResult(127, list(tail))
+        if input_text is not None:
+            try:
+                process.stdin.write(input_text.encode())
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+        decoder = LineDecoder()
+        while True:
+            data = process.stdout.read1(READ_SIZE)
+            if not data:
+                break
+            emit(decoder.feed(data))
+        emit(decoder.close())
+        process.stdout.close()
+        return ProcessResult(process.wait(), list(tail))
+    finally:
+        if log is not None:
+            log.close()
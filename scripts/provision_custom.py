@@ -1,78 +1,264 @@
 import os
-import yaml
-from scripts.utilities import colorize_green, colorize_pink, colorize_yellow, run_command
+import sys
+import glob
+import time
+import asyncio
+import hashlib
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+from scripts.app_index import app_index
+from scripts.async_commands import run_sync, stream_async
+from scripts.container_state import ContainerSnapshot, container_snapshot
+from scripts.environment import Environment, ProvisionInputs, load_environment
+from scripts.image_builds import file_digest
+from scripts.log_store import record_failure, run_logs
+from scripts.state_store import custom_provision_store
+from scripts.utilities import colorize_green, colorize_lightblue, colorize_pink, colorize_red, colorize_yellow, \
+    force_requested, print_log_tail
+
+DEFAULT_CONCURRENCY = 3
+# Script kind (see app_index.FRAGMENT_KINDS) -> how it is described
+SCRIPT_LABELS = {'custom-provision': 'once-only', 'custom-provision-always': 'always'}
+
+
+class ProvisionOrderError(Exception):
+    pass
+
+
+@dataclass
+class ProvisionJob:
+    appname: str
+    # (kind, path) of each script to run, in order: the once-only script before the always-run one
+    scripts: List[Tuple[str, str]]
+    # Apps whose scripts must finish first (only those that have scripts to run)
+    after: List[str] = field(default_factory=list)
+    # Hash of the always-run script and its declared inputs, if the app declares them
+    inputs_hash: Optional[str] = None
+
+
+@dataclass
+class ScriptResult:
+    appname: str
+    kind: str
+    exit_code: int
+    seconds: float
+    log_path: str
+
+
+@dataclass
+class SkippedScript:
+    appname: str
+    kind: str
+    reason: str
+
 
 def create_custom_provision(root_loc: str) -> None:
     """
-    Creates the .custom_provision.yml file if it does not exist.
+    Creates the .custom_provision state file if it does not exist.
     """
-    custom_path = os.path.join(root_loc, '.custom_provision.yml')
-    if os.path.exists(custom_path):
+    store = custom_provision_store(root_loc)
+    if store.exists():
         return
     print(colorize_green("Did not find a .custom_provision file. I'll create a new one."))
-    custom_file = {
-        'version': '1',
-        'applications': []
-    }
-    with open(custom_path, 'w') as f:
-        yaml.dump(custom_file, f)
-
-def custom_provisioned(root_loc: str, app_name: str) -> bool:
+    store.create()
+
+def custom_provision_concurrency(config: dict) -> int:
     """
-    Returns True if the app has already been custom provisioned.
+    Returns the number of apps whose custom provision scripts run at once, from
+    DEV_ENV_CUSTOM_PROVISION_CONCURRENCY or the custom-provision-concurrency key of the dev-env-config,
+    defaulting to 3.
     """
-    custom_path = os.path.join(root_loc, '.custom_provision.yml')
-    if not os.path.exists(custom_path):
-        return False
-    with open(custom_path) as f:
-        custom_file = yaml.safe_load(f)
-    return app_name in custom_file.get('applications', [])
-
-def set_custom_provisioned(root_loc: str, app_name: str) -> None:
+    value = os.environ.get('DEV_ENV_CUSTOM_PROVISION_CONCURRENCY',
+                           config.get('custom-provision-concurrency', DEFAULT_CONCURRENCY))
+    try:
+        return max(1, int(value))
+    except (TypeError, ValueError):
+        return DEFAULT_CONCURRENCY
+
+def inputs_hash(app_dir: str, script_path: str, inputs: ProvisionInputs, snapshot: ContainerSnapshot) -> str:
     """
-    Marks the app as custom provisioned in .custom_provision.yml.
+    Hashes an always-run script together with its declared inputs: the content of every file matching
+    the globs, the image IDs of the containers and the values of the environment variables.
     """
-    create_custom_provision(root_loc)
-    custom_path = os.path.join(root_loc, '.custom_provision.yml')
-    with open(custom_path) as f:
-        custom_file = yaml.safe_load(f)
-    custom_file['applications'].append(app_name)
-    with open(custom_path, 'w') as f:
-        yaml.dump(custom_file, f)
-
-def provision_custom(root_loc: str) -> None:
+    digest = hashlib.sha256(file_digest(script_path))
+    paths = sorted({path for pattern in inputs.files
+                    for path in glob.glob(os.path.join(app_dir, pattern), recursive=True) if os.path.isfile(path)})
+    for path in paths:
+        digest.update(os.path.relpath(path, app_dir).encode() + b'\0' + file_digest(path))
+    for name in inputs.images:
+        digest.update(f"image {name}={snapshot[name].image}\0".encode())
+    for name in inputs.env:
+        digest.update(f"env {name}={os.environ.get(name)!r}\0".encode())
+    return digest.hexdigest()
+
+def plan_custom_provision(root_loc: str, environment: Environment, force: bool = False) -> Dict[str, ProvisionJob]:
     """
-    Runs custom provision scripts for all apps as defined in configuration.yml.
+    Works out which scripts each app needs to run and what they have to wait for. An always-run script
+    with declared inputs is skipped if they hash the same as at its last successful run, unless forced.
+    Raises ProvisionOrderError if the custom_provision.after declarations form a cycle.
     """
-    config_path = os.path.join(root_loc, 'dev-env-config', 'configuration.yml')
-    with open(config_path) as f:
-        config = yaml.safe_load(f)
-    if not config or 'applications' not in config:
-        return
-    for appname in config['applications']:
-        run_onetime_custom_provision(root_loc, appname)
-        run_always_custom_provision(root_loc, appname)
+    index = app_index(root_loc)
+    store = custom_provision_store(root_loc)
+    provisioned = set(store.data.get('applications', [])) if store.exists() else set()
+    last_hashes = store.data.get('always', {}) if store.exists() else {}
+    # One inspect call covers the images every app declares
+    snapshot = container_snapshot(name for app in environment.apps.values() if app.provision_inputs
+                                  for name in app.provision_inputs.images)
+    jobs: Dict[str, ProvisionJob] = {}
+    for appname, app in environment.apps.items():
+        files = index.app(appname)
+        scripts: List[Tuple[str, str]] = []
+        current_hash: Optional[str] = None
+        for kind, label in SCRIPT_LABELS.items():
+            script_path = files.fragment(kind)
+            if script_path is None:
+                continue
+            print(colorize_pink(f"Found a custom provision script ({label}) in {appname}"))
+            if kind == 'custom-provision' and appname in provisioned:
+                print(colorize_yellow(f"Custom provision script has already been run for {appname}, skipping"))
+                continue
+            if kind == 'custom-provision-always' and app.provision_inputs is not None:
+                current_hash = inputs_hash(files.path, script_path, app.provision_inputs, snapshot)
+                if current_hash == last_hashes.get(appname) and not force:
+                    print(colorize_yellow(f"The inputs of the always-run custom provision script for {appname} "
+                                          f"are unchanged since it last succeeded, skipping"))
+                    continue
+            scripts.append((kind, script_path))
+        if scripts:
+            jobs[appname] = ProvisionJob(appname, scripts, inputs_hash=current_hash)
+
+    for appname, job in jobs.items():
+        for other in environment.apps[appname].provision_after:
+            if other not in environment.apps:
+                print(colorize_yellow(f"{appname} wants to be provisioned after {other}, which is not in the "
+                                      f"dev-env-config; ignoring"))
+            elif other in jobs and other != appname:
+                job.after.append(other)
 
-def run_onetime_custom_provision(root_loc: str, appname: str) -> None:
+    visiting: List[str] = []
+    checked: Set[str] = set()
+
+    def visit(appname: str) -> None:
+        if appname in checked:
+            return
+        if appname in visiting:
+            cycle = visiting[visiting.index(appname):] + [appname]
+            raise ProvisionOrderError('custom_provision.after declarations form a cycle: ' + ' -> '.join(cycle))
+        visiting.append(appname)
+        for other in jobs[appname].after:
+            visit(other)
+        visiting.pop()
+        checked.add(appname)
+
+    for appname in jobs:
+        visit(appname)
+    return jobs
+
+def provision_custom(root_loc: str, force: bool = False) -> None:
     """
-    Runs the once-only custom provision script for an app if it exists and hasn't been run.
+    Runs custom provision scripts for all apps as defined in configuration.yml. force (or
+    DEV_ENV_FORCE_PROVISION) runs always-run scripts even if their declared inputs are unchanged.
     """
-    script_path = os.path.join(root_loc, 'apps', appname, 'fragments', 'custom-provision.sh')
-    if not os.path.exists(script_path):
+    run_sync(provision_custom_async(root_loc, force_requested(force)))
+
+async def provision_custom_async(root_loc: str, force: bool = False) -> None:
+    environment = load_environment(root_loc)
+    if environment is None:
         return
-    print(colorize_pink(f"Found a custom provision script (once-only) in {appname}"))
-    if custom_provisioned(root_loc, appname):
-        print(colorize_yellow(f"Custom provision script has already been run for {appname}, skipping"))
-    else:
-        run_command(f"sh {script_path}")
-        set_custom_provisioned(root_loc, appname)
+    try:
+        jobs = plan_custom_provision(root_loc, environment, force)
+    except ProvisionOrderError as e:
+        print(colorize_red(f"Cannot run the custom provision scripts: {e}"))
+        sys.exit(1)
+    if not jobs:
+        return
+
+    log_dir = run_logs(root_loc).phase_dir('custom-provision')
+    limit = asyncio.Semaphore(custom_provision_concurrency(environment.config))
+    finished = {appname: asyncio.Event() for appname in jobs}
+    results: List[ScriptResult] = []
+    skipped: List[SkippedScript] = []
+    started = time.monotonic()
+    await asyncio.gather(*(run_job(root_loc, job, finished, limit, log_dir, results, skipped)
+                           for job in jobs.values()))
 
-def run_always_custom_provision(root_loc: str, appname: str) -> None:
+    # The state file is written once, for every once-only script that succeeded and every always-run
+    # script with declared inputs
+    newly_provisioned = [result.appname for result in results
+                         if result.kind == 'custom-provision' and result.exit_code == 0]
+    # Always-run script with declared inputs -> whether it succeeded (a skipped one did not)
+    hashed = {result.appname: result.exit_code == 0 for result in results if result.kind == 'custom-provision-always'}
+    hashed.update((script.appname, False) for script in skipped if script.kind == 'custom-provision-always')
+    hashed = {appname: ok for appname, ok in hashed.items() if jobs[appname].inputs_hash is not None}
+    if newly_provisioned or hashed:
+        create_custom_provision(root_loc)
+        with custom_provision_store(root_loc).batch() as custom_file:
+            custom_file['applications'].extend(newly_provisioned)
+            last_hashes = custom_file.setdefault('always', {})
+            for appname, ok in hashed.items():
+                if ok:
+                    last_hashes[appname] = jobs[appname].inputs_hash
+                else:
+                    last_hashes.pop(appname, None)
+    print_summary(results, skipped, time.monotonic() - started)
+
+async def run_job(root_loc: str, job: ProvisionJob, finished: Dict[str, asyncio.Event], limit: asyncio.Semaphore, log_dir: str,
+                  results: List[ScriptResult], skipped: List[SkippedScript]) -> None:
     """
-    Runs the always-run custom provision script for an app if it exists.
+    Runs an app's scripts one after the other, once the apps it is ordered after have finished. The app is
+    skipped if one of those did not provision cleanly (it declared that it depends on them), and the always-run
+    script is skipped if the once-only script fails.
     """
-    script_path = os.path.join(root_loc, 'apps', appname, 'fragments', 'custom-provision-always.sh')
-    if not os.path.exists(script_path):
-        return
-    print(colorize_pink(f"Found a custom provision script (always) in {appname}"))
-    run_command(f"sh {script_path}")
+    try:
+        for other in job.after:
+            await finished[other].wait()
+        unprovisioned = {result.appname for result in results if result.exit_code != 0} | \
+            {script.appname for script in skipped}
+        blocked = [other for other in job.after if other in unprovisioned]
+        if blocked:
+            reason = f"{', '.join(blocked)} did not provision cleanly"
+            print(colorize_yellow(f"Skipping the custom provision scripts for {job.appname} as {reason}"))
+            skipped.extend(SkippedScript(job.appname, kind, reason) for kind, _ in job.scripts)
+            return
+        async with limit:
+            for position, (kind, script_path) in enumerate(job.scripts):
+                result = await run_script(root_loc, job.appname, kind, script_path, log_dir)
+                results.append(result)
+                if result.exit_code != 0:
+                    reason = f"the {SCRIPT_LABELS[kind]} script failed"
+                    skipped.extend(SkippedScript(job.appname, later, reason) for later, _ in job.scripts[position + 1:])
+                    break
+    finally:
+        finished[job.appname].set()
+
+async def run_script(root_loc: str, appname: str, kind: str, script_path: str, log_dir: str) -> ScriptResult:
+    """
+    Runs one script with its output going to its own log file rather than the terminal.
+    """
+    label = SCRIPT_LABELS[kind]
+    log_path = os.path.join(log_dir, f'{appname}.{kind}.log')
+    print(colorize_lightblue(f"Running the {label} custom provision script for {appname} "
+                             f"(logging to {os.path.relpath(log_path, root_loc)})"))
+    started = time.monotonic()
+    with open(log_path, 'w') as log:
+        exit_code = await stream_async(['sh', script_path], lambda line: log.write(line + '\n'))
+    result = ScriptResult(appname, kind, exit_code, time.monotonic() - started, log_path)
+    if exit_code == 0:
+        print(colorize_green(f"The {label} custom provision script for {appname} finished in {result.seconds:.1f}s"))
+    else:
+        retry = '; it will be run again next time' if kind == 'custom-provision' else ''
+        print(colorize_red(f"The {label} custom provision script for {appname} failed with exit code {exit_code} "
+                           f"after {result.seconds:.1f}s{retry}. Here are the last 10 lines of its log:"))
+        print_log_tail(log_path)
+        record_failure(root_loc, log_path, exit_code)
+    return result
+
+def print_summary(results: List[ScriptResult], skipped: List[SkippedScript], seconds: float) -> None:
+    failed = [result for result in results if result.exit_code != 0]
+    print(colorize_lightblue(f"Custom provisioning finished in {seconds:.1f}s "
+                             f"({len(results)} script(s), {len(failed)} failed, {len(skipped)} skipped):"))
+    for result in sorted(results, key=lambda result: -result.seconds):
+        colour = colorize_green if result.exit_code == 0 else colorize_red
+        print(colour(f"  {result.appname:<40} {SCRIPT_LABELS[result.kind]:<10} {result.seconds:>7.1f}s"))
+    for script in skipped:
+        print(colorize_yellow(f"  {script.appname:<40} {SCRIPT_LABELS[script.kind]:<10} skipped ({script.reason})"))
@@ -1,11 +1,22 @@
 import os
-import time
-import yaml
+import re
+import asyncio
+import tempfile
+from typing import Dict, List, Optional, Tuple
 
+from scripts.app_index import app_index
+from scripts.async_commands import capture_async, run_async, run_sync
+from scripts.container_state import container_snapshot
+from scripts.docker_api import DockerAPIError, docker_client
+from scripts.environment import load_environment
+from scripts.health_watcher import health_watcher
+from scripts.volume_snapshots import restore_volume, save_volume, snapshot_path, snapshot_target
+from scripts.waiting import Backoff, wait_until
 from scripts.commodities import (
     commodity_required,
     container_to_commodity,
-    commodity_provisioned,
+    fragment_digest,
+    provision_decision,
     set_commodity_provision_status,
 )
 
@@ -15,10 +26,16 @@ from scripts.utilities import (
     colorize_pink,
     colorize_lightblue,
     colorize_green,
-    run_command,
-    run_command_noshell,
 )
 
+POSTGRES_STARTUP_TIMEOUT = 300
+# Fragments and the script that runs them are uploaded here
+PROVISION_DIR = '/dev-env-provision'
+SCRIPT_NAME = 'run-init-fragments.sql'
+# Written to stderr (like psql's errors, so the two stay in order) around each app's fragment
+MARKER = '==dev-env-provision=='
+ERROR_PATTERN = re.compile(r'\b(?:ERROR|FATAL|PANIC):')
+
 
 def postgres_container(postgres_version: str) -> str:
     if postgres_version == '13':
@@ -30,15 +47,18 @@ def postgres_container(postgres_version: str) -> str:
         return ''
 
 
-def provision_postgres(root_loc: str, new_containers: list, postgres_version: str) -> None:
+def provision_postgres(root_loc: str, new_containers: list, postgres_version: str, force: bool = False) -> None:
+    run_sync(provision_postgres_async(root_loc, new_containers, postgres_version, force))
+
+
+async def provision_postgres_async(root_loc: str, new_containers: list, postgres_version: str,
+                                   force: bool = False) -> None:
     container = postgres_container(postgres_version)
     if not container:
         return
 
-    config_path = os.path.join(root_loc, 'dev-env-config', 'configuration.yml')
-    with open(config_path) as f:
-        config = yaml.safe_load(f)
-    if not config or 'applications' not in config:
+    environment = load_environment(root_loc)
+    if environment is None or not environment.apps:
         return
 
     new_db_container = container in new_containers
@@ -48,89 +68,277 @@ def provision_postgres(root_loc: str, new_containers: list, postgres_version: st
             "provision status in .commodities will be ignored"
         ))
 
-    started = False
-    for appname in config['applications']:
+    # Everything pending for this container is initialised together, in one psql session
+    fragments: Dict[str, bytes] = {}
+    digests: Dict[str, str] = {}
+    decisions: List[Tuple[str, bool, str]] = []
+    index = app_index(root_loc)
+    for appname in environment.apps:
         if not postgres_required(root_loc, appname, container):
             continue
-        sql_path = os.path.join(root_loc, 'apps', appname, 'fragments', 'postgres-init-fragment.sql')
-        if os.path.exists(sql_path):
-            started = start_postgres_maybe(
-                root_loc, appname, started, new_db_container, postgres_version
-            )
+        if index.app(appname).fragment('postgres-init') is None:
+            continue
+        content = open_fragment(root_loc, appname)
+        run, reason = provision_decision(root_loc, appname, container_to_commodity(container), content,
+                                         new_db_container, force)
+        decisions.append((appname, run, reason))
+        digests[appname] = fragment_digest(content)
+        if run:
+            fragments[appname] = content
+    print_decisions(postgres_version, decisions)
+    if not fragments:
+        return
+
+    # A new container starts from scratch, so a snapshot of the same image with the same fragments applied
+    # can stand in for running them
+    target = await snapshot_target(root_loc, container, digests) if new_db_container else None
+    if target is not None and await restore_snapshot(root_loc, container, postgres_version, target, digests):
+        return
+
+    if not await start_container(container, postgres_version):
+        print(colorize_red(
+            f"Postgres {postgres_version} did not become healthy within {POSTGRES_STARTUP_TIMEOUT} seconds; "
+            f"skipping {', '.join(fragments)}"
+        ))
+        return
+    failed = await initialise_apps(root_loc, fragments, container)
+    if snapshot_wanted(new_db_container, fragments, digests, failed):
+        target = target or await snapshot_target(root_loc, container, digests)
+        if target is not None and not os.path.exists(snapshot_path(root_loc, container, target[0])):
+            await save_snapshot(root_loc, container, postgres_version, target)
+
+
+def snapshot_wanted(new_db_container: bool, fragments: Dict[str, bytes], digests: Dict[str, str],
+                    failed: List[str]) -> bool:
+    """
+    Returns True if the container's data is worth saving as a snapshot: it was created in this run and holds
+    nothing but every app's fragment, all applied cleanly just now. An existing container holds the
+    developer's own data (and apps only assumed to be current), and would be stopped to save it.
+    """
+    return new_db_container and not failed and set(fragments) == set(digests)
+
+
+async def restore_snapshot(root_loc: str, container: str, postgres_version: str, target: Tuple[str, str, str],
+                           digests: Dict[str, str]) -> bool:
+    """
+    Restores the container's data from the snapshot for target, if there is one, and records every
+    fragment as applied. Returns False if there is no usable snapshot.
+    """
+    key, image_id, volume = target
+    if not os.path.exists(snapshot_path(root_loc, container, key)):
+        return False
+    await run_async(os.environ['DC_CMD'].split() + ['stop', container])
+    if not await restore_volume(root_loc, container, key, image_id, volume):
+        return False
+    if not await start_container(container, postgres_version):
+        print(colorize_red(f"Postgres {postgres_version} did not become healthy after restoring its snapshot"))
+        return False
+    for appname, digest in digests.items():
+        set_commodity_provision_status(root_loc, appname, container_to_commodity(container), digest)
+    print(colorize_green(f"Restored {container} with the init fragments of {len(digests)} app(s) already applied"))
+    return True
+
+
+async def save_snapshot(root_loc: str, container: str, postgres_version: str, target: Tuple[str, str, str]) -> None:
+    """
+    Stops the container long enough to archive a consistent copy of its data volume.
+    """
+    key, image_id, volume = target
+    await run_async(os.environ['DC_CMD'].split() + ['stop', container])
+    await save_volume(root_loc, container, key, image_id, volume)
+    if not await start_container(container, postgres_version):
+        print(colorize_red(f"Postgres {postgres_version} did not become healthy again after the snapshot"))
+
+
+def print_decisions(postgres_version: str, decisions: List[Tuple[str, bool, str]]) -> None:
+    if not decisions:
+        return
+    print(colorize_lightblue(f"Postgres {postgres_version} init fragments:"))
+    for appname, run, reason in decisions:
+        colour = colorize_pink if run else colorize_yellow
+        print(colour(f"  {appname:<40} {'run' if run else 'skip':<5} ({reason})"))
 
 
 def postgres_required(root_loc: str, appname: str, container: str) -> bool:
-    config_path = os.path.join(root_loc, 'apps', appname, 'configuration.yml')
-    return (
-            os.path.exists(config_path) and
-            commodity_required(root_loc, appname, container_to_commodity(container))
-    )
+    return commodity_required(root_loc, appname, container_to_commodity(container))
 
 
-def start_postgres_maybe(
+async def start_postgres_maybe(
         root_loc: str,
         appname: str,
         started: bool,
         new_db_container: bool,
         postgres_version: str,
+        env: Optional[Dict[str, str]] = None,
 ) -> bool:
+    """
+    Runs the app's init fragment if it needs to be, starting the container first unless it has been started
+    already. env (if given) is the environment the compose commands run in. Returns whether it is started.
+    """
     container = postgres_container(postgres_version)
     if not container:
         return started
 
-    print(colorize_pink(f"Found Postgres init fragment SQL in {appname}"))
-    if commodity_provisioned(root_loc, appname, container_to_commodity(container)) and not new_db_container:
-        print(colorize_yellow(
-            f"Postgres {postgres_version} has previously been provisioned for {appname}, skipping"
-        ))
-    else:
-        started = start_postgres(root_loc, appname, started, postgres_version)
+    content = open_fragment(root_loc, appname)
+    run, reason = provision_decision(root_loc, appname, container_to_commodity(container), content, new_db_container)
+    print_decisions(postgres_version, [(appname, run, reason)])
+    if run:
+        started = await start_postgres(root_loc, appname, started, postgres_version, env)
     return started
 
 
-def start_postgres(
+async def start_postgres(
         root_loc: str,
         appname: str,
         started: bool,
         postgres_version: str,
+        env: Optional[Dict[str, str]] = None,
 ) -> bool:
     container = postgres_container(postgres_version)
     if not container:
         return started
 
     if not started:
-        run_command_noshell(os.environ['DC_CMD'].split() + ['up', '-d', container])
-        print(colorize_lightblue(f"Waiting for Postgres {postgres_version} to finish initialising"))
-
-        command_output = []
-        command_outcode = 1
-        while command_outcode != 0 or not check_healthy_output(command_output):
-            command_output.clear()
-            command_outcode = run_command(
-                f'docker inspect --format="{{{{json .State.Health.Status}}}}" {container}',
-                command_output
-            )
-            print(colorize_yellow(f"Postgres {postgres_version} is unavailable - sleeping"))
-            time.sleep(3)
-        time.sleep(3)
-        print(colorize_green(f"Postgres {postgres_version} is ready"))
+        if not await start_container(container, postgres_version, env):
+            print(colorize_red(
+                f"Postgres {postgres_version} did not become healthy within {POSTGRES_STARTUP_TIMEOUT} seconds; "
+                f"skipping {appname}"
+            ))
+            return started
         started = True
 
-    run_initialisation(root_loc, appname, container)
-    set_commodity_provision_status(root_loc, appname, container_to_commodity(container), True)
+    await initialise_apps(root_loc, {appname: open_fragment(root_loc, appname)}, container)
     return started
 
 
-def run_initialisation(root_loc: str, appname: str, container: str) -> None:
-    sql_fragment = 'postgres-init-fragment.sql'
-    app_fragments = os.path.join(root_loc, 'apps', appname, 'fragments')
-    run_command(
-        f'tar -c -C {app_fragments} {sql_fragment} | docker cp - {container}:/'
+async def start_container(container: str, postgres_version: str, env: Optional[Dict[str, str]] = None) -> bool:
+    """
+    Starts the Postgres container and waits for it to become healthy. Returns False on timeout.
+    """
+    await run_async(os.environ['DC_CMD'].split() + ['up', '-d', container], env=env)
+    print(colorize_lightblue(f"Waiting for Postgres {postgres_version} to finish initialising"))
+    ready = await asyncio.to_thread(
+        wait_until,
+        lambda: container_snapshot([container]).healthy(container),
+        POSTGRES_STARTUP_TIMEOUT,
+        Backoff(maximum=3.0),
+        watcher=health_watcher(),
+        on_wait=lambda: print(colorize_yellow(f"Postgres {postgres_version} is unavailable - waiting")),
     )
-    print(colorize_pink(f"Executing SQL fragment for {appname}..."))
-    run_command_noshell(['docker', 'exec', container, 'psql', '-q', '-f', sql_fragment])
-    print(colorize_pink('...done.'))
+    if ready:
+        print(colorize_green(f"Postgres {postgres_version} is ready"))
+    return ready
+
+
+async def initialise_apps(root_loc: str, fragments: Dict[str, bytes], container: str) -> List[str]:
+    """
+    Runs the apps' init fragments (app -> fragment content) and records the digest of each one, flagged if it
+    reported errors. A flagged fragment is tried again once it changes, or when provisioning is forced.
+    Returns the apps whose fragment reported errors.
+    """
+    appnames = list(fragments)
+    results = await run_initialisation(fragments, container)
+    failed = [appname for appname in appnames if not results[appname][0]]
+    for appname in appnames:
+        ok, output = results[appname]
+        digest = fragment_digest(fragments[appname])
+        print(colorize_pink(f"Executing SQL fragment for {appname}..."))
+        for line in output:
+            print(line)
+        if ok:
+            set_commodity_provision_status(root_loc, appname, container_to_commodity(container), digest)
+            print(colorize_pink('...done.'))
+        else:
+            set_commodity_provision_status(root_loc, appname, container_to_commodity(container),
+                                           {'digest': digest, 'errors': True})
+            print(colorize_red(f"...the SQL fragment for {appname} reported errors; it will be run again once it "
+                               f"changes, or with --force-provision."))
+    if len(appnames) > 1:
+        print(colorize_lightblue(
+            f"{container}: initialised {len(appnames) - len(failed)} of {len(appnames)} app(s) in one session"
+            + (f"; errors in {', '.join(failed)}" if failed else '')
+        ))
+    return failed
+
+
+def initialisation_script(appnames: List[str]) -> str:
+    """
+    Returns a psql script that runs each app's fragment in turn, on a fresh connection each (as a separate
+    psql would), between markers on stderr so the output can be split per app.
+    """
+    lines = ["\\set dev_env_db :DBNAME", "\\set dev_env_user :USER"]
+    for appname in appnames:
+        lines += [
+            "\\connect -reuse-previous=on :dev_env_db :dev_env_user",
+            f"\\warn {MARKER} begin {appname}",
+            f"\\ir {appname}.sql",
+            f"\\warn {MARKER} end {appname}",
+        ]
+    return '\n'.join(lines) + '\n'
+
+
+def split_output(appnames: List[str], output: str, exit_code: int) -> Dict[str, Tuple[bool, List[str]]]:
+    """
+    Splits the session's output at the markers into {app: (ran cleanly, output lines)}. An app whose
+    section is missing or contains an error did not run cleanly; output outside any section (e.g. a
+    connection failure) is attributed to every app that did not finish.
+    """
+    sections: Dict[str, List[str]] = {}
+    finished: set = set()
+    outside: List[str] = []
+    current: Optional[str] = None
+    for line in output.splitlines():
+        if line.startswith(MARKER):
+            _, event, appname = line.split(' ', 2)
+            if event == 'begin':
+                current = appname
+                sections.setdefault(appname, [])
+            else:
+                finished.add(appname)
+                current = None
+        elif current is not None:
+            sections[current].append(line)
+        elif line.strip():
+            outside.append(line)
+
+    results: Dict[str, Tuple[bool, List[str]]] = {}
+    for appname in appnames:
+        lines = sections.get(appname, [])
+        ok = appname in finished and not any(ERROR_PATTERN.search(line) for line in lines)
+        if appname not in finished:
+            lines = lines + outside + [f"psql exited with code {exit_code} before the fragment finished"]
+        results[appname] = (ok, lines)
+    return results
+
+
+async def run_initialisation(fragments: Dict[str, bytes], container: str) -> Dict[str, Tuple[bool, List[str]]]:
+    """
+    Uploads every app's init fragment (and the script that runs them) in one archive and runs them all
+    in a single psql session. Returns {app: (ran cleanly, output lines)}.
+    """
+    appnames = list(fragments)
+    files = {f"{appname}.sql": content for appname, content in fragments.items()}
+    files[SCRIPT_NAME] = initialisation_script(appnames).encode()
+    cmd = ['psql', '-q', '-f', f'{PROVISION_DIR}/{SCRIPT_NAME}']
+    client = docker_client()
+    if client is not None:
+        try:
+            await asyncio.to_thread(client.upload_files, container, '/', {
+                f'{PROVISION_DIR.lstrip("/")}/{name}': content for name, content in files.items()
+            })
+            exit_code, output = await asyncio.to_thread(client.exec, container, cmd)
+            return split_output(appnames, output, exit_code)
+        except DockerAPIError as e:
+            print(colorize_yellow(f"The Docker API failed ({e}); using the docker CLI instead"))
+    with tempfile.TemporaryDirectory() as staging:
+        for name, content in files.items():
+            with open(os.path.join(staging, name), 'wb') as f:
+                f.write(content)
+        await run_async(['docker', 'cp', f'{staging}/.', f'{container}:{PROVISION_DIR}'])
+    exit_code, lines = await capture_async(['docker', 'exec', container] + cmd)
+    return split_output(appnames, '\n'.join(lines), exit_code)
 
 
-def check_healthy_output(command_output: list) -> bool:
-    return any('healthy' in line for line in command_output)
+def open_fragment(root_loc: str, appname: str) -> bytes:
+    with open(os.path.join(root_loc, 'apps', appname, 'fragments', 'postgres-init-fragment.sql'), 'rb') as f:
+        return f.read()
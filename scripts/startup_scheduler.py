@@ -0,0 +1,281 @@
+import os
+import asyncio
+from dataclasses import dataclass, field, replace
+from typing import Dict, List, Optional, Set, Tuple
+from scripts.async_commands import capture_async, run_async, run_sync
+from scripts.container_state import ContainerSnapshot, container_snapshot
+from scripts.docker_api import DockerAPIError, docker_client, split_command
+from scripts.environment import ConfigError, ExpensiveService, HealthDependency, startup_timeout_seconds
+from scripts.health_watcher import health_watcher
+from scripts.waiting import Backoff, Deadline, pause
+from scripts.utilities import (
+    colorize_lightblue,
+    colorize_green,
+    colorize_yellow,
+    colorize_pink,
+    colorize_red)
+
+DEFAULT_CONCURRENCY = 3
+# Polls start fast and back off to the old fixed 5 second interval while nothing changes
+POLL_BACKOFF = Backoff(initial=0.25, maximum=5.0)
+MAX_RESTARTS = 9
+
+
+class StartupGraphError(Exception):
+    pass
+
+
+@dataclass
+class StartupGraph:
+    services: Dict[str, ExpensiveService]
+    # compose service -> the services (expensive or not) it waits for
+    dependencies: Dict[str, List[HealthDependency]]
+    # compose service -> number of services in the longest chain that starts with it
+    chain_length: Dict[str, int] = field(default_factory=dict)
+
+    def critical_path(self) -> List[str]:
+        """
+        Returns the longest chain of expensive services that have to become healthy one after another.
+        """
+        if not self.chain_length:
+            return []
+        path = [max(self.chain_length, key=lambda name: self.chain_length[name])]
+        while True:
+            # Follow the service that the last one in the path waits for with the longest chain of its own
+            waits_for = [dep.compose_service for dep in self.dependencies[path[-1]]
+                         if dep.compose_service in self.services]
+            if not waits_for:
+                break
+            path.append(max(waits_for, key=lambda name: self.chain_length[name]))
+        path.reverse()
+        return path
+
+
+def build_startup_graph(expensive: List[ExpensiveService], known_services: List[str]) -> StartupGraph:
+    """
+    Builds the dependency graph of the expensive services to be started.
+    Raises StartupGraphError for an invalid startup_timeout, a dependency on a service compose does not
+    know about, or a dependency cycle.
+    """
+    services = {}
+    for service in expensive:
+        try:
+            timeout = startup_timeout_seconds(service)
+        except ConfigError as e:
+            raise StartupGraphError(str(e)) from None
+        services[service.compose_service] = replace(service, startup_timeout=timeout)
+    dependencies = {name: list(service.wait_until_healthy) for name, service in services.items()}
+    unknown = sorted({
+        f"{name} -> {dep.compose_service}"
+        for name, deps in dependencies.items() for dep in deps
+        if dep.compose_service not in known_services
+    })
+    if unknown:
+        raise StartupGraphError('wait_until_healthy refers to unknown services: ' + ', '.join(unknown))
+
+    graph = StartupGraph(services=services, dependencies=dependencies)
+    visiting: List[str] = []
+
+    def visit(name: str) -> int:
+        if name in graph.chain_length:
+            return graph.chain_length[name]
+        if name in visiting:
+            cycle = visiting[visiting.index(name):] + [name]
+            raise StartupGraphError('wait_until_healthy dependencies form a cycle: ' + ' -> '.join(cycle))
+        visiting.append(name)
+        longest = 0
+        for dep in dependencies[name]:
+            if dep.compose_service in services:
+                longest = max(longest, visit(dep.compose_service))
+        visiting.pop()
+        graph.chain_length[name] = longest + 1
+        return longest + 1
+
+    for name in services:
+        visit(name)
+    return graph
+
+
+def concurrency_limit(config: dict) -> int:
+    """
+    Returns the maximum number of expensive services to start at once, from DEV_ENV_STARTUP_CONCURRENCY
+    or the expensive-startup-concurrency key of the dev-env-config, defaulting to 3.
+    """
+    value = os.environ.get('DEV_ENV_STARTUP_CONCURRENCY', config.get('expensive-startup-concurrency', DEFAULT_CONCURRENCY))
+    try:
+        return max(1, int(value))
+    except (TypeError, ValueError):
+        return DEFAULT_CONCURRENCY
+
+
+async def service_healthy(compose_service: str, healthcheck_cmd: Optional[str], snapshot: ContainerSnapshot) -> bool:
+    """
+    Checks if a service is healthy using either the Docker healthcheck (read from the snapshot)
+    or the command from configuration.yml.
+    """
+    if healthcheck_cmd == 'docker':
+        return snapshot.healthy(compose_service)
+    client = docker_client()
+    if client is not None:
+        try:
+            exit_code, _ = await asyncio.to_thread(client.exec, compose_service, split_command(healthcheck_cmd))
+            return exit_code == 0
+        except DockerAPIError:
+            return False
+    return await run_async(f"docker exec {compose_service} {healthcheck_cmd}", []) == 0
+
+
+async def last_log_line(compose_service: str) -> str:
+    client = docker_client()
+    if client is not None:
+        try:
+            output = await asyncio.to_thread(client.logs, compose_service, 1)
+            return output.rstrip('\n').split('\n')[-1]
+        except DockerAPIError:
+            return ''
+    _, output_lines = await capture_async(['docker', 'logs', '--tail', '1', compose_service])
+    return output_lines[0] if output_lines else ''
+
+
+def containers_to_inspect(graph: StartupGraph, pending: List[str], in_progress: List[str]) -> Set[str]:
+    """
+    Returns every container whose state the next pass needs: the services being started plus any
+    services outside the graph that pending services are waiting on.
+    """
+    names = set(in_progress)
+    for name in pending:
+        names.update(dep.compose_service for dep in graph.dependencies[name]
+                     if dep.compose_service not in graph.services)
+    return names
+
+
+def start_expensive_services(graph: StartupGraph, concurrency: int) -> List[ExpensiveService]:
+    """
+    Starts every service in the graph as soon as all of its dependencies are healthy, with at most
+    `concurrency` services starting at any one time. Returns the services that failed to start.
+    A service with a startup_timeout that is not healthy in time (counting from when it was started,
+    or from the beginning while it waits for dependencies) is reported and skipped.
+    """
+    return run_sync(start_expensive_services_async(graph, concurrency))
+
+
+async def start_expensive_services_async(graph: StartupGraph, concurrency: int) -> List[ExpensiveService]:
+    critical_path = graph.critical_path()
+    if len(critical_path) > 1:
+        print(colorize_lightblue(f"Critical path ({len(critical_path)} services): {' -> '.join(critical_path)}"))
+
+    # Longest remaining chain first, so the critical path is never left waiting for a free slot
+    pending = sorted(graph.services, key=lambda name: -graph.chain_length[name])
+    in_progress: List[str] = []
+    healthy: Set[str] = set()
+    failed: List[str] = []
+    check_counts: Dict[str, int] = {}
+    deadlines = {name: Deadline(service.startup_timeout) for name, service in graph.services.items()}
+    watcher = health_watcher()
+    delays = POLL_BACKOFF.delays()
+
+    while pending or in_progress:
+        # Any container event after this point cuts the wait at the end of the pass short
+        since = watcher.generation
+        progressed = False
+        snapshot = await asyncio.to_thread(container_snapshot, containers_to_inspect(graph, pending, in_progress))
+
+        # Every in-progress service is checked (and its log tailed) at the same time
+        checking = list(in_progress)
+        results = await asyncio.gather(*(
+            service_healthy(name, graph.services[name].healthcheck_cmd, snapshot) for name in checking))
+        not_healthy = [name for name, result in zip(checking, results) if not result]
+        log_lines = dict(zip(not_healthy, await asyncio.gather(*(last_log_line(name) for name in not_healthy))))
+        to_stop: List[str] = []
+        for name, result in zip(checking, results):
+            check_counts[name] += 1
+            service = graph.services[name]
+            print(colorize_lightblue(f"Checking if {name} is healthy - Attempt {check_counts[name]}"))
+            if result:
+                print(colorize_green(f"{name} is healthy ({deadlines[name].elapsed:.1f}s)"))
+                in_progress.remove(name)
+                healthy.add(name)
+                progressed = True
+                continue
+            if deadlines[name].expired:
+                print(colorize_red(f"{name} did not become healthy within its startup_timeout of {service.startup_timeout} seconds. Skipping this container"))
+                in_progress.remove(name)
+                failed.append(name)
+                progressed = True
+                continue
+            print(colorize_yellow(f"Not yet (Last log line: {log_lines[name]})"))
+            restarts = snapshot[name].restart_count
+            if restarts > 0:
+                print(colorize_pink(f"The container has exited (crashed?) and been restarted {restarts} times (max {MAX_RESTARTS + 1} allowed)"))
+            if restarts > MAX_RESTARTS:
+                print(colorize_red('The failure threshold has been reached. Skipping this container'))
+                in_progress.remove(name)
+                failed.append(name)
+                progressed = True
+                to_stop.append(name)
+        if to_stop:
+            await run_async(f"{os.environ.get('DC_CMD')} stop {' '.join(to_stop)}", [])
+
+        # Services outside the graph that pending services wait on, all checked at the same time.
+        # Skipped while every slot is taken, as nothing could be started anyway.
+        external_health: Dict[Tuple[str, Optional[str]], bool] = {}
+        if len(in_progress) < concurrency:
+            externals = list(dict.fromkeys(
+                (dep.compose_service, dep.healthcheck_cmd)
+                for name in pending for dep in graph.dependencies[name]
+                if dep.compose_service not in graph.services))
+            results = await asyncio.gather(*(service_healthy(dep, cmd, snapshot) for dep, cmd in externals))
+            external_health = dict(zip(externals, results))
+
+        def dependency_healthy(dep: HealthDependency) -> bool:
+            if dep.compose_service in graph.services:
+                return dep.compose_service in healthy
+            return external_health.get((dep.compose_service, dep.healthcheck_cmd), False)
+
+        to_start: List[str] = []
+        for name in list(pending):
+            if len(in_progress) >= concurrency:
+                break
+            deps = graph.dependencies[name]
+            failed_deps = [dep.compose_service for dep in deps if dep.compose_service in failed]
+            if failed_deps:
+                print(colorize_red(f"{name} will not be started as {', '.join(failed_deps)} failed to start"))
+                pending.remove(name)
+                failed.append(name)
+                progressed = True
+                continue
+            waiting_on = [dep.compose_service for dep in deps if not dependency_healthy(dep)]
+            if waiting_on and deadlines[name].expired:
+                print(colorize_red(f"{name} gave up waiting for {', '.join(waiting_on)} after its startup_timeout of {graph.services[name].startup_timeout} seconds"))
+                pending.remove(name)
+                failed.append(name)
+                progressed = True
+                continue
+            if waiting_on:
+                continue
+            if deps:
+                print(colorize_green(f"Dependencies of {name} are healthy"))
+            print(colorize_lightblue(f"Starting {name}"))
+            to_start.append(name)
+            pending.remove(name)
+            in_progress.append(name)
+            check_counts[name] = 0
+            deadlines[name] = Deadline(graph.services[name].startup_timeout)
+            progressed = True
+        if to_start:
+            # One compose call starts everything that became ready in this pass
+            await run_async(f"{os.environ.get('DC_CMD')} up --no-deps --remove-orphans -d {' '.join(to_start)}", [])
+
+        if pending and not in_progress:
+            blocked = {name: [dep.compose_service for dep in graph.dependencies[name]
+                              if dep.compose_service not in healthy] for name in pending}
+            print(colorize_yellow('Waiting for dependencies: ' + '; '.join(
+                f"{name} needs {', '.join(deps)}" for name, deps in blocked.items())))
+        if pending or in_progress:
+            print()
+            if progressed:
+                delays = POLL_BACKOFF.delays()
+            # Woken as soon as docker reports a health change, death or restart; backs off otherwise
+            await asyncio.to_thread(pause, next(delays), watcher, since)
+
+    return [graph.services[name] for name in failed]
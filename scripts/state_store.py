@@ -0,0 +1,245 @@
+import os
+import json
+import sqlite3
+import tempfile
+import threading
+import yaml
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows; writes are still atomic, just not locked against other processes
+    fcntl = None
+
+YamlDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+BACKENDS = ('yaml', 'json', 'sqlite')
+BACKEND_EXTENSIONS = {'yaml': '.yml', 'json': '.json', 'sqlite': '.sqlite'}
+
+# path -> StateStore, so every module in the process shares the same in-memory copy
+_stores: Dict[str, 'StateStore'] = {}
+_stores_lock = threading.Lock()
+
+
+def selected_backend() -> str:
+    """
+    Returns the state backend chosen via DEV_ENV_STATE_BACKEND (yaml, json or sqlite). Defaults to yaml.
+    """
+    backend = os.environ.get('DEV_ENV_STATE_BACKEND', 'yaml').lower()
+    return backend if backend in BACKENDS else 'yaml'
+
+
+def state_file_paths(root_loc: str, name: str) -> list:
+    """
+    Returns the paths every backend could use for the named state file (e.g. '.commodities').
+    """
+    return [os.path.join(root_loc, name + ext) for ext in BACKEND_EXTENSIONS.values()] + \
+        [os.path.join(root_loc, name + '.lock')]
+
+
+class StateStore:
+    """
+    An in-memory copy of a small state document that is loaded once, updated in batches and
+    committed atomically (temporary file plus rename, under an exclusive file lock).
+    """
+
+    def __init__(self, root_loc: str, name: str, default: Callable[[], Dict[str, Any]],
+                 backend: Optional[str] = None):
+        self.root_loc = root_loc
+        self.name = name
+        self.default = default
+        self.backend = backend or selected_backend()
+        self.path = os.path.join(root_loc, name + BACKEND_EXTENSIONS[self.backend])
+        self.lock_path = os.path.join(root_loc, name + '.lock')
+        self._data: Optional[Dict[str, Any]] = None
+        self._loaded_key: Optional[Tuple[int, int]] = None
+        self._depth = 0
+        self._dirty = False
+        self._lock_file = None
+        self._mutex = threading.RLock()
+
+    # Reading
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path) or self._legacy_path() is not None
+
+    @property
+    def data(self) -> Dict[str, Any]:
+        """
+        The current document. Re-read from disk only if another process has changed the file
+        and there are no uncommitted changes in memory.
+        """
+        with self._mutex:
+            if self._data is None or (not self._dirty and self._file_key() != self._loaded_key):
+                self._load()
+            return self._data
+
+    def _file_key(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load(self) -> None:
+        document = None
+        if os.path.exists(self.path):
+            document = self._read(self.backend, self.path)
+        else:
+            legacy = self._legacy_path()
+            if legacy is not None:
+                document = self._migrate(*legacy)
+        self._data = document if document is not None else self.default()
+        self._loaded_key = self._file_key()
+
+    def _legacy_path(self) -> Optional[Tuple[str, str]]:
+        """
+        Returns (backend, path) of a state file written by a different backend, if there is one.
+        """
+        for backend, ext in BACKEND_EXTENSIONS.items():
+            path = os.path.join(self.root_loc, self.name + ext)
+            if backend != self.backend and os.path.exists(path):
+                return backend, path
+        return None
+
+    def _migrate(self, backend: str, path: str) -> Optional[Dict[str, Any]]:
+        document = self._read(backend, path)
+        if document is None:
+            return None
+        self._write(document)
+        os.remove(path)
+        return document
+
+    @staticmethod
+    def _read(backend: str, path: str) -> Optional[Dict[str, Any]]:
+        if backend == 'sqlite':
+            connection = sqlite3.connect(path)
+            try:
+                row = connection.execute('SELECT document FROM state WHERE id = 1').fetchone()
+            except sqlite3.OperationalError:
+                row = None
+            finally:
+                connection.close()
+            return json.loads(row[0]) if row else None
+        with open(path) as f:
+            if backend == 'json':
+                return json.load(f)
+            return yaml.load(f, Loader=YamlLoader)
+
+    # Writing
+
+    @contextmanager
+    def batch(self) -> Iterator[Dict[str, Any]]:
+        """
+        Yields the document for modification. Changes are written once, when the outermost batch
+        exits (including when it exits because of an error or CTRL-C, so completed work is kept).
+        The calling thread has the document to itself until its batch exits; a batch opened by another
+        thread waits for it, so keep batches short and do not wait on other threads inside one.
+        """
+        with self._mutex, self.deferred():
+            document = self.data
+            self._dirty = True
+            yield document
+
+    @contextmanager
+    def deferred(self) -> Iterator[None]:
+        """
+        Holds back the writes of every batch (from any thread) opened while it is open, so they are
+        written once, when it exits. Unlike batch it does not lock the document, so it can wrap work
+        spread over several threads.
+        """
+        with self._mutex:
+            if self._depth == 0:
+                self._acquire_lock()
+            self._depth += 1
+        try:
+            yield
+        finally:
+            with self._mutex:
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        self.commit()
+                    finally:
+                        self._release_lock()
+
+    def create(self) -> None:
+        """
+        Writes the default document if there is no state file yet.
+        """
+        with self._mutex, self.deferred():
+            if not self.exists():
+                self._data = self.default()
+                self._dirty = True
+
+    def commit(self) -> None:
+        with self._mutex:
+            if self._dirty and self._data is not None:
+                self._write(self._data)
+                self._loaded_key = self._file_key()
+            self._dirty = False
+
+    def _write(self, document: Dict[str, Any]) -> None:
+        if self.backend == 'sqlite':
+            # SQLite commits atomically on its own
+            connection = sqlite3.connect(self.path)
+            try:
+                with connection:
+                    connection.execute('CREATE TABLE IF NOT EXISTS state (id INTEGER PRIMARY KEY, document TEXT)')
+                    connection.execute('INSERT OR REPLACE INTO state (id, document) VALUES (1, ?)',
+                                        (json.dumps(document),))
+            finally:
+                connection.close()
+            return
+        fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(self.path) + '.', suffix='.tmp',
+                                         dir=os.path.dirname(self.path))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                if self.backend == 'json':
+                    json.dump(document, f, separators=(',', ':'))
+                else:
+                    yaml.dump(document, f, Dumper=YamlDumper)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def _acquire_lock(self) -> None:
+        if fcntl is None:
+            return
+        self._lock_file = open(self.lock_path, 'a')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+
+    def _release_lock(self) -> None:
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+
+
+def get_store(root_loc: str, name: str, default: Callable[[], Dict[str, Any]]) -> StateStore:
+    """
+    Returns the shared store for the named state file, creating it on first use.
+    """
+    key = os.path.join(root_loc, name)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None or store.backend != selected_backend():
+            store = StateStore(root_loc, name, default)
+            _stores[key] = store
+        return store
+
+
+def commodities_store(root_loc: str) -> StateStore:
+    return get_store(root_loc, '.commodities', lambda: {'version': '2', 'commodities': [], 'applications': {}})
+
+
+def custom_provision_store(root_loc: str) -> StateStore:
+    return get_store(root_loc, '.custom_provision', lambda: {'version': '1', 'applications': []})
@@ -1,31 +1,66 @@
 import os
+import re
 import time
+import hashlib
 import threading
 import queue
-import yaml
-from typing import Dict, Any, List
+from typing import Callable, Dict, Any, List, Optional, Tuple
+from scripts.environment import Environment, load_environment
+from scripts.git_metadata import head_info, ref_sha
+from scripts.state_store import StateStore, get_store
 from scripts.utilities import (
     colorize_lightblue,
     colorize_red,
     colorize_yellow,
     colorize_green,
-    run_command)
+    run_command,
+    run_command_noshell)
 
-THREAD_COUNT = 3
+MAX_AUTO_THREADS = 16
+# One lock per cache mirror, so two apps cloned from the same repo do not update it at the same time
+_mirror_locks: Dict[str, threading.Lock] = {}
+_mirror_locks_mutex = threading.Lock()
+# Matches git's final transfer progress line, e.g. "Receiving objects: 100% (120/120), 1.20 MiB | 2.00 MiB/s, done."
+TRANSFER_PATTERN = re.compile(r'(?:Receiving|Unpacking) objects: +100% \(\d+/\d+\), ([\d.]+) (bytes|KiB|MiB|GiB)')
+# An intermediate progress redraw, e.g. "remote: Counting objects:  66% (2/3)"
+PROGRESS_PATTERN = re.compile(r'^(?:remote: )?[\w ]+: +\d+% \(\d+/\d+\)')
+UNIT_BYTES = {'bytes': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3}
 
-def update_apps(root_loc: str) -> None:
+def timings_store(root_loc: str) -> StateStore:
+    return get_store(root_loc, '.update-timings', lambda: {'version': '1', 'applications': {}})
+
+def thread_count(environment: Environment, app_count: int) -> int:
+    """
+    Returns the number of update workers: DEV_ENV_UPDATE_THREADS or the update-threads key of the
+    dev-env-config if set, otherwise sized from the CPU count (git work is mostly waiting on the network).
     """
-    Updates or clones all applications defined in configuration.yml using threads.
+    configured = os.environ.get('DEV_ENV_UPDATE_THREADS', environment.config.get('update-threads'))
+    try:
+        count = int(configured)
+    except (TypeError, ValueError):
+        count = min(MAX_AUTO_THREADS, (os.cpu_count() or 2) * 2)
+    return max(1, min(count, app_count))
+
+def update_apps(root_loc: str, force_fetch: bool = False,
+                on_app_updated: Optional[Callable[[str], None]] = None) -> None:
     """
-    config_path = os.path.join(root_loc, 'dev-env-config', 'configuration.yml')
-    with open(config_path) as f:
-        config: Dict[str, Any] = yaml.safe_load(f)
-    if not config or 'applications' not in config:
+    Updates or clones all applications defined in configuration.yml using threads,
+    starting with the apps that took longest last time. Fetches are skipped for apps whose
+    remote has not changed, unless force_fetch is set. on_app_updated, if given, is called
+    (from a worker thread) with each app's name as soon as that app is done.
+    """
+    environment = load_environment(root_loc)
+    if environment is None or not environment.apps:
         return
 
+    store = timings_store(root_loc)
+    previous = store.data.get('applications', {})
+    workers = thread_count(environment, len(environment.apps))
     output_mutex = threading.Lock()
     q = queue.Queue()
     threads = []
+    results: Dict[str, Dict[str, Any]] = {}
+    started = time.monotonic()
 
     def worker():
         while True:
@@ -33,47 +68,99 @@ def update_apps(root_loc: str) -> None:
             if queue_item is None:
                 break
             appname, appconfig = queue_item
-            output_lines = [colorize_green(f"================== {appname} ==================")]
-            output_lines += update_or_clone(appconfig, root_loc, appname)
-            with output_mutex:
-                for line in output_lines:
-                    print(line)
-            q.task_done()
-
-    for _ in range(THREAD_COUNT):
+            try:
+                app_started = time.monotonic()
+                raw_lines = update_or_clone(appconfig, root_loc, appname, force_fetch)
+                elapsed = time.monotonic() - app_started
+                output_lines = [colorize_green(f"================== {appname} ==================")]
+                output_lines += tidy_progress(raw_lines)
+                with output_mutex:
+                    results[appname] = {'seconds': round(elapsed, 2), 'bytes': fetched_bytes(raw_lines)}
+                    for line in output_lines:
+                        print(line)
+                if on_app_updated is not None:
+                    on_app_updated(appname)
+            except Exception as e:
+                # One broken app must not take its worker down with it, or q.join() never returns
+                with output_mutex:
+                    print(colorize_red(f"Updating {appname} failed: {e!r}"))
+            finally:
+                q.task_done()
+
+    for _ in range(workers):
         t = threading.Thread(target=worker)
         t.start()
         threads.append(t)
 
-    populate_queue(config, q)
-    q.join()
-    for _ in range(THREAD_COUNT):
-        q.put(None)
-    for t in threads:
-        t.join()
+    # Remote tips seen by the workers are written once, at the end
+    with freshness_store(root_loc).deferred():
+        populate_queue(environment, q, previous)
+        q.join()
+        for _ in range(workers):
+            q.put(None)
+        for t in threads:
+            t.join()
+
+    with store.batch() as timings:
+        timings.setdefault('applications', {}).update(results)
+    print_summary(results, time.monotonic() - started, workers)
+
+def populate_queue(environment: Environment, q: queue.Queue, previous: Dict[str, Dict[str, Any]]) -> None:
+    """
+    Queues the apps longest-expected-first, so the slowest repos are not left until the end.
+    Apps with no recorded duration (usually still to be cloned) go first.
+    """
+    def expected_seconds(appname: str) -> float:
+        return previous.get(appname, {}).get('seconds', float('inf'))
+
+    for appname in sorted(environment.apps, key=expected_seconds, reverse=True):
+        q.put((appname, environment.apps[appname].settings))
 
-def populate_queue(config: Dict[str, Any], q: queue.Queue) -> None:
-    for appname, appconfig in config['applications'].items():
-        q.put((appname, appconfig))
+def fetched_bytes(output_lines: List[str]) -> int:
+    """
+    Returns the number of bytes git reported transferring, from its --progress output.
+    """
+    total = 0
+    for line in output_lines:
+        # Only the final (", done.") redraw of each transfer is counted
+        match = TRANSFER_PATTERN.search(line)
+        if match and line.rstrip().endswith('done.'):
+            total += int(float(match.group(1)) * UNIT_BYTES[match.group(2)])
+    return total
+
+def tidy_progress(output_lines: List[str]) -> List[str]:
+    """
+    Drops git's intermediate progress redraws, keeping each counter's final ", done." line.
+    """
+    return [line for line in output_lines
+            if not PROGRESS_PATTERN.match(line) or line.rstrip().endswith('done.')]
+
+def human_bytes(count: int) -> str:
+    for unit in ('bytes', 'KiB', 'MiB'):
+        if count < 1024:
+            return f"{count:.0f} {unit}" if unit == 'bytes' else f"{count:.1f} {unit}"
+        count /= 1024
+    return f"{count:.1f} GiB"
+
+def print_summary(results: Dict[str, Dict[str, Any]], wall_time: float, workers: int) -> None:
+    print(colorize_lightblue(f"Updated {len(results)} apps in {wall_time:.1f}s using {workers} workers:"))
+    for appname, result in sorted(results.items(), key=lambda item: -item[1]['seconds']):
+        print(colorize_lightblue(f"  {appname:<40} {result['seconds']:>7.1f}s  {human_bytes(result['bytes']):>10}"))
 
 def required_ref(appconfig: Dict[str, Any]) -> str:
     return appconfig.get('ref', appconfig.get('branch'))
 
-def update_or_clone(appconfig: Dict[str, Any], root_loc: str, appname: str) -> List[str]:
+def update_or_clone(appconfig: Dict[str, Any], root_loc: str, appname: str, force_fetch: bool = False) -> List[str]:
     if appconfig.get('repo') == 'none':
         return [colorize_lightblue('This app is local-only; skipping')]
     app_path = os.path.join(root_loc, 'apps', appname)
     if os.path.isdir(app_path):
-        return update_app(appconfig, root_loc, appname)
+        return update_app(appconfig, root_loc, appname, force_fetch)
     else:
         return clone_app(appconfig, root_loc, appname)
 
 def current_branch(root_loc: str, appname: str) -> str:
-    app_path = os.path.join(root_loc, 'apps', appname)
-    result = os.popen(f"git -C {app_path} rev-parse --abbrev-ref HEAD").read().strip()
-    if result == 'HEAD':
-        return 'detached'
-    return result
+    return head_info(os.path.join(root_loc, 'apps', appname)).branch or 'detached'
 
 def merge(root_loc: str, appname: str) -> List[str]:
     if current_branch(root_loc, appname) == 'detached':
@@ -86,7 +173,57 @@ def merge(root_loc: str, appname: str) -> List[str]:
         ))
     return output_lines
 
-def update_app(appconfig: Dict[str, Any], root_loc: str, appname: str) -> List[str]:
+def freshness_store(root_loc: str) -> StateStore:
+    return get_store(root_loc, '.remote-freshness', lambda: {'version': '1', 'applications': {}})
+
+def fetch_ttl(root_loc: str) -> float:
+    """
+    Returns how many seconds a remote tip seen by an earlier run is trusted without asking the remote again,
+    from DEV_ENV_FETCH_TTL or the fetch-ttl key of the dev-env-config. Defaults to 0 (always ask).
+    """
+    environment = load_environment(root_loc)
+    configured = os.environ.get('DEV_ENV_FETCH_TTL', environment.config.get('fetch-ttl') if environment else None)
+    try:
+        return max(0.0, float(configured))
+    except (TypeError, ValueError):
+        return 0.0
+
+def tracking_sha(app_path: str, branch: str) -> Optional[str]:
+    return ref_sha(app_path, f'refs/remotes/origin/{branch}')
+
+def remote_sha(app_path: str, branch: str) -> Optional[str]:
+    output_lines: List[str] = []
+    if run_command_noshell(['git', '-C', app_path, 'ls-remote', 'origin', f'refs/heads/{branch}'], output_lines) != 0:
+        return None
+    for line in output_lines:
+        parts = line.split()
+        if len(parts) == 2 and parts[1] == f'refs/heads/{branch}':
+            return parts[0]
+    return None
+
+def record_remote_tip(root_loc: str, appname: str, sha: Optional[str]) -> None:
+    if sha:
+        with freshness_store(root_loc).batch() as freshness:
+            freshness.setdefault('applications', {})[appname] = {'sha': sha, 'checked': time.time()}
+
+def remote_unchanged(root_loc: str, appname: str, app_path: str, branch: str) -> Tuple[bool, str]:
+    """
+    Returns (True, reason) if origin's tip of branch is already our remote-tracking ref, so the fetch can be
+    skipped. A tip recorded within the TTL is trusted without contacting the remote at all.
+    """
+    local = tracking_sha(app_path, branch)
+    if local is None:
+        return False, ''
+    recorded = freshness_store(root_loc).data.get('applications', {}).get(appname)
+    if recorded and recorded.get('sha') == local and time.time() - recorded.get('checked', 0) < fetch_ttl(root_loc):
+        return True, 'checked recently'
+    remote = remote_sha(app_path, branch)
+    if remote is None:
+        return False, ''
+    record_remote_tip(root_loc, appname, remote)
+    return remote == local, 'remote unchanged'
+
+def update_app(appconfig: Dict[str, Any], root_loc: str, appname: str, force_fetch: bool = False) -> List[str]:
     output_lines: List[str] = []
     branch = current_branch(root_loc, appname)
     if branch == 'detached':
@@ -99,7 +236,15 @@ def update_app(appconfig: Dict[str, Any], root_loc: str, appname: str) -> List[s
         ))
         return output_lines
     app_path = os.path.join(root_loc, 'apps', appname)
-    if run_command(f"git -C {app_path} fetch origin", output_lines) == 0:
+    if not force_fetch:
+        unchanged, reason = remote_unchanged(root_loc, appname, app_path, branch)
+        if unchanged:
+            output_lines.append(colorize_lightblue(f"origin/{branch} is up to date ({reason}); skipping fetch"))
+            # The local branch may still be behind a previous fetch
+            output_lines += merge(root_loc, appname)
+            return output_lines
+    if run_command(f"git -C {app_path} fetch --progress origin", output_lines) == 0:
+        record_remote_tip(root_loc, appname, tracking_sha(app_path, branch))
         output_lines += merge(root_loc, appname)
         return output_lines
     output_lines.append(colorize_red(f"Error while updating {appname}"))
@@ -107,12 +252,67 @@ def update_app(appconfig: Dict[str, Any], root_loc: str, appname: str) -> List[s
     time.sleep(3)
     return output_lines
 
+def clone_options(appconfig: Dict[str, Any], root_loc: str) -> Dict[str, Any]:
+    """
+    Returns the app's clone settings: the `clone` key of its dev-env-config entry, e.g.
+        clone:
+          cache: true          # borrow objects from a shared local mirror (default: true if a cache dir is set)
+          filter: blob:none    # partial clone
+          depth: 1             # shallow clone
+    The cache directory comes from DEV_ENV_GIT_CACHE or the git-cache-dir key of the dev-env-config.
+    """
+    options = dict(appconfig.get('clone') or {})
+    environment = load_environment(root_loc)
+    cache_dir = os.environ.get('DEV_ENV_GIT_CACHE') or (environment.config.get('git-cache-dir') if environment else None)
+    if cache_dir and options.get('cache', True):
+        options['cache_dir'] = os.path.normpath(os.path.join(root_loc, os.path.expanduser(cache_dir)))
+    return options
+
+def mirror_path(cache_dir: str, repo: str) -> str:
+    name = re.sub(r'\.git$', '', repo.rstrip('/').split('/')[-1].split(':')[-1])
+    readable = re.sub(r'[^A-Za-z0-9._-]+', '_', name)
+    digest = hashlib.sha1(repo.encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, f"{readable}-{digest}.git")
+
+def update_mirror(cache_dir: str, repo: str, output_lines: List[str]) -> Optional[str]:
+    """
+    Creates or refreshes the bare mirror of repo in the cache and returns its path (None on failure).
+    """
+    path = mirror_path(cache_dir, repo)
+    with _mirror_locks_mutex:
+        lock = _mirror_locks.setdefault(path, threading.Lock())
+    with lock:
+        if os.path.isdir(path):
+            outcode = run_command_noshell(['git', '-C', path, 'fetch', '--prune', '--progress', 'origin'], output_lines)
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+            outcode = run_command_noshell(['git', 'clone', '--mirror', '--progress', repo, path], output_lines)
+    if outcode != 0:
+        output_lines.append(colorize_yellow(f"Could not update the local object cache for {repo}; cloning without it"))
+        return None
+    return path
+
+def clone_command(appconfig: Dict[str, Any], root_loc: str, app_path: str, output_lines: List[str]) -> List[str]:
+    repo = appconfig['repo']
+    options = clone_options(appconfig, root_loc)
+    cmd = ['git', 'clone', '--progress']
+    if options.get('cache_dir'):
+        mirror = update_mirror(options['cache_dir'], repo, output_lines)
+        if mirror:
+            # Objects are borrowed from the mirror via alternates, so the cache must not be deleted
+            cmd += ['--reference-if-able', mirror]
+    if options.get('filter'):
+        cmd.append(f"--filter={options['filter']}")
+    if options.get('depth'):
+        # Keep every branch tip so the configured ref can still be checked out
+        cmd += ['--depth', str(options['depth']), '--no-single-branch']
+    return cmd + [repo, app_path]
+
 def clone_app(appconfig: Dict[str, Any], root_loc: str, appname: str) -> List[str]:
     output_lines: List[str] = []
     output_lines.append(colorize_lightblue(f"{appname} does not yet exist; cloning"))
-    repo = appconfig['repo']
     app_path = os.path.join(root_loc, 'apps', appname)
-    if run_command(f"git clone {repo} {app_path}", output_lines) != 0:
+    if run_command_noshell(clone_command(appconfig, root_loc, app_path, output_lines), output_lines) != 0:
         output_lines.append(colorize_red(f"Error while cloning {appname}"))
         output_lines.append(colorize_yellow('Continuing in 3 seconds...'))
         time.sleep(3)
@@ -1,8 +1,9 @@
 import os
 import sys
 import time
-import subprocess
+from collections import deque
 from typing import List, Optional
+from scripts.process_runner import run_process
 
 def colorize_lightblue(msg: str) -> str:
     return f"\033[36m{msg}\033[0m"
@@ -23,33 +24,13 @@ def run_command(cmd: str, output_lines: Optional[List[str]] = None, input_lines:
     """
     Runs a shell command, optionally piping input and collecting output.
     """
-    process = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-    if input_lines is not None:
-        process.stdin.write(input_lines)
-        process.stdin.close()
-    for line in process.stdout:
-        if output_lines is None:
-            print(line, end='')
-        else:
-            output_lines.append(line.rstrip('\n'))
-    process.wait()
-    return process.returncode
+    return run_process(cmd, print if output_lines is None else output_lines.append, input_text=input_lines).exit_code
 
 def run_command_noshell(cmd: List[str], output_lines: Optional[List[str]] = None, input_lines: Optional[str] = None) -> int:
     """
     Runs a command without shell, optionally piping input and collecting output.
     """
-    process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-    if input_lines is not None:
-        process.stdin.write(input_lines)
-        process.stdin.close()
-    for line in process.stdout:
-        if output_lines is None:
-            print(line, end='')
-        else:
-            output_lines.append(line.rstrip('\n'))
-    process.wait()
-    return process.returncode
+    return run_process(cmd, print if output_lines is None else output_lines.append, input_text=input_lines).exit_code
 
 def fail_and_exit(new_project: bool, DEV_ENV_CONTEXT_FILE: str, DEV_ENV_CONFIG_DIR: str) -> None:
     print(colorize_red('Something went wrong when cloning/pulling the dev-env configuration project. Check your URL?'))
@@ -66,5 +47,22 @@ def fail_and_exit(new_project: bool, DEV_ENV_CONTEXT_FILE: str, DEV_ENV_CONFIG_D
         print(colorize_yellow('Continuing in 3 seconds...'))
         time.sleep(3)
 
+def force_requested(force: bool) -> bool:
+    """
+    Returns True if provisioning is forced, by --force-provision (force) or DEV_ENV_FORCE_PROVISION.
+    """
+    return force or os.environ.get('DEV_ENV_FORCE_PROVISION', '').lower() in ('1', 'true', 'yes', 'on')
+
 def check_healthy_output(command_output: List[str]) -> bool:
     return any(ln.startswith('"healthy"') for ln in command_output)
+
+def print_log_tail(log_path: str, lines: int = 10) -> None:
+    """
+    Prints the last lines of a log file, or a note if it was never written (e.g. a build that failed before it started).
+    """
+    try:
+        with open(log_path, errors='replace') as f:
+            for line in deque(f, maxlen=lines):
+                print(line, end='')
+    except FileNotFoundError:
+        print(colorize_yellow(f"(no log was written to {log_path})"))
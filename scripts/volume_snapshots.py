@@ -0,0 +1,146 @@
+import os
+import json
+import asyncio
+import hashlib
+import subprocess
+from typing import Any, Dict, Optional, Tuple
+from scripts.async_commands import capture_async
+from scripts.docker_api import DockerAPIError, docker_client
+from scripts.environment import load_environment
+from scripts.utilities import colorize_lightblue, colorize_yellow
+
+SNAPSHOT_DIR = '.volume-snapshots'
+# Snapshots kept per container (older ones are deleted when a new one is saved)
+SNAPSHOT_KEEP = 2
+DEFAULT_DATA_DIR = '/var/lib/postgresql/data'
+
+
+def snapshots_enabled(root_loc: str) -> bool:
+    """
+    Returns whether provisioned data volumes are snapshotted and restored, from DEV_ENV_VOLUME_SNAPSHOTS or
+    the volume-snapshots key of the dev-env-config. Enabled by default.
+    """
+    configured = os.environ.get('DEV_ENV_VOLUME_SNAPSHOTS')
+    if configured is not None:
+        return configured.lower() not in ('0', 'false', 'no', 'off')
+    environment = load_environment(root_loc)
+    return environment is None or environment.config.get('volume-snapshots', True) is not False
+
+
+def snapshot_key(image_id: str, fragments: Dict[str, str]) -> str:
+    """
+    Returns the cache key for a data volume: the container's image plus the digest of every init fragment
+    applied to it (app -> digest).
+    """
+    digest = hashlib.sha256(image_id.encode())
+    digest.update(json.dumps(sorted(fragments.items())).encode())
+    return digest.hexdigest()[:32]
+
+
+def snapshot_path(root_loc: str, container: str, key: str) -> str:
+    return os.path.join(root_loc, SNAPSHOT_DIR, container, f'{key}.tar.gz')
+
+
+def inspect_container(container: str) -> Optional[Dict[str, Any]]:
+    client = docker_client()
+    if client is not None:
+        try:
+            return client.inspect(container)
+        except DockerAPIError:
+            pass
+    result = subprocess.run(['docker', 'inspect', '--type', 'container', container],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    if result.returncode != 0:
+        return None
+    documents = json.loads(result.stdout or '[]')
+    return documents[0] if documents else None
+
+
+def data_volume(document: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+    """
+    Returns (image ID, volume name) for a container whose data directory (PGDATA) is a named volume,
+    or None if it is not (bind mounts and container-local data are never snapshotted).
+    """
+    data_dir = DEFAULT_DATA_DIR
+    for variable in (document.get('Config') or {}).get('Env') or []:
+        if variable.startswith('PGDATA='):
+            data_dir = variable[len('PGDATA='):]
+    for mount in document.get('Mounts') or []:
+        # PGDATA may be a subdirectory of the mounted volume
+        destination = mount.get('Destination', '').rstrip('/')
+        if mount.get('Type') == 'volume' and (data_dir == destination or data_dir.startswith(destination + '/')):
+            return document.get('Image', ''), mount['Name']
+    return None
+
+
+async def snapshot_target(root_loc: str, container: str, fragments: Dict[str, str]) -> Optional[Tuple[str, str, str]]:
+    """
+    Returns (key, image ID, volume name) for the container's desired state, or None if snapshots are
+    disabled or the container's data is not in a named volume.
+    """
+    if not snapshots_enabled(root_loc):
+        return None
+    document = await asyncio.to_thread(inspect_container, container)
+    target = data_volume(document) if document else None
+    if target is None:
+        return None
+    image_id, volume = target
+    return snapshot_key(image_id, fragments), image_id, volume
+
+
+async def restore_volume(root_loc: str, container: str, key: str, image_id: str, volume: str) -> bool:
+    """
+    Replaces the contents of the (stopped) container's data volume with the snapshot for key, if there
+    is one. Returns True if the volume was restored.
+    """
+    path = snapshot_path(root_loc, container, key)
+    if not os.path.exists(path):
+        return False
+    print(colorize_lightblue(f"Restoring {container} data from snapshot {key[:12]}"))
+    # The container's own image provides tar, so nothing extra is pulled
+    code, output = await capture_async([
+        'docker', 'run', '--rm', '--entrypoint', 'sh',
+        '-v', f'{volume}:/data', '-v', f'{os.path.dirname(path)}:/backup:ro', image_id,
+        '-c', f'find /data -mindepth 1 -delete && tar --numeric-owner -xzpf /backup/{key}.tar.gz -C /data',
+    ])
+    if code != 0:
+        print(colorize_yellow(f"Could not restore the {container} snapshot; provisioning from the init fragments"))
+        for line in output[-10:]:
+            print(line)
+        return False
+    os.utime(path)
+    return True
+
+
+async def save_volume(root_loc: str, container: str, key: str, image_id: str, volume: str) -> bool:
+    """
+    Archives the (stopped) container's data volume as the snapshot for key. Returns True on success.
+    """
+    path = snapshot_path(root_loc, container, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_name = f'{key}.tar.gz.tmp'
+    print(colorize_lightblue(f"Saving a snapshot of the provisioned {container} data ({key[:12]})"))
+    code, output = await capture_async([
+        'docker', 'run', '--rm', '--entrypoint', 'tar',
+        '-v', f'{volume}:/data:ro', '-v', f'{os.path.dirname(path)}:/backup', image_id,
+        '--numeric-owner', '-czpf', f'/backup/{temp_name}', '-C', '/data', '.',
+    ])
+    temp_path = os.path.join(os.path.dirname(path), temp_name)
+    if code != 0:
+        print(colorize_yellow(f"Could not save a snapshot of {container}"))
+        for line in output[-10:]:
+            print(line)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+    os.replace(temp_path, path)
+    prune_snapshots(os.path.dirname(path))
+    return True
+
+
+def prune_snapshots(directory: str) -> None:
+    snapshots = sorted(
+        (entry for entry in os.scandir(directory) if entry.name.endswith('.tar.gz')),
+        key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in snapshots[SNAPSHOT_KEEP:]:
+        os.remove(entry.path)
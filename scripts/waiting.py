@@ -0,0 +1,79 @@
+import time
+import random
+from dataclasses import dataclass
+from typing import Callable, Iterator, Optional
+
+
+@dataclass(frozen=True)
+class Backoff:
+    """
+    Poll intervals that start short and grow exponentially up to `maximum`, each randomised by
+    +/- `jitter` (a fraction) so that many waiters do not poll in lockstep.
+    """
+    initial: float = 0.25
+    maximum: float = 5.0
+    factor: float = 2.0
+    jitter: float = 0.2
+
+    def delays(self) -> Iterator[float]:
+        delay = self.initial
+        while True:
+            yield max(0.0, delay * random.uniform(1 - self.jitter, 1 + self.jitter))
+            delay = min(self.maximum, delay * self.factor)
+
+
+class Deadline:
+    """
+    A point in time after which waiting should stop. A timeout of None never expires.
+    """
+
+    def __init__(self, timeout: Optional[float]):
+        self.timeout = timeout
+        self.started = time.monotonic()
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    @property
+    def remaining(self) -> Optional[float]:
+        if self.timeout is None:
+            return None
+        return max(0.0, self.timeout - self.elapsed)
+
+    @property
+    def expired(self) -> bool:
+        return self.timeout is not None and self.elapsed >= self.timeout
+
+    def cap(self, delay: float) -> float:
+        remaining = self.remaining
+        return delay if remaining is None else min(delay, remaining)
+
+
+def pause(delay: float, watcher=None, since: Optional[int] = None) -> None:
+    """
+    Sleeps for delay seconds, or less if the health watcher sees a container event after generation `since`.
+    """
+    if watcher is not None and since is not None:
+        watcher.wait(since, delay)
+    else:
+        time.sleep(delay)
+
+
+def wait_until(check: Callable[[], bool], timeout: Optional[float], backoff: Backoff = Backoff(),
+               watcher=None, on_wait: Optional[Callable[[], None]] = None) -> bool:
+    """
+    Calls check until it returns True (returns True) or the timeout passes (returns False).
+    Between checks it backs off exponentially; with a health watcher, a container event ends the wait early.
+    """
+    deadline = Deadline(timeout)
+    delays = backoff.delays()
+    while True:
+        since = watcher.generation if watcher is not None else None
+        if check():
+            return True
+        if deadline.expired:
+            return False
+        if on_wait is not None:
+            on_wait()
+        pause(deadline.cap(next(delays)), watcher, since)
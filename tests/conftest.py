@@ -0,0 +1,41 @@
+import os
+import sys
+import stat
+import textwrap
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def write_executable(path: str, source: str) -> str:
+    """
+    Writes a Python script that stands in for a command-line tool.
+    """
+    with open(path, 'w') as f:
+        f.write(f'#!{sys.executable}\n' + textwrap.dedent(source))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+@pytest.fixture
+def fake_bin(tmp_path, monkeypatch):
+    """
+    A directory at the front of PATH for fake executables (e.g. `docker`), written with fake_bin.add(name, source).
+    The Docker Engine API is disabled so the CLI is always used.
+    """
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv('DEV_ENV_DOCKER_BACKEND', 'cli')
+
+    class FakeBin:
+        path = str(bin_dir)
+
+        @staticmethod
+        def add(name: str, source: str) -> str:
+            return write_executable(str(bin_dir / name), source)
+
+    return FakeBin()
@@ -0,0 +1,73 @@
+import os
+import shutil
+
+import pytest
+
+from scripts.app_index import _index_cache, app_index
+
+
+@pytest.fixture
+def root_loc(tmp_path):
+    """
+    Two apps: web with a compose fragment and a variant, api with no fragments directory.
+    """
+    fragments = tmp_path / 'apps' / 'web' / 'fragments'
+    fragments.mkdir(parents=True)
+    (fragments / 'compose-fragment.yml').write_text('services: {}\n')
+    (fragments / 'compose-fragment.test.yml').write_text('services: {}\n')
+    (tmp_path / 'apps' / 'web' / 'configuration.yml').write_text('{}\n')
+    (tmp_path / 'apps' / 'api').mkdir()
+    yield str(tmp_path)
+    _index_cache.pop(str(tmp_path), None)
+
+
+def test_the_index_is_reused_while_nothing_changes(root_loc):
+    index = app_index(root_loc)
+    assert sorted(index.apps) == ['api', 'web']
+    assert index.app('web').variants == {'test': os.path.join(root_loc, 'apps', 'web', 'fragments', 'compose-fragment.test.yml')}
+
+    # Editing a file does not change what exists, so the index stands
+    with open(os.path.join(root_loc, 'apps', 'web', 'fragments', 'compose-fragment.yml'), 'a') as f:
+        f.write('# edited\n')
+    assert app_index(root_loc) is index
+
+
+def test_a_new_fragment_is_picked_up(root_loc):
+    app_index(root_loc)
+    path = os.path.join(root_loc, 'apps', 'web', 'fragments', 'postgres-init-fragment.sql')
+    open(path, 'w').close()
+    assert app_index(root_loc).app('web').fragment('postgres-init') == path
+
+
+def test_a_removed_fragment_is_dropped(root_loc):
+    app_index(root_loc)
+    os.remove(os.path.join(root_loc, 'apps', 'web', 'fragments', 'compose-fragment.test.yml'))
+    assert app_index(root_loc).app('web').variants == {}
+
+
+def test_a_new_fragments_directory_is_picked_up(root_loc):
+    assert app_index(root_loc).app('api').fragments == {}
+    os.makedirs(os.path.join(root_loc, 'apps', 'api', 'fragments'))
+    path = os.path.join(root_loc, 'apps', 'api', 'fragments', 'compose-fragment.yml')
+    open(path, 'w').close()
+    assert app_index(root_loc).app('api').fragment('compose') == path
+
+
+def test_a_new_configuration_file_is_picked_up(root_loc):
+    assert app_index(root_loc).app('api').config is None
+    open(os.path.join(root_loc, 'apps', 'api', 'configuration.yml'), 'w').close()
+    assert app_index(root_loc).app('api').config == os.path.join(root_loc, 'apps', 'api', 'configuration.yml')
+
+
+def test_added_and_removed_apps_are_picked_up(root_loc):
+    app_index(root_loc)
+    shutil.rmtree(os.path.join(root_loc, 'apps', 'api'))
+    os.makedirs(os.path.join(root_loc, 'apps', 'worker'))
+    assert sorted(app_index(root_loc).apps) == ['web', 'worker']
+
+
+def test_a_missing_apps_directory_has_no_apps(tmp_path):
+    assert app_index(str(tmp_path)).apps == {}
+    os.makedirs(tmp_path / 'apps' / 'web')
+    assert sorted(app_index(str(tmp_path)).apps) == ['web']
+    _index_cache.pop(str(tmp_path), None)
@@ -0,0 +1,42 @@
+import pytest
+
+from scripts.commodities import fragment_digest, provision_decision, provision_status, \
+    set_commodity_provision_status
+
+FRAGMENT = b'CREATE DATABASE web;\n'
+
+
+@pytest.fixture
+def root_loc(tmp_path):
+    return str(tmp_path)
+
+
+def decide(root_loc, content=FRAGMENT, new_container=False, force=False):
+    return provision_decision(root_loc, 'web', 'postgres-13', content, new_container, force)[0]
+
+
+def test_a_clean_fragment_runs_again_only_when_it_changes(root_loc):
+    assert decide(root_loc)
+    set_commodity_provision_status(root_loc, 'web', 'postgres-13', fragment_digest(FRAGMENT))
+    assert not decide(root_loc)
+    assert not decide(root_loc, force=True)
+    assert decide(root_loc, content=FRAGMENT + b'CREATE USER web;\n')
+    assert decide(root_loc, new_container=True)
+
+
+def test_a_fragment_that_reported_errors_waits_for_a_change_or_force(root_loc):
+    set_commodity_provision_status(root_loc, 'web', 'postgres-13', {'digest': fragment_digest(FRAGMENT), 'errors': True})
+    assert not decide(root_loc)
+    assert decide(root_loc, force=True)
+    assert decide(root_loc, content=FRAGMENT + b'-- fixed\n')
+    assert decide(root_loc, new_container=True)
+
+
+def test_legacy_statuses(root_loc):
+    # False was written for failures before errors were flagged with the digest
+    set_commodity_provision_status(root_loc, 'web', 'postgres-13', False)
+    assert decide(root_loc)
+    # True was written before digests were recorded; the current fragment is assumed to be applied
+    set_commodity_provision_status(root_loc, 'web', 'postgres-13', True)
+    assert not decide(root_loc)
+    assert provision_status(root_loc, 'web', 'postgres-13') == fragment_digest(FRAGMENT)
@@ -0,0 +1,19 @@
+import os
+
+from scripts.delete_env_files import delete_files
+from scripts.state_store import commodities_store
+
+
+def test_a_reset_removes_state_caches_and_volume_snapshots(tmp_path):
+    root_loc = str(tmp_path)
+    with commodities_store(root_loc).batch() as document:
+        document['commodities'] = ['postgres-13']
+    (tmp_path / '.docker-compose-file-list').write_text('')
+    for directory in ('.compose-cache', os.path.join('.volume-snapshots', 'postgres-13')):
+        os.makedirs(tmp_path / directory)
+        (tmp_path / directory / 'file').write_text('')
+    (tmp_path / 'dev-env-config').mkdir()
+
+    delete_files(root_loc)
+
+    assert sorted(os.listdir(root_loc)) == ['dev-env-config']
@@ -0,0 +1,170 @@
+import json
+import struct
+import threading
+import time
+import socketserver
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+import scripts.docker_api as docker_api
+from scripts.container_state import container_snapshot
+from scripts.docker_api import DockerAPIError, DockerClient, demultiplex
+from scripts.image_builds import image_id
+
+CONTAINERS = {
+    'web': {'Name': '/proj-web-1', 'Image': 'sha256:web', 'RestartCount': 2,
+            'State': {'Status': 'running', 'ExitCode': 0, 'Health': {'Status': 'healthy'}},
+            'Config': {'Labels': {'com.docker.compose.service': 'web'}}},
+    'db': {'Name': '/db', 'Image': 'sha256:db', 'State': {'Status': 'exited', 'ExitCode': 3}, 'Config': {}},
+}
+INSPECT_DELAY = 0.3
+
+
+def frame(stream: int, data: bytes) -> bytes:
+    return struct.pack('>BxxxI', stream, len(data)) + data
+
+
+class FakeDaemon(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    uploads = []
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=b'', content_type='application/json'):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/_ping':
+            return self.reply(200, b'OK', 'text/plain')
+        if path.startswith('/containers/') and path.endswith('/json'):
+            name = path.split('/')[2]
+            if name == 'slow':
+                time.sleep(INSPECT_DELAY)
+                return self.reply(200, dict(CONTAINERS['web'], Name='/slow'))
+            if name in CONTAINERS:
+                return self.reply(200, CONTAINERS[name])
+            return self.reply(404, {'message': f'No such container: {name}'})
+        if path == '/images/app/json':
+            return self.reply(200, {'Id': 'sha256:app'})
+        if path.startswith('/images/'):
+            return self.reply(404, {'message': 'No such image'})
+        if path == '/exec/e1/json':
+            return self.reply(200, {'ExitCode': 4})
+        if path.startswith('/containers/') and path.endswith('/logs'):
+            return self.reply(200, frame(1, b'first\n') + frame(2, b'last line\n'), 'application/octet-stream')
+        if path == '/broken':
+            # Drop the connection without answering
+            self.close_connection = True
+            return
+        self.reply(404, {'message': 'unknown path'})
+
+    def do_POST(self):
+        data = self.body()
+        if self.path == '/containers/web/exec':
+            assert json.loads(data)['Cmd'] == ['psql', '-c', 'select 1']
+            return self.reply(201, {'Id': 'e1'})
+        if self.path == '/exec/e1/start':
+            return self.reply(200, frame(1, b'out\n') + frame(2, b'err\n'), 'application/vnd.docker.raw-stream')
+        self.reply(404, {'message': 'unknown path'})
+
+    def do_PUT(self):
+        FakeDaemon.uploads.append((self.path, self.body()))
+        self.reply(200)
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    socket_path = str(tmp_path / 'docker.sock')
+    server = socketserver.ThreadingUnixStreamServer(socket_path, FakeDaemon)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    client = DockerClient(socket_path, timeout=5)
+    FakeDaemon.uploads = []
+    yield client
+    client.close()
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def shared_client(monkeypatch):
+    """
+    Makes docker_client() return the given client, as if it had been found at start-up.
+    """
+    def use(client):
+        monkeypatch.setattr(docker_api, '_client', client)
+        monkeypatch.setattr(docker_api, '_client_checked', True)
+    return use
+
+
+def test_requests_over_the_socket(daemon):
+    assert daemon.ping()
+    assert daemon.inspect('web')['Image'] == 'sha256:web'
+    assert daemon.inspect('missing') is None
+    assert daemon.image_id('app') == 'sha256:app'
+    assert daemon.image_id('nope') is None
+    assert daemon.logs('web') == 'first\nlast line\n'
+    assert daemon.exec('web', ['psql', '-c', 'select 1']) == (4, 'out\nerr\n')
+    daemon.upload_files('web', '/', {'dir/a.sql': b'select 1;'})
+    path, archive = FakeDaemon.uploads[0]
+    assert path == '/containers/web/archive?path=%2F'
+    assert b'dir/a.sql' in archive and b'select 1;' in archive
+
+
+def test_inspect_many_runs_in_parallel_and_skips_missing(daemon):
+    started = time.monotonic()
+    documents = daemon.inspect_many(['slow'] * 4 + ['missing'])
+    elapsed = time.monotonic() - started
+    assert [document['Name'] for document in documents] == ['/slow'] * 4
+    assert elapsed < INSPECT_DELAY * 3
+
+
+def test_transport_errors_raise_docker_api_error(daemon, tmp_path):
+    with pytest.raises(DockerAPIError):
+        daemon._request('GET', '/broken')
+    dead = DockerClient(str(tmp_path / 'missing.sock'), timeout=1)
+    assert not dead.ping()
+    with pytest.raises(DockerAPIError):
+        dead.inspect('web')
+    with pytest.raises(DockerAPIError):
+        dead.exec('web', ['true'])
+
+
+def test_callers_fall_back_to_the_cli_when_the_daemon_goes_away(fake_bin, tmp_path, shared_client):
+    fake_bin.add('docker', f'''
+        import sys, json
+        if sys.argv[1:3] == ['image', 'inspect']:
+            print('sha256:from-cli')
+        elif sys.argv[1] == 'inspect':
+            print(json.dumps([{json.dumps(CONTAINERS['db'])}]))
+    ''')
+    shared_client(DockerClient(str(tmp_path / 'missing.sock'), timeout=1))
+    assert image_id('app') == 'sha256:from-cli'
+    snapshot = container_snapshot(['db'])
+    assert snapshot['db'].status == 'exited' and snapshot['db'].exit_code == 3
+
+
+def test_snapshot_uses_the_api(daemon, shared_client):
+    shared_client(daemon)
+    snapshot = container_snapshot(['web', 'db', 'missing'])
+    assert snapshot.healthy('web') and snapshot['proj-web-1'].restart_count == 2
+    assert snapshot['web'].image == 'sha256:web'
+    assert not snapshot['missing'].exists
+
+
+def test_demultiplex_leaves_tty_output_alone():
+    assert demultiplex(frame(1, b'a') + frame(2, b'b')) == b'ab'
+    assert demultiplex(b'plain output') == b'plain output'
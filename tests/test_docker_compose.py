@@ -0,0 +1,168 @@
+import os
+import json
+
+import pytest
+
+from scripts import commodities, docker_compose
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    """
+    A root fragment in apps/ and an app fragment that pulls in an env_file and extends another file.
+    """
+    monkeypatch.setenv('DC_CMD', 'docker compose')
+    apps = tmp_path / 'apps'
+    (apps / 'web').mkdir(parents=True)
+    (apps / 'root-compose-fragment.yml').write_text('services: {}\n')
+    (apps / 'web' / 'compose-fragment.yml').write_text(
+        'services:\n'
+        '  web:\n'
+        '    env_file: web/web.env\n'
+        '    extends: {file: base.yml, service: base}\n')
+    (apps / 'web' / 'base.yml').write_text(
+        'services:\n'
+        '  base:\n'
+        '    env_file: [{path: web/base.env, required: false}]\n')
+    (apps / 'web' / 'web.env').write_text('A=1\n')
+    return {'root': str(tmp_path),
+            'fragments': [str(apps / 'root-compose-fragment.yml'), str(apps / 'web' / 'compose-fragment.yml')]}
+
+
+@pytest.fixture
+def fake_compose(fake_bin, tmp_path):
+    """
+    A `docker` whose `compose ... config` prints a one-service file, recording each call's arguments.
+    """
+    calls = tmp_path / 'calls.jsonl'
+    fake_bin.add('docker', f'''
+        import sys, json
+        with open({str(calls)!r}, 'a') as f:
+            f.write(json.dumps(sys.argv[1:]) + '\\n')
+        print('name: apps')
+        print('services:')
+        print('  web:')
+        print('    image: web')
+    ''')
+
+    def read_calls():
+        return [json.loads(line) for line in calls.read_text().splitlines()] if calls.exists() else []
+    return read_calls
+
+
+def test_referenced_files_follow_env_file_and_extends(project):
+    apps = os.path.join(project['root'], 'apps')
+    assert docker_compose.referenced_files(project['fragments']) == [
+        os.path.join(apps, '.env'),
+        os.path.join(apps, 'web', 'web.env'),
+        os.path.join(apps, 'web', 'base.yml'),
+        os.path.join(apps, 'web', 'base.env'),
+    ]
+
+
+def test_merge_passes_the_project_directory(project, fake_compose):
+    referenced = docker_compose.referenced_files(project['fragments'])
+
+    merged = docker_compose.merged_compose_file(project['root'], project['fragments'], referenced)
+
+    assert merged is not None
+    [call] = fake_compose()
+    assert call[:3] == ['compose', '--project-directory', os.path.join(project['root'], 'apps')]
+    with open(docker_compose.services_path(merged)) as f:
+        assert f.read() == 'web\n'
+
+
+def test_changing_a_referenced_file_re_merges(project, fake_compose):
+    fragments = project['fragments']
+    first = docker_compose.merged_compose_file(project['root'], fragments, docker_compose.referenced_files(fragments))
+    again = docker_compose.merged_compose_file(project['root'], fragments, docker_compose.referenced_files(fragments))
+    assert again == first
+    assert len(fake_compose()) == 1
+
+    with open(os.path.join(project['root'], 'apps', 'web', 'web.env'), 'a') as f:
+        f.write('B=2\n')
+    changed = docker_compose.merged_compose_file(project['root'], fragments, docker_compose.referenced_files(fragments))
+    assert changed != first
+    assert len(fake_compose()) == 2
+
+
+def test_the_project_env_file_is_visible_next_to_the_merged_file(project, fake_compose):
+    env_path = os.path.join(project['root'], 'apps', '.env')
+    with open(env_path, 'w') as f:
+        f.write('TAG=1\n')
+    fragments = project['fragments']
+
+    merged = docker_compose.merged_compose_file(project['root'], fragments, docker_compose.referenced_files(fragments))
+
+    with open(os.path.join(os.path.dirname(merged), '.env')) as f:
+        assert f.read() == 'TAG=1\n'
+    os.remove(env_path)
+    docker_compose.merged_compose_file(project['root'], fragments, docker_compose.referenced_files(fragments))
+    assert not os.path.lexists(os.path.join(os.path.dirname(merged), '.env'))
+
+
+@pytest.fixture
+def environment(tmp_path, monkeypatch):
+    """
+    A dev-env with one app whose compose fragment pulls in an env_file, and its file list path.
+    """
+    monkeypatch.setenv('DC_CMD', 'docker compose')
+    (tmp_path / 'dev-env-config').mkdir()
+    (tmp_path / 'dev-env-config' / 'configuration.yml').write_text('applications:\n  web: {}\n')
+    fragments = tmp_path / 'apps' / 'web' / 'fragments'
+    fragments.mkdir(parents=True)
+    (tmp_path / 'apps' / 'root-compose-fragment.yml').write_text('services: {}\n')
+    (tmp_path / 'apps' / 'web' / 'configuration.yml').write_text('{}\n')
+    (fragments / 'compose-fragment.yml').write_text('services:\n  web:\n    env_file: web/web.env\n')
+    (tmp_path / 'apps' / 'web' / 'web.env').write_text('A=1\n')
+    return {'root': str(tmp_path), 'file_list': str(tmp_path / '.docker-compose-file-list')}
+
+
+def prepare(environment):
+    commodities.create_commodities_list(environment['root'])
+    docker_compose.prepare_compose(environment['root'], environment['file_list'])
+
+
+def test_compose_is_up_to_date_after_it_was_prepared(environment, fake_compose):
+    assert not docker_compose.compose_up_to_date(environment['root'], environment['file_list'])
+
+    prepare(environment)
+
+    assert docker_compose.compose_up_to_date(environment['root'], environment['file_list'])
+    assert len(fake_compose()) == 1
+
+
+@pytest.mark.parametrize('change', [
+    'apps/web/configuration.yml',
+    'apps/web/fragments/compose-fragment.yml',
+    'apps/web/fragments/compose-fragment.test.yml',
+    'apps/root-compose-fragment.yml',
+    'dev-env-config/configuration.yml',
+    'apps/web/web.env',
+])
+def test_changing_an_input_makes_compose_out_of_date(environment, fake_compose, change):
+    prepare(environment)
+
+    with open(os.path.join(environment['root'], change), 'a') as f:
+        f.write('\n# changed\n')
+
+    assert not docker_compose.compose_up_to_date(environment['root'], environment['file_list'])
+
+
+def test_a_missing_merged_file_makes_compose_out_of_date(environment, fake_compose):
+    prepare(environment)
+    with open(environment['file_list']) as f:
+        [merged] = f.read().split(':')
+
+    os.remove(merged)
+
+    assert not docker_compose.compose_up_to_date(environment['root'], environment['file_list'])
+
+
+def test_a_changed_commodity_list_makes_compose_out_of_date(environment, fake_compose):
+    prepare(environment)
+
+    with commodities.commodities_store(environment['root']).batch() as document:
+        document['commodities'].append('postgres-13')
+
+    assert not docker_compose.compose_up_to_date(environment['root'], environment['file_list'])
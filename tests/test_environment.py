@@ -0,0 +1,42 @@
+import pytest
+
+from scripts.environment import load_environment
+from scripts.startup_scheduler import StartupGraphError, build_startup_graph
+
+
+def write_config(root, app_config):
+    (root / 'dev-env-config').mkdir(exist_ok=True)
+    (root / 'dev-env-config' / 'configuration.yml').write_text('applications:\n  web: {repo: x}\n')
+    (root / 'apps' / 'web').mkdir(parents=True, exist_ok=True)
+    (root / 'apps' / 'web' / 'configuration.yml').write_text(app_config)
+
+
+def expensive(timeout):
+    return ('expensive_startup:\n'
+            '  - compose_service: web\n'
+            '    healthcheck_cmd: docker\n'
+            f'    startup_timeout: {timeout}\n')
+
+
+def startup_graph(root):
+    return build_startup_graph(load_environment(str(root)).expensive_services, ['web'])
+
+
+@pytest.mark.parametrize('value, expected', [('90', 90.0), ('2.5', 2.5), ('"120"', 120.0)])
+def test_startup_timeout_is_a_number_of_seconds(tmp_path, value, expected):
+    write_config(tmp_path, expensive(value))
+    assert startup_graph(tmp_path).services['web'].startup_timeout == expected
+
+
+def test_startup_timeout_is_optional(tmp_path):
+    write_config(tmp_path, 'expensive_startup:\n  - compose_service: web\n')
+    assert startup_graph(tmp_path).services['web'].startup_timeout is None
+
+
+@pytest.mark.parametrize('value', ['soon', '-5', '0', 'true', '[10]', '.inf'])
+def test_bad_startup_timeouts_are_rejected_when_starting(tmp_path, value):
+    write_config(tmp_path, expensive(value))
+    # Only starting the expensive services needs the timeout, so every other phase can still load the environment
+    environment = load_environment(str(tmp_path))
+    with pytest.raises(StartupGraphError, match='startup_timeout of web'):
+        build_startup_graph(environment.expensive_services, ['web'])
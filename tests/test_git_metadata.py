@@ -0,0 +1,86 @@
+import os
+import subprocess
+
+import pytest
+
+from scripts.git_metadata import HeadInfo, head_info_from_git, read_head, ref_sha
+
+
+def git(*args, cwd=None):
+    return subprocess.run(['git', *args], cwd=cwd, check=True, capture_output=True, text=True).stdout.strip()
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    """
+    A repository on main with two commits.
+    """
+    for name in ('AUTHOR', 'COMMITTER'):
+        monkeypatch.setenv(f'GIT_{name}_NAME', 'Test')
+        monkeypatch.setenv(f'GIT_{name}_EMAIL', 'test@example.com')
+    path = tmp_path / 'repo'
+    git('init', '-q', '-b', 'main', str(path))
+    for message in ('first', 'second'):
+        git('commit', '-q', '--allow-empty', '-m', message, cwd=path)
+    return str(path)
+
+
+def assert_matches_git(path):
+    # read_head is called directly so a fallback to git cannot hide a parsing failure
+    assert read_head(path) == head_info_from_git(path)
+
+
+def test_a_branch_in_loose_refs(repo):
+    assert not os.path.exists(os.path.join(repo, '.git', 'packed-refs'))
+    assert read_head(repo) == HeadInfo(branch='main', sha=git('rev-parse', 'HEAD', cwd=repo))
+    assert_matches_git(repo)
+
+
+def test_a_branch_in_packed_refs(repo):
+    git('remote', 'add', 'origin', 'https://example.com/repo.git', cwd=repo)
+    git('update-ref', 'refs/remotes/origin/main', 'HEAD~1', cwd=repo)
+    git('pack-refs', '--all', cwd=repo)
+    assert not os.path.exists(os.path.join(repo, '.git', 'refs', 'heads', 'main'))
+
+    assert read_head(repo) == HeadInfo(branch='main', sha=git('rev-parse', 'HEAD', cwd=repo))
+    assert ref_sha(repo, 'refs/remotes/origin/main') == git('rev-parse', 'HEAD~1', cwd=repo)
+    assert ref_sha(repo, 'refs/remotes/origin/missing') is None
+
+
+def test_a_loose_ref_wins_over_a_stale_packed_one(repo):
+    git('pack-refs', '--all', cwd=repo)
+    git('commit', '-q', '--allow-empty', '-m', 'third', cwd=repo)
+    assert_matches_git(repo)
+
+
+def test_a_detached_head(repo):
+    first = git('rev-parse', 'HEAD~1', cwd=repo)
+    git('checkout', '-q', '--detach', first, cwd=repo)
+    assert read_head(repo) == HeadInfo(branch=None, sha=first)
+    assert read_head(repo).detached
+
+
+def test_a_branch_with_no_commits(tmp_path):
+    path = str(tmp_path / 'empty')
+    git('init', '-q', '-b', 'main', path)
+    assert read_head(path) == HeadInfo(branch='main', sha=None)
+
+
+def test_a_linked_worktree(repo, tmp_path):
+    worktree = str(tmp_path / 'feature')
+    git('worktree', 'add', '-q', '-b', 'feature', worktree, 'HEAD~1', cwd=repo)
+    assert os.path.isfile(os.path.join(worktree, '.git'))
+
+    # HEAD is the worktree's own, the branch it points to lives in the main repository
+    assert read_head(worktree) == HeadInfo(branch='feature', sha=git('rev-parse', 'HEAD~1', cwd=repo))
+    assert read_head(repo).branch == 'main'
+    assert ref_sha(worktree, 'refs/heads/main') == git('rev-parse', 'main', cwd=repo)
+
+    git('pack-refs', '--all', cwd=repo)
+    assert_matches_git(worktree)
+
+
+def test_a_detached_linked_worktree(repo, tmp_path):
+    worktree = str(tmp_path / 'detached')
+    git('worktree', 'add', '-q', '--detach', worktree, 'HEAD', cwd=repo)
+    assert read_head(worktree) == HeadInfo(branch=None, sha=git('rev-parse', 'HEAD', cwd=repo))
@@ -0,0 +1,93 @@
+import json
+import time
+
+from scripts.health_watcher import HealthWatcher
+
+
+def event(action, name, service=None):
+    attributes = {'name': name}
+    if service:
+        attributes['com.docker.compose.service'] = service
+    return {'Type': 'container', 'Action': action, 'Actor': {'Attributes': attributes}}
+
+
+def fake_events(fake_bin, tmp_path, events, linger=0.0):
+    """
+    A `docker` whose `events` subcommand prints the given events (one JSON object per line) and then exits,
+    recording its arguments.
+    """
+    (tmp_path / 'events.json').write_text(json.dumps(events))
+    return fake_bin.add('docker', f'''
+        import sys, json, time
+        with open({str(tmp_path / 'args.json')!r}, 'w') as f:
+            json.dump(sys.argv[1:], f)
+        if sys.argv[1] != 'events':
+            sys.exit(1)
+        for event in json.load(open({str(tmp_path / 'events.json')!r})):
+            print(json.dumps(event), flush=True)
+            print('not json', flush=True)
+        time.sleep({linger})
+    ''')
+
+
+def wait_until_stopped(watcher, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while watcher.running and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_states_follow_the_event_stream(fake_bin, tmp_path):
+    docker = fake_events(fake_bin, tmp_path, [
+        event('start', 'proj-web-1', 'web'),
+        event('health_status: starting', 'proj-web-1', 'web'),
+        event('health_status: healthy', 'proj-web-1', 'web'),
+        event('die', 'proj-db-1', 'db'),
+        event('exec_start: sh', 'proj-db-1', 'db'),
+    ])
+    watcher = HealthWatcher(docker=docker, project='proj')
+    assert watcher.start()
+    wait_until_stopped(watcher)
+
+    assert watcher.state('web') == 'healthy'
+    assert watcher.state('proj-web-1') == 'healthy'
+    # exec events are not watched, so the last state seen for db is its death
+    assert watcher.state('db') == 'die'
+    assert json.loads((tmp_path / 'args.json').read_text()) == [
+        'events', '--format', '{{json .}}', '--filter', 'type=container',
+        '--filter', 'label=com.docker.compose.project=proj']
+
+
+def test_wait_is_woken_by_an_event(fake_bin, tmp_path):
+    docker = fake_bin.add('docker', f'''
+        import json, time
+        time.sleep(0.3)
+        print(json.dumps({event('health_status: healthy', 'web')!r}), flush=True)
+        time.sleep(5)
+    ''')
+    watcher = HealthWatcher(docker=docker)
+    assert watcher.start()
+    try:
+        since = watcher.generation
+        started = time.monotonic()
+        assert watcher.wait(since, timeout=4.0)
+        assert time.monotonic() - started < 3.0
+        assert watcher.state('web') == 'healthy'
+    finally:
+        watcher.stop()
+    assert not watcher.running
+
+
+def test_end_of_stream_falls_back_to_polling(fake_bin, tmp_path):
+    docker = fake_events(fake_bin, tmp_path, [])
+    watcher = HealthWatcher(docker=docker)
+    assert watcher.start()
+    wait_until_stopped(watcher)
+    assert not watcher.running
+    # With no stream, waiting is a plain sleep that reports no event
+    assert watcher.wait(watcher.generation, timeout=0.05) is False
+
+
+def test_missing_docker_cannot_start(tmp_path):
+    watcher = HealthWatcher(docker=str(tmp_path / 'no-such-docker'))
+    assert watcher.start() is False
+    assert not watcher.running
@@ -0,0 +1,161 @@
+import os
+import time
+
+import pytest
+
+from scripts import image_builds
+from scripts.image_builds import BuildService, builds_store, compile_pattern, context_hash, is_ignored
+
+
+def service(context, settings='{}'):
+    context = str(context)
+    return BuildService(name='web', image='web', context=context, dockerfile=os.path.join(context, 'Dockerfile'),
+                        settings=settings)
+
+
+def patterns(*lines):
+    return [(line.startswith('!'), compile_pattern(line.lstrip('!'))) for line in lines]
+
+
+@pytest.mark.parametrize('pattern, path, matches', [
+    ('*.log', 'build.log', True),
+    ('*.log', 'logs/build.log', False),
+    ('*/*.log', 'logs/build.log', True),
+    ('**/*.log', 'build.log', True),
+    ('**/*.log', 'a/b/build.log', True),
+    ('logs/**', 'logs/a/b', True),
+    ('file?.txt', 'file1.txt', True),
+    ('file?.txt', 'file/.txt', False),
+    ('[a-c].txt', 'b.txt', True),
+    ('[a-c].txt', 'd.txt', False),
+    ('a+b.txt', 'a+b.txt', True),
+    (r'\*.txt', '*.txt', True),
+    (r'\*.txt', 'a.txt', False),
+])
+def test_patterns_follow_dockerignore_syntax(pattern, path, matches):
+    assert bool(compile_pattern(pattern).fullmatch(path)) is matches
+
+
+def test_a_later_negation_re_includes_a_file():
+    rules = patterns('*.md', '!README.md')
+    assert is_ignored('CHANGES.md', rules)
+    assert not is_ignored('README.md', rules)
+    # The last matching pattern wins
+    assert is_ignored('README.md', rules + patterns('README.md'))
+
+
+def test_an_ignored_directory_ignores_everything_under_it():
+    rules = patterns('node_modules')
+    assert is_ignored('node_modules/a/index.js', rules)
+    assert not is_ignored('src/node_modules.txt', rules)
+
+
+def test_trailing_slashes_are_normalised(tmp_path):
+    (tmp_path / '.dockerignore').write_text('# comment\n\nbuild/\n/tmp\n!build/keep\n')
+    rules = image_builds.dockerignore_patterns(service(tmp_path))
+    assert is_ignored('build/output.o', rules)
+    assert is_ignored('tmp/x', rules)
+    assert not is_ignored('build/keep', rules)
+    assert not is_ignored('src/build.c', rules)
+
+
+def test_a_dockerfile_specific_ignore_file_wins(tmp_path):
+    (tmp_path / '.dockerignore').write_text('*.txt\n')
+    (tmp_path / 'Dockerfile.dockerignore').write_text('*.log\n')
+    rules = image_builds.dockerignore_patterns(service(tmp_path))
+    assert is_ignored('a.log', rules)
+    assert not is_ignored('a.txt', rules)
+
+
+@pytest.fixture
+def context(tmp_path):
+    root = tmp_path / 'context'
+    (root / 'src').mkdir(parents=True)
+    (root / 'node_modules' / 'dep').mkdir(parents=True)
+    (root / 'Dockerfile').write_text('FROM python:3\n')
+    (root / '.dockerignore').write_text('node_modules\n*.log\n')
+    (root / 'src' / 'app.py').write_text('print(1)\n')
+    (root / 'node_modules' / 'dep' / 'index.js').write_text('1\n')
+    (root / 'debug.log').write_text('noise\n')
+    return root
+
+
+def test_the_context_hash_ignores_ignored_files(context):
+    before = context_hash(service(context))
+    (context / 'node_modules' / 'dep' / 'index.js').write_text('2\n')
+    (context / 'debug.log').write_text('more noise\n')
+    (context / 'node_modules' / 'new.js').write_text('\n')
+    assert context_hash(service(context)) == before
+
+
+@pytest.mark.parametrize('change', ['content', 'new file', 'mode', 'dockerfile', 'settings'])
+def test_the_context_hash_covers_every_build_input(context, change):
+    before = context_hash(service(context))
+    settings = '{}'
+    if change == 'content':
+        (context / 'src' / 'app.py').write_text('print(2)\n')
+    elif change == 'new file':
+        (context / 'src' / 'util.py').write_text('\n')
+    elif change == 'mode':
+        os.chmod(context / 'src' / 'app.py', 0o755)
+    elif change == 'dockerfile':
+        (context / 'Dockerfile').write_text('FROM python:3.12\n')
+    else:
+        settings = '{"args": {"DEBUG": "1"}}'
+    assert context_hash(service(context, settings)) != before
+
+
+@pytest.fixture
+def plan(tmp_path, monkeypatch, context):
+    """
+    Plans a build of the context's service against recorded state, with docker reporting the image IDs in
+    `images`.
+    """
+    root_loc = str(tmp_path / 'root')
+    os.makedirs(root_loc)
+    monkeypatch.setenv('DEV_ENV_PULL_TTL', '3600')
+    images = {'web': 'sha256:built'}
+    monkeypatch.setattr(image_builds, 'image_id', lambda image: images.get(image))
+
+    def make_plan(build=None, pull=False, svc=None):
+        svc = svc or service(context)
+        if build is not None:
+            with builds_store(root_loc).batch() as document:
+                document['services']['web'] = dict(
+                    {'hash': context_hash(svc), 'image_id': 'sha256:built', 'pulled_at': time.time()}, **build)
+        return image_builds.plan_builds(root_loc, [svc], pull)
+    make_plan.images = images
+    return make_plan
+
+
+def test_an_unchanged_service_is_not_rebuilt(plan):
+    assert plan({}, pull=True) == []
+
+
+def test_a_missing_image_is_rebuilt(plan, capsys):
+    del plan.images['web']
+    [job] = plan({})
+    assert job.image_id is None
+    assert 'web: building (no image)' in capsys.readouterr().out
+
+
+def test_changed_inputs_are_rebuilt(plan, capsys):
+    [job] = plan({'hash': 'stale'})
+    assert not job.pull
+    assert 'build inputs changed' in capsys.readouterr().out
+
+
+def test_the_base_image_is_checked_once_the_pull_ttl_expires(plan, capsys):
+    assert plan({'pulled_at': time.time() - 600}, pull=True) == []
+    [job] = plan({'pulled_at': time.time() - 7200}, pull=True)
+    assert job.pull
+    assert 'base image check due' in capsys.readouterr().out
+    # Without --pull an expired check does not force a build
+    assert plan({'pulled_at': time.time() - 7200}, pull=False) == []
+
+
+def test_a_remote_context_is_always_rebuilt(plan, capsys):
+    remote = BuildService(name='web', image='web', context='https://github.com/example/web.git#main',
+                          dockerfile='https://github.com/example/web.git#main/Dockerfile', settings='{}')
+    assert len(plan({}, svc=remote)) == 1
+    assert 'remote build context' in capsys.readouterr().out
@@ -0,0 +1,118 @@
+import os
+import re
+import json
+
+import pytest
+
+from scripts import log_store
+
+LINES = [f'line {n}' for n in range(1, 501)]
+
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+    monkeypatch.setattr(log_store, 'BLOCK_SIZE', 256)
+
+
+@pytest.fixture
+def compressed(tmp_path, small_blocks):
+    """
+    A log of 500 lines, compressed into many small blocks.
+    """
+    path = tmp_path / 'build.log'
+    path.write_text('\n'.join(LINES) + '\n')
+    log_store.compress_log(str(path))
+    return log_store.resolve_log(str(path))
+
+
+@pytest.fixture
+def runs(tmp_path, monkeypatch):
+    """
+    Starts runs as separate processes would (nothing is shared in memory), without registering exit handlers.
+    """
+    monkeypatch.setattr(log_store.atexit, 'register', lambda function: None)
+    monkeypatch.setattr(log_store, '_runs', {})
+
+    def start(run_id=None):
+        if run_id is None:
+            monkeypatch.delenv(log_store.RUN_ID_VARIABLE, raising=False)
+        else:
+            monkeypatch.setenv(log_store.RUN_ID_VARIABLE, run_id)
+        log_store._runs.clear()
+        return log_store.run_logs(str(tmp_path))
+    return start
+
+
+def test_the_index_records_every_block(compressed):
+    assert not os.path.exists(compressed[:compressed.rindex('.')])
+    with open(log_store.index_path(compressed)) as f:
+        index = json.load(f)
+    assert index['lines'] == len(LINES)
+    assert len(index['blocks']) > 10
+    expected_offset, expected_line = 0, 0
+    for offset, size, first_line, count in index['blocks']:
+        assert (offset, first_line) == (expected_offset, expected_line)
+        expected_offset, expected_line = offset + size, first_line + count
+    assert expected_offset == os.path.getsize(compressed)
+
+
+@pytest.mark.parametrize('count', [0, 1, 10, 37, 500, 600])
+def test_tail_matches_the_plain_log(tmp_path, compressed, count):
+    plain = tmp_path / 'plain.log'
+    plain.write_text('\n'.join(LINES) + '\n')
+    expected = LINES[-count:] if count else []
+    assert log_store.tail_plain(str(plain), count) == expected
+    assert log_store.tail_log(compressed, count) == expected
+
+
+@pytest.mark.parametrize('pattern', [r'line 5', r'^line 5$', r'^line 49\d$', r'0$', r'\Aline 250\Z', r'nothing'])
+def test_grep_matches_the_plain_log(tmp_path, compressed, pattern):
+    plain = tmp_path / 'plain.log'
+    plain.write_text('\n'.join(LINES) + '\n')
+    expected = list(log_store.grep_log(str(plain), re.compile(pattern)))
+    assert list(log_store.grep_log(compressed, re.compile(pattern))) == expected
+    if pattern == r'^line 5$':
+        assert expected == [(5, 'line 5')]
+
+
+def test_a_second_log_of_the_same_name_is_appended(tmp_path, small_blocks):
+    path = tmp_path / 'build.log'
+    path.write_text('\n'.join(LINES[:200]) + '\n')
+    log_store.compress_log(str(path))
+    path.write_text('\n'.join(LINES[200:]) + '\n')
+    log_store.compress_log(str(path))
+
+    compressed = log_store.resolve_log(str(path))
+    assert log_store.tail_log(compressed, 3) == LINES[-3:]
+    assert list(log_store.grep_log(compressed, re.compile(r'^line (1|201|500)$'))) == \
+        [(1, 'line 1'), (201, 'line 201'), (500, 'line 500')]
+
+
+def test_the_processes_of_one_command_share_a_run(runs):
+    first = runs('20261017-120000-42')
+    first.record_failure(first.path('update-apps'), 1)
+    first.finish()
+
+    second = runs('20261017-120000-42')
+    assert second.directory == first.directory
+    manifest = log_store.read_manifest(second.directory)
+    assert 'finished' not in manifest
+    assert manifest['failures'] == [{'log': 'update-apps.log', 'exit_code': 1}]
+    assert log_store.latest_run(second.root_loc) == second.directory
+
+
+def test_without_a_run_id_each_process_has_its_own_run(runs):
+    assert runs().run_id.endswith(f'-{os.getpid()}')
+    assert runs('../escape').run_id.endswith(f'-{os.getpid()}')
+
+
+def test_last_failure_shows_the_end_of_each_failed_log(runs, capsys):
+    run = runs('20261017-120000-42')
+    path = run.path('imagebuild')
+    with open(path, 'w') as f:
+        f.write('\n'.join(LINES) + '\n')
+    run.record_failure(path, 2)
+    run.finish()
+
+    assert log_store.main(['--root', run.root_loc, 'last-failure', '-n', '2']) == 1
+    assert capsys.readouterr().out.splitlines() == ['==> imagebuild.log (exit code 2) <==', 'line 499', 'line 500']
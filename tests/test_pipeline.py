@@ -0,0 +1,101 @@
+import os
+import json
+
+import pytest
+
+from scripts.async_commands import run_sync
+from scripts.pipeline import Pipeline
+from scripts.provision_scripts import provision_postgres
+
+
+@pytest.fixture
+def root_loc(tmp_path, monkeypatch):
+    """
+    An environment with one app that has a Postgres 13 init fragment.
+    """
+    monkeypatch.setenv('DC_CMD', 'docker compose')
+    (tmp_path / 'dev-env-config').mkdir()
+    (tmp_path / 'dev-env-config' / 'configuration.yml').write_text('applications:\n  web: {}\n')
+    fragments = tmp_path / 'apps' / 'web' / 'fragments'
+    fragments.mkdir(parents=True)
+    (tmp_path / 'apps' / 'web' / 'configuration.yml').write_text('commodities: [postgres-13]\n')
+    (fragments / 'postgres-init-fragment.sql').write_text('CREATE DATABASE web;\n')
+    return str(tmp_path)
+
+
+@pytest.fixture
+def fake_compose(fake_bin, tmp_path):
+    """
+    A `docker` whose `compose ps --all --services` lists the services in services.txt, recording the
+    COMPOSE_FILE each call saw.
+    """
+    services = tmp_path / 'services.txt'
+    calls = tmp_path / 'calls.jsonl'
+    fake_bin.add('docker', f'''
+        import os, sys, json
+        with open({str(calls)!r}, 'a') as f:
+            f.write(json.dumps({{'args': sys.argv[1:], 'compose_file': os.environ.get('COMPOSE_FILE')}}) + '\\n')
+        if sys.argv[1:3] == ['compose', 'ps']:
+            print(open({str(services)!r}).read(), end='')
+    ''')
+
+    class FakeCompose:
+        @staticmethod
+        def services(*names):
+            services.write_text(''.join(f'{name}\n' for name in names))
+
+        @staticmethod
+        def calls():
+            return [json.loads(line) for line in calls.read_text().splitlines()]
+    return FakeCompose()
+
+
+@pytest.fixture
+def started(monkeypatch):
+    """
+    Records how start_postgres_maybe is called instead of starting anything.
+    """
+    calls = []
+
+    async def start_postgres_maybe(root_loc, appname, started, new_db_container, postgres_version, env=None):
+        calls.append({'app': appname, 'new': new_db_container, 'version': postgres_version, 'env': env})
+        return True
+    monkeypatch.setattr(provision_postgres, 'start_postgres_maybe', start_postgres_maybe)
+    return calls
+
+
+def make_pipeline(root_loc, tmp_path):
+    env = dict(os.environ, COMPOSE_FILE='/root-and-commodities.yml')
+    return Pipeline(root_loc, False, str(tmp_path / 'logs'), env)
+
+
+def test_a_container_that_does_not_exist_yet_is_new(root_loc, tmp_path, fake_compose, started):
+    fake_compose.services('web')
+    pipeline = make_pipeline(root_loc, tmp_path)
+
+    run_sync(pipeline.provision_app('web'))
+
+    assert started == [{'app': 'web', 'new': True, 'version': '13', 'env': pipeline.compose_env}]
+    assert fake_compose.calls() == [{'args': ['compose', 'ps', '--all', '--services'],
+                                     'compose_file': '/root-and-commodities.yml'}]
+
+
+def test_an_existing_container_is_not_new_and_is_only_checked_once(root_loc, tmp_path, fake_compose, started):
+    fake_compose.services('postgres-13', 'web')
+    pipeline = make_pipeline(root_loc, tmp_path)
+
+    run_sync(pipeline.provision_app('web'))
+    run_sync(pipeline.provision_app('web'))
+
+    assert [call['new'] for call in started] == [False, False]
+    assert len(fake_compose.calls()) == 1
+
+
+def test_the_process_environment_is_left_alone(root_loc, tmp_path, fake_compose, started, monkeypatch):
+    monkeypatch.setenv('COMPOSE_FILE', '/full-configuration.yml')
+    fake_compose.services('postgres-13')
+
+    run_sync(make_pipeline(root_loc, tmp_path).provision_app('web'))
+
+    assert os.environ['COMPOSE_FILE'] == '/full-configuration.yml'
+    assert fake_compose.calls()[0]['compose_file'] == '/root-and-commodities.yml'
@@ -0,0 +1,55 @@
+import sys
+
+from scripts import process_runner
+from scripts.process_runner import LineDecoder, run_process
+
+
+def decode(*chunks):
+    decoder = LineDecoder()
+    lines = []
+    for chunk in chunks:
+        lines += decoder.feed(chunk)
+    return lines + decoder.close()
+
+
+def test_crlf_split_across_chunks_is_one_line_end():
+    assert decode(b'first\r', b'\nsecond\r\n') == ['first', 'second']
+
+
+def test_a_bare_carriage_return_ends_a_line():
+    # git and docker redraw their progress lines with \r
+    assert decode(b'10%\r50%\r100%\ndone') == ['10%', '50%', '100%', 'done']
+    assert decode(b'10%\r', b'50%\r') == ['10%', '50%']
+
+
+def test_a_character_split_across_chunks_is_decoded_whole():
+    encoded = 'café ✓\n'.encode()
+    assert decode(encoded[:4], encoded[4:8], encoded[8:]) == ['café ✓']
+
+
+def test_invalid_utf8_is_replaced():
+    assert decode(b'bad \xff byte\n') == ['bad � byte']
+
+
+def test_an_unterminated_long_line_is_passed_on_in_pieces(monkeypatch):
+    monkeypatch.setattr(process_runner, 'MAX_LINE_LENGTH', 4)
+    decoder = LineDecoder()
+    assert decoder.feed(b'abcdefghij') == ['abcd', 'efgh']
+    assert decoder.close() == ['ij']
+
+
+def test_only_the_tail_is_kept_but_everything_is_logged(tmp_path):
+    log_path = tmp_path / 'out.log'
+    script = 'import sys\nfor n in range(5000):\n    print("line", n)\nsys.exit(3)\n'
+
+    result = run_process([sys.executable, '-c', script], log_path=str(log_path), tail_lines=3)
+
+    assert result.exit_code == 3
+    assert result.tail == ['line 4997', 'line 4998', 'line 4999']
+    assert log_path.read_text().splitlines() == [f'line {n}' for n in range(5000)]
+
+
+def test_a_missing_command_reports_127():
+    result = run_process(['/nonexistent/command'])
+    assert result.exit_code == 127
+    assert len(result.tail) == 1
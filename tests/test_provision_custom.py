@@ -0,0 +1,159 @@
+import os
+
+import pytest
+
+from scripts.provision_custom import provision_custom
+from scripts.state_store import custom_provision_store
+
+
+@pytest.fixture
+def make_root(tmp_path):
+    """
+    Writes an environment from {app: (configuration.yml, {script name: exit code})}. Each script appends
+    its app and name to ran.txt before exiting with its code.
+    """
+    root = tmp_path / 'root'
+    ran = tmp_path / 'ran.txt'
+
+    def make(apps):
+        (root / 'dev-env-config').mkdir(parents=True)
+        (root / 'dev-env-config' / 'configuration.yml').write_text(
+            'applications:\n' + ''.join(f'  {app}: {{}}\n' for app in apps))
+        for app, (config, scripts) in apps.items():
+            fragments = root / 'apps' / app / 'fragments'
+            fragments.mkdir(parents=True)
+            (root / 'apps' / app / 'configuration.yml').write_text(config)
+            for name, code in scripts.items():
+                (fragments / f'{name}.sh').write_text(f'echo {app}/{name} >> {ran}\nexit {code}\n')
+        return str(root)
+
+    def ran_scripts():
+        return ran.read_text().split() if ran.exists() else []
+
+    make.ran = ran_scripts
+    return make
+
+
+def test_apps_after_a_failed_app_are_skipped(make_root, capsys):
+    root_loc = make_root({
+        'base': ('', {'custom-provision': 1}),
+        'web': ('custom_provision: {after: [base]}\n', {'custom-provision': 0}),
+        'api': ('custom_provision: {after: [web]}\n', {'custom-provision': 0}),
+        'other': ('', {'custom-provision': 0}),
+    })
+
+    provision_custom(root_loc)
+
+    assert sorted(make_root.ran()) == ['base/custom-provision', 'other/custom-provision']
+    assert custom_provision_store(root_loc).data['applications'] == ['other']
+    output = capsys.readouterr().out
+    assert 'Skipping the custom provision scripts for web as base did not provision cleanly' in output
+    assert 'Skipping the custom provision scripts for api as web did not provision cleanly' in output
+    assert '2 script(s), 1 failed, 2 skipped' in output
+
+
+def test_the_always_script_is_skipped_after_the_once_only_script_fails(make_root, capsys):
+    root_loc = make_root({'web': ('', {'custom-provision': 3, 'custom-provision-always': 0})})
+
+    provision_custom(root_loc)
+
+    assert make_root.ran() == ['web/custom-provision']
+    assert 'skipped (the once-only script failed)' in capsys.readouterr().out
+
+    # Once the once-only script is fixed both run, in order
+    with open(os.path.join(root_loc, 'apps', 'web', 'fragments', 'custom-provision.sh'), 'w') as f:
+        f.write(f'echo web/custom-provision-fixed >> {os.path.dirname(root_loc)}/ran.txt\n')
+    provision_custom(root_loc)
+
+    assert make_root.ran() == ['web/custom-provision', 'web/custom-provision-fixed', 'web/custom-provision-always']
+
+
+def test_apps_after_a_successful_app_wait_for_it(make_root):
+    root_loc = make_root({
+        'web': ('custom_provision: {after: [base]}\n', {'custom-provision': 0}),
+        'base': ('', {'custom-provision': 0}),
+    })
+
+    provision_custom(root_loc)
+
+    assert make_root.ran() == ['base/custom-provision', 'web/custom-provision']
+
+
+
+ALWAYS_INPUTS = 'custom_provision: {always_inputs: {files: ["src/**/*.py"], images: [db], env: [APP_MODE]}}\n'
+
+
+@pytest.fixture
+def memoized(make_root, fake_bin, tmp_path, monkeypatch):
+    """
+    An app that has run its always-run script once. The script declares a file glob, the image of the db
+    container (read from db-image.txt by a fake `docker inspect`) and APP_MODE as its inputs.
+    Returns the number of times the script ran after calling provision_custom again.
+    """
+    image = tmp_path / 'db-image.txt'
+    image.write_text('sha256:one')
+    fake_bin.add('docker', f'''
+        import sys, json
+        if sys.argv[1] == 'inspect':
+            print(json.dumps([{{'Name': '/db', 'Image': open({str(image)!r}).read(),
+                                'State': {{'Status': 'running'}}, 'Config': {{'Env': []}}, 'Mounts': []}}]))
+    ''')
+    monkeypatch.setenv('APP_MODE', 'dev')
+    root_loc = make_root({'web': (ALWAYS_INPUTS, {'custom-provision-always': 0})})
+    app_dir = os.path.join(root_loc, 'apps', 'web')
+    os.makedirs(os.path.join(app_dir, 'src', 'pkg'))
+    with open(os.path.join(app_dir, 'src', 'pkg', 'app.py'), 'w') as f:
+        f.write('print(1)\n')
+    provision_custom(root_loc)
+    assert make_root.ran() == ['web/custom-provision-always']
+
+    def runs(force=False):
+        before = len(make_root.ran())
+        provision_custom(root_loc, force)
+        return len(make_root.ran()) - before
+    runs.app_dir = app_dir
+    runs.image = image
+    return runs
+
+
+def test_unchanged_inputs_skip_the_always_run_script(memoized, capsys):
+    assert memoized() == 0
+    assert 'are unchanged since it last succeeded, skipping' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('change', ['edit', 'new file', 'unmatched file'])
+def test_a_changed_input_file_reruns_the_script(memoized, change):
+    if change == 'edit':
+        path, content = os.path.join('src', 'pkg', 'app.py'), 'print(2)\n'
+    elif change == 'new file':
+        path, content = os.path.join('src', 'util.py'), '\n'
+    else:
+        path, content = 'README.md', 'not an input\n'
+    with open(os.path.join(memoized.app_dir, path), 'w') as f:
+        f.write(content)
+
+    assert memoized() == (0 if change == 'unmatched file' else 1)
+    # The new inputs were recorded, so the next run is skipped again
+    assert memoized() == 0
+
+
+def test_a_changed_environment_variable_reruns_the_script(memoized, monkeypatch):
+    monkeypatch.setenv('APP_MODE', 'test')
+    assert memoized() == 1
+    monkeypatch.delenv('APP_MODE')
+    assert memoized() == 1
+
+
+def test_a_changed_image_reruns_the_script(memoized):
+    memoized.image.write_text('sha256:two')
+    assert memoized() == 1
+
+
+def test_a_changed_script_reruns_it(memoized):
+    with open(os.path.join(memoized.app_dir, 'fragments', 'custom-provision-always.sh'), 'a') as f:
+        f.write('# edited\n')
+    assert memoized() == 1
+
+
+def test_force_runs_the_script_despite_unchanged_inputs(memoized):
+    assert memoized(force=True) == 1
@@ -0,0 +1,153 @@
+import os
+import json
+
+import pytest
+
+from scripts.async_commands import run_sync
+from scripts.commodities import fragment_digest, provision_status
+from scripts.provision_scripts import provision_postgres
+from scripts.volume_snapshots import snapshot_key, snapshot_path
+
+IMAGE = 'sha256:postgres13'
+FRAGMENTS = {'api': b'CREATE DATABASE api;\n', 'web': b'CREATE DATABASE web;\n'}
+
+
+@pytest.fixture
+def root_loc(tmp_path, monkeypatch):
+    """
+    An environment of two apps with Postgres 13 init fragments.
+    """
+    monkeypatch.setenv('DC_CMD', 'docker compose')
+    monkeypatch.setenv('DEV_ENV_VOLUME_SNAPSHOTS', '1')
+    monkeypatch.setattr(provision_postgres, 'health_watcher', lambda: None)
+    root = tmp_path / 'root'
+    (root / 'dev-env-config').mkdir(parents=True)
+    (root / 'dev-env-config' / 'configuration.yml').write_text(
+        'applications:\n' + ''.join(f'  {app}: {{}}\n' for app in FRAGMENTS))
+    for app, content in FRAGMENTS.items():
+        (root / 'apps' / app / 'fragments').mkdir(parents=True)
+        (root / 'apps' / app / 'configuration.yml').write_text('commodities: [postgres-13]\n')
+        (root / 'apps' / app / 'fragments' / 'postgres-init-fragment.sql').write_bytes(content)
+    return str(root)
+
+
+@pytest.fixture
+def docker(fake_bin, tmp_path):
+    """
+    A `docker` standing in for a healthy postgres-13 container whose data is in a named volume. psql
+    reports an error for any fragment containing 'boom'; tar and restores only touch the backup directory.
+    """
+    calls = tmp_path / 'docker-calls.jsonl'
+    state = tmp_path / 'docker-state'
+    state.mkdir()
+    fake_bin.add('docker', f'''
+        import os, re, sys, json, glob, shutil
+        args = sys.argv[1:]
+        state = {str(state)!r}
+        with open({str(calls)!r}, 'a') as f:
+            f.write(json.dumps(args) + '\\n')
+        if args[0] == 'inspect':
+            print(json.dumps([{{
+                'Name': '/postgres-13', 'Image': {IMAGE!r}, 'Config': {{'Env': []}},
+                'State': {{'Status': 'running', 'Health': {{'Status': 'healthy'}}}},
+                'Mounts': [{{'Type': 'volume', 'Name': 'pgdata', 'Destination': '/var/lib/postgresql/data'}}],
+            }}]))
+        elif args[0] == 'cp':
+            shutil.rmtree(os.path.join(state, 'uploaded'), ignore_errors=True)
+            shutil.copytree(args[1].rstrip('.'), os.path.join(state, 'uploaded'))
+        elif args[0] == 'exec':
+            script = open(os.path.join(state, 'uploaded', 'run-init-fragments.sql')).read()
+            for app in re.findall(r'\\\\ir (\\S+)\\.sql', script):
+                print('==dev-env-provision== begin ' + app)
+                if 'boom' in open(os.path.join(state, 'uploaded', app + '.sql')).read():
+                    print('psql:' + app + '.sql:1: ERROR:  boom')
+                print('==dev-env-provision== end ' + app)
+        elif args[0] == 'run' and '--entrypoint' in args and args[args.index('--entrypoint') + 1] == 'tar':
+            backup = next(arg.split(':')[0] for arg in args if arg.endswith(':/backup'))
+            target = next(arg for arg in args if arg.startswith('/backup/'))
+            open(os.path.join(backup, target[len('/backup/'):]), 'w').write('archive')
+    ''')
+
+    def read_calls():
+        if not calls.exists():
+            return []
+        result = [json.loads(line) for line in calls.read_text().splitlines()]
+        calls.unlink()
+        return result
+    return read_calls
+
+
+def provision(root_loc, new_containers):
+    run_sync(provision_postgres.provision_postgres_async(root_loc, new_containers, '13'))
+
+
+def digests():
+    return {app: fragment_digest(content) for app, content in FRAGMENTS.items()}
+
+
+def ran_psql(calls):
+    return any(call[0] == 'exec' for call in calls)
+
+
+def stopped(calls):
+    return any(call[:2] == ['compose', 'stop'] for call in calls)
+
+
+def test_the_snapshot_key_covers_the_image_and_every_fragment():
+    key = snapshot_key(IMAGE, digests())
+    assert key == snapshot_key(IMAGE, dict(reversed(list(digests().items()))))
+    assert key != snapshot_key('sha256:other', digests())
+    assert key != snapshot_key(IMAGE, dict(digests(), web=fragment_digest(b'changed')))
+    assert key != snapshot_key(IMAGE, {'web': digests()['web']})
+
+
+def test_a_new_container_is_snapshotted_then_restored(root_loc, docker):
+    path = snapshot_path(root_loc, 'postgres-13', snapshot_key(IMAGE, digests()))
+
+    provision(root_loc, ['postgres-13'])
+    calls = docker()
+    assert ran_psql(calls)
+    assert os.path.exists(path)
+
+    provision(root_loc, ['postgres-13'])
+    calls = docker()
+    assert not ran_psql(calls)
+    assert any(call[0] == 'run' and 'sh' in call for call in calls)
+    assert {app: provision_status(root_loc, app, 'postgres-13') for app in FRAGMENTS} == digests()
+
+
+def test_an_existing_container_is_never_snapshotted(root_loc, docker):
+    with open(os.path.join(root_loc, 'apps', 'web', 'fragments', 'postgres-init-fragment.sql'), 'ab') as f:
+        f.write(b'-- edited\n')
+
+    provision(root_loc, [])
+
+    calls = docker()
+    assert ran_psql(calls)
+    assert not stopped(calls)
+    assert not os.path.exists(os.path.join(root_loc, '.volume-snapshots'))
+
+
+def test_a_new_container_with_a_failing_fragment_is_not_snapshotted(root_loc, docker):
+    with open(os.path.join(root_loc, 'apps', 'web', 'fragments', 'postgres-init-fragment.sql'), 'ab') as f:
+        f.write(b'boom\n')
+
+    provision(root_loc, ['postgres-13'])
+
+    calls = docker()
+    assert ran_psql(calls)
+    assert not stopped(calls)
+    assert not os.path.exists(os.path.join(root_loc, '.volume-snapshots'))
+    assert provision_status(root_loc, 'web', 'postgres-13')['errors'] is True
+    assert provision_status(root_loc, 'api', 'postgres-13') == digests()['api']
+
+
+@pytest.mark.parametrize('new_db_container, ran, failed, wanted', [
+    (True, ['api', 'web'], [], True),
+    (False, ['api', 'web'], [], False),
+    (True, ['web'], [], False),
+    (True, ['api', 'web'], ['web'], False),
+])
+def test_snapshot_wanted(new_db_container, ran, failed, wanted):
+    fragments = {app: FRAGMENTS[app] for app in ran}
+    assert provision_postgres.snapshot_wanted(new_db_container, fragments, digests(), failed) is wanted
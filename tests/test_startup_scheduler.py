@@ -0,0 +1,48 @@
+import pytest
+
+from scripts.environment import ExpensiveService, HealthDependency
+from scripts.startup_scheduler import StartupGraphError, build_startup_graph
+
+
+def service(name, *waits_on):
+    return ExpensiveService(app_name=name, compose_service=name,
+                            wait_until_healthy=tuple(HealthDependency(dep, None) for dep in waits_on))
+
+
+def test_a_cycle_is_reported_with_its_path():
+    services = [service('web', 'api'), service('api', 'db'), service('db', 'web'), service('other')]
+
+    with pytest.raises(StartupGraphError, match='form a cycle: web -> api -> db -> web$'):
+        build_startup_graph(services, ['web', 'api', 'db', 'other'])
+
+
+def test_waiting_on_an_unknown_service_is_an_error():
+    with pytest.raises(StartupGraphError, match='unknown services: web -> missing$'):
+        build_startup_graph([service('web', 'db', 'missing')], ['web', 'db'])
+
+
+def test_a_cheap_service_that_is_waited_on_is_not_part_of_the_graph():
+    graph = build_startup_graph([service('web', 'db')], ['web', 'db'])
+
+    assert graph.chain_length == {'web': 1}
+    assert graph.critical_path() == ['web']
+
+
+def test_the_critical_path_is_the_longest_chain():
+    services = [
+        service('web', 'api', 'cache'),
+        service('api', 'auth'),
+        service('auth', 'db'),
+        service('cache'),
+        service('worker', 'cache'),
+        service('db'),
+    ]
+
+    graph = build_startup_graph(services, [s.compose_service for s in services])
+
+    assert graph.chain_length == {'web': 4, 'api': 3, 'auth': 2, 'cache': 1, 'worker': 2, 'db': 1}
+    assert graph.critical_path() == ['db', 'auth', 'api', 'web']
+
+
+def test_no_expensive_services_have_no_critical_path():
+    assert build_startup_graph([], []).critical_path() == []
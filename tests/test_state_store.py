@@ -0,0 +1,71 @@
+import time
+import threading
+import pytest
+from scripts.state_store import StateStore
+
+
+@pytest.fixture(params=['yaml', 'json', 'sqlite'])
+def store(request, tmp_path):
+    return StateStore(str(tmp_path), '.state', lambda: {'counts': {}}, backend=request.param)
+
+
+def test_batches_from_many_threads_lose_no_updates(store):
+    def bump(name):
+        for _ in range(50):
+            with store.batch() as document:
+                counts = document['counts']
+                total = counts.get('total', 0)
+                # Give other threads every chance to interleave between the read and the write
+                time.sleep(0.0001)
+                counts['total'] = total + 1
+                counts[name] = counts.get(name, 0) + 1
+
+    threads = [threading.Thread(target=bump, args=(f'thread{i}',)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    reread = StateStore(store.root_loc, store.name, store.default, backend=store.backend)
+    assert reread.data['counts'] == {'thread0': 50, 'thread1': 50, 'thread2': 50, 'thread3': 50, 'total': 200}
+
+
+def test_deferred_writes_once_for_batches_from_other_threads(store, monkeypatch):
+    writes = []
+    write = store._write
+    monkeypatch.setattr(store, '_write', lambda document: (writes.append(dict(document)), write(document)))
+
+    def record(name):
+        with store.batch() as document:
+            document['counts'][name] = 1
+
+    with store.deferred():
+        threads = [threading.Thread(target=record, args=(f'thread{i}',)) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert writes == []
+    assert len(writes) == 1
+    assert StateStore(store.root_loc, store.name, store.default, backend=store.backend).data['counts'] == \
+        {'thread0': 1, 'thread1': 1, 'thread2': 1}
+
+
+def test_nested_batches_in_one_thread_write_once(store, monkeypatch):
+    writes = []
+    monkeypatch.setattr(store, '_write', writes.append)
+    with store.batch() as outer:
+        with store.batch() as inner:
+            inner['counts']['a'] = 1
+        outer['counts']['b'] = 2
+    assert writes == [{'counts': {'a': 1, 'b': 2}}]
+
+
+def test_create_writes_the_default_only_once(store):
+    assert not store.exists()
+    store.create()
+    assert store.exists()
+    with store.batch() as document:
+        document['counts']['a'] = 1
+    store.create()
+    assert StateStore(store.root_loc, store.name, store.default, backend=store.backend).data == {'counts': {'a': 1}}
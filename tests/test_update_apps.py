@@ -0,0 +1,171 @@
+import os
+import threading
+import subprocess
+import pytest
+from scripts import update_apps
+
+
+def git(*args, cwd=None):
+    return subprocess.run(['git', *args], cwd=cwd, check=True, capture_output=True, text=True).stdout.strip()
+
+
+def commit(work, message):
+    with open(os.path.join(work, 'README'), 'a') as f:
+        f.write(message + '\n')
+    git('add', 'README', cwd=work)
+    git('commit', '-q', '-m', message, cwd=work)
+    git('push', '-q', 'origin', 'main', cwd=work)
+    return git('rev-parse', 'HEAD', cwd=work)
+
+
+@pytest.fixture
+def origin(tmp_path, monkeypatch):
+    """
+    A bare repo served over file:// (so git does not take its local-clone shortcuts) plus a work tree
+    that pushes to it.
+    """
+    for name in ('AUTHOR', 'COMMITTER'):
+        monkeypatch.setenv(f'GIT_{name}_NAME', 'Test')
+        monkeypatch.setenv(f'GIT_{name}_EMAIL', 'test@example.com')
+    bare = tmp_path / 'origin.git'
+    work = tmp_path / 'work'
+    git('init', '-q', '--bare', '-b', 'main', str(bare))
+    git('init', '-q', '-b', 'main', str(work))
+    git('remote', 'add', 'origin', str(bare), cwd=work)
+    commit(work, 'first')
+    return {'url': f'file://{bare}', 'work': str(work)}
+
+
+@pytest.fixture
+def root_loc(tmp_path, monkeypatch):
+    root = tmp_path / 'root'
+    (root / 'apps').mkdir(parents=True)
+    monkeypatch.setenv('DEV_ENV_GIT_CACHE', str(tmp_path / 'cache'))
+    return str(root)
+
+
+def alternates(root_loc, appname):
+    path = os.path.join(root_loc, 'apps', appname, '.git', 'objects', 'info', 'alternates')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read().strip()
+
+
+def test_mirror_miss_creates_the_mirror_and_borrows_from_it(origin, root_loc):
+    appconfig = {'repo': origin['url'], 'branch': 'main'}
+    mirror = update_apps.mirror_path(os.environ['DEV_ENV_GIT_CACHE'], origin['url'])
+    assert not os.path.exists(mirror)
+
+    update_apps.clone_app(appconfig, root_loc, 'app')
+
+    assert git('rev-parse', 'HEAD', cwd=mirror) == git('rev-parse', 'HEAD', cwd=origin['work'])
+    assert alternates(root_loc, 'app') == os.path.join(mirror, 'objects')
+    assert update_apps.current_branch(root_loc, 'app') == 'main'
+
+
+def test_mirror_hit_is_refreshed_before_cloning(origin, root_loc):
+    appconfig = {'repo': origin['url'], 'branch': 'main'}
+    update_apps.clone_app(appconfig, root_loc, 'first')
+    newer = commit(origin['work'], 'second')
+
+    update_apps.clone_app(appconfig, root_loc, 'second')
+
+    mirror = update_apps.mirror_path(os.environ['DEV_ENV_GIT_CACHE'], origin['url'])
+    assert git('rev-parse', 'main', cwd=mirror) == newer
+    assert git('rev-parse', 'HEAD', cwd=os.path.join(root_loc, 'apps', 'second')) == newer
+    assert alternates(root_loc, 'second') == os.path.join(mirror, 'objects')
+
+
+def test_broken_mirror_falls_back_to_a_plain_clone(origin, root_loc):
+    appconfig = {'repo': origin['url'], 'branch': 'main'}
+    # A directory that is not a git repo, so refreshing the mirror fails
+    os.makedirs(update_apps.mirror_path(os.environ['DEV_ENV_GIT_CACHE'], origin['url']))
+
+    output = update_apps.clone_app(appconfig, root_loc, 'app')
+
+    assert any('cloning without it' in line for line in output)
+    assert alternates(root_loc, 'app') is None
+    assert git('rev-parse', 'HEAD', cwd=os.path.join(root_loc, 'apps', 'app')) == \
+        git('rev-parse', 'HEAD', cwd=origin['work'])
+
+
+def test_cache_can_be_turned_off_per_app(origin, root_loc):
+    appconfig = {'repo': origin['url'], 'branch': 'main', 'clone': {'cache': False}}
+
+    update_apps.clone_app(appconfig, root_loc, 'app')
+
+    assert not os.path.exists(os.environ['DEV_ENV_GIT_CACHE'])
+    assert alternates(root_loc, 'app') is None
+
+
+def test_a_failing_app_does_not_stop_the_others(root_loc, monkeypatch, capsys):
+    os.makedirs(os.path.join(root_loc, 'dev-env-config'))
+    with open(os.path.join(root_loc, 'dev-env-config', 'configuration.yml'), 'w') as f:
+        f.write('applications:\n' + ''.join(f'  {app}: {{repo: none}}\n' for app in ('broken', 'callback', 'fine')))
+    monkeypatch.setenv('DEV_ENV_UPDATE_THREADS', '1')
+
+    def update_or_clone(appconfig, root_loc, appname, force_fetch):
+        if appname == 'broken':
+            raise OSError('disk full')
+        return []
+    monkeypatch.setattr(update_apps, 'update_or_clone', update_or_clone)
+    updated = []
+
+    def on_app_updated(appname):
+        if appname == 'callback':
+            raise RuntimeError('callback failed')
+        updated.append(appname)
+
+    # With a single worker, an exception escaping it would leave q.join() waiting forever
+    thread = threading.Thread(target=update_apps.update_apps, args=(root_loc,), kwargs={'on_app_updated': on_app_updated})
+    thread.start()
+    thread.join(timeout=30)
+
+    assert not thread.is_alive()
+    assert updated == ['fine']
+    output = capsys.readouterr().out
+    assert "Updating broken failed: OSError('disk full')" in output
+    assert "Updating callback failed: RuntimeError('callback failed')" in output
+
+
+def test_an_unchanged_remote_is_not_fetched(origin, root_loc):
+    appconfig = {'repo': origin['url'], 'branch': 'main'}
+    update_apps.clone_app(appconfig, root_loc, 'app')
+
+    output = update_apps.update_app(appconfig, root_loc, 'app')
+    assert any('(remote unchanged); skipping fetch' in line for line in output)
+
+    newer = commit(origin['work'], 'second')
+    output = update_apps.update_app(appconfig, root_loc, 'app')
+    assert not any('skipping fetch' in line for line in output)
+    assert git('rev-parse', 'HEAD', cwd=os.path.join(root_loc, 'apps', 'app')) == newer
+
+
+def test_a_recently_checked_remote_is_trusted_until_forced(origin, root_loc, monkeypatch):
+    monkeypatch.setenv('DEV_ENV_FETCH_TTL', '3600')
+    appconfig = {'repo': origin['url'], 'branch': 'main'}
+    update_apps.clone_app(appconfig, root_loc, 'app')
+    update_apps.update_app(appconfig, root_loc, 'app')
+    newer = commit(origin['work'], 'second')
+
+    # Within the TTL the recorded tip is trusted, so the new commit is not seen
+    output = update_apps.update_app(appconfig, root_loc, 'app')
+    assert any('(checked recently); skipping fetch' in line for line in output)
+    assert git('rev-parse', 'HEAD', cwd=os.path.join(root_loc, 'apps', 'app')) != newer
+
+    output = update_apps.update_app(appconfig, root_loc, 'app', force_fetch=True)
+    assert not any('skipping fetch' in line for line in output)
+    assert git('rev-parse', 'HEAD', cwd=os.path.join(root_loc, 'apps', 'app')) == newer
+
+
+def test_an_expired_ttl_asks_the_remote_again(origin, root_loc, monkeypatch):
+    monkeypatch.setenv('DEV_ENV_FETCH_TTL', '3600')
+    appconfig = {'repo': origin['url'], 'branch': 'main'}
+    update_apps.clone_app(appconfig, root_loc, 'app')
+    update_apps.update_app(appconfig, root_loc, 'app')
+    newer = commit(origin['work'], 'second')
+
+    monkeypatch.setenv('DEV_ENV_FETCH_TTL', '0')
+    update_apps.update_app(appconfig, root_loc, 'app')
+    assert git('rev-parse', 'HEAD', cwd=os.path.join(root_loc, 'apps', 'app')) == newer
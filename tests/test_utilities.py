@@ -0,0 +1,16 @@
+from scripts.utilities import print_log_tail
+
+
+def test_print_log_tail_prints_the_last_lines(tmp_path, capsys):
+    log = tmp_path / 'build.log'
+    log.write_text(''.join(f'line {n}\n' for n in range(1, 21)))
+
+    print_log_tail(str(log), lines=3)
+
+    assert capsys.readouterr().out == 'line 18\nline 19\nline 20\n'
+
+
+def test_print_log_tail_notes_a_missing_log(tmp_path, capsys):
+    print_log_tail(str(tmp_path / 'never-written.log'))
+
+    assert 'no log was written' in capsys.readouterr().out